@@ -38,16 +38,43 @@ Function readMsg($msgID%)
       PRINT "REBIRTH COMMAND"
       @PublishAllTags()
     ENDIF
+    IF msgTopic$ = mqtt_base_topic$ + "CMD" AND LEN(msgData$) > 6 THEN
+      IF msgData$(1 TO 6) = "WRITE;" THEN
+        PRINT "WRITE COMMAND"
+        @WriteTags(msgData$)
+      ENDIF
+    ENDIF
   ENDIF
 ENDFN
+// Batched tag writes: "WRITE;<count>;<index>,<value>;<index>,<value>..."
+// index is the tag position ($n%) in the BIRTH metric list, the next RBE cycle reports the new values
+FUNCTION WriteTags($cmd$)
+  $rest$ = $cmd$(7 TO LEN($cmd$)) + ";"
+  $sep% = INSTR 1, $rest$, ";"
+  $count% = VAL($rest$(1 TO $sep% - 1))
+  FOR $k% = 1 To $count%
+    $rest$ = $rest$($sep% + 1 TO LEN($rest$))
+    $sep% = INSTR 1, $rest$, ";"
+    $item$ = $rest$(1 TO $sep% - 1)
+    $comma% = INSTR 1, $item$, ","
+    $n% = VAL($item$(1 TO $comma% - 1))
+    IF $n% >= 1 AND $n% <= no_tags% THEN
+      SETIO RTRIM tags_names$(1, $n%), VAL($item$($comma% + 1 TO LEN($item$)))
+    ENDIF
+  NEXT $k%
+ENDFN
 Function MosquittoMQTTStatusChange($status%)
   IF $status% = 5 Then
     PRINT "MQTT connected"
     MQTT "subscribe", mqtt_base_topic$ + "CMD", 0
-    MQTT "publish", mqtt_state_topic$, "ONLINE", 0, 1
+    MQTT "publish", mqtt_state_topic$, online_payload$, 0, 1
     //@PublishAllTags()
     TSET 1, poll_seconds%
-    ONTIMER 1, "@RBE()"
+    IF data_format$ = "DATA2" THEN
+      ONTIMER 1, "@RBE2()"
+    ELSE
+      ONTIMER 1, "@RBE()"
+    ENDIF
   ELSE
     PRINT "MQTT disconnected"
     TSET 1, 0
@@ -78,6 +105,36 @@ FUNCTION RBE()
     $payload$ = $payload$ + $metrics$ + '}'
     //PRINT $payload$
     MQTT "publish", mqtt_base_topic$ + 'DATA', $payload$, 0, 0
+    idle_polls% = 0
+  ELSE
+    @Heartbeat($payload$ + '[]}', 'DATA')
+  ENDIF
+ENDFN
+// Empty DATA after heartbeat_polls% polls without changes, the bridge DDEATHs a Flexy that stays silent
+FUNCTION Heartbeat($payload$, $message_type$)
+  idle_polls% = idle_polls% + 1
+  IF idle_polls% >= heartbeat_polls% THEN
+    MQTT "publish", mqtt_base_topic$ + $message_type$, $payload$, 0, 0
+    idle_polls% = 0
+  ENDIF
+ENDFN
+// Compact DATA2 format: "<t>;<tag count>;<index>,<value>;<index>,<value>..."
+// index is the tag position ($n%) in the BIRTH metric list
+FUNCTION RBE2()
+  $read_timestamp% = GETSYS PRG, "TIMESEC"
+  @ReadRoundTags()
+  $metrics$ = ""
+  FOR $n% = 1 To no_tags%
+    IF NOT tags_values(1, $n%) = tags_values_prev(1, $n%) THEN
+      $metrics$ = $metrics$ + ";" + STR$($n%) + "," + STR$(tags_values(1, $n%))
+    ENDIF
+  NEXT $n%
+  $payload$ = STR$($read_timestamp%) + ";" + STR$(no_tags%)
+  IF NOT $metrics$ = "" THEN
+    MQTT "publish", mqtt_base_topic$ + 'DATA2', $payload$ + $metrics$, 0, 0
+    idle_polls% = 0
+  ELSE
+    @Heartbeat($payload$, 'DATA2')
   ENDIF
 ENDFN
 FUNCTION PublishAllTags()
@@ -96,7 +153,8 @@ FUNCTION PublishAllTags()
   NEXT $n%
   $metrics$ = $metrics$ + "]"
   //PRINT $metrics$
-  $payload$ = $payload$ + $metrics$ + '}'
+  // "p" and "h" tell the bridge how long the Flexy can stay silent
+  $payload$ = $payload$ + $metrics$ + ', "p":' + STR$(poll_seconds%) + ', "h":' + STR$(heartbeat_polls%) + '}'
   //PRINT $payload$
   MQTT "publish", mqtt_base_topic$ + 'BIRTH', $payload$, 0, 0
 ENDFN
@@ -157,6 +215,14 @@ FOR x% = 0 To no_tags% -1
   tags_types$(1, x%+1) = TYPE$(GETIO RTRIM tag_name$)
   tags_names$(1,x%+1) = RTRIM tag_name$
 NEXT x%
+// Retained STATE "ONLINE;<id>,<id>...", a restarted bridge checks its cached aliases against the tag IDs
+online_payload$ = "ONLINE;"
+FOR x% = 1 To no_tags%
+  IF x% > 1 THEN
+    online_payload$ = online_payload$ + ","
+  ENDIF
+  online_payload$ = online_payload$ + RTRIM tags_ids$(1, x%)
+NEXT x%
 // User defined Variables
 mqtt_namespace$ = "flexy_v1.0"
 mqtt_host$ = "mqtt.iono2x.com"
@@ -173,6 +239,11 @@ mqtt_base_topic$ = mqtt_namespace$ + "/" + group_id$ + "/" + node_id$ + "/" + de
 mqtt_client$ = group_id$ + "_" + node_id$ + "_" + device_id$
 mqtt_state_topic$ = mqtt_base_topic$ + "STATE"
 poll_seconds% = 20
+// Polls without changes before an empty heartbeat DATA is sent
+heartbeat_polls% = 3
+idle_polls% = 0
+// DATA (JSON) or DATA2 (compact positional, needs a translator that handles DATA2)
+data_format$ = "DATA"
 
 @Start()
 Rem --- eWON user (end)
@@ -0,0 +1,336 @@
+# Offline throughput/latency benchmark for the translator hot paths, no broker needed.
+#   python bench.py --devices 200 --tags 500 --messages 50000 --change-ratio 0.02
+#   python bench.py --logging --log-write-us 100      per message cost of the DDATA log line, print vs logger
+import argparse
+import concurrent.futures
+import contextlib
+import datetime as dt
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+from pyapp.ewon_translate import SparkplugNode, FlexyTranslatorNode
+from pyapp.fake_mqtt import FakeMqttClient, FakeMessage
+from pyapp.log import AsyncLogger, EventLimit, INFO, LEVELS, WARNING, logger
+from pyapp.protobuf import sparkplug_b_pb2
+from pyapp.rbe import RbeEngine
+from pyapp.shard import ShardFilter
+from pyapp.templates import TemplateRegistry
+
+VALUE_GENERATORS = {
+    'float': lambda rnd: f'{rnd.uniform(-1000, 1000):.2f}',
+    'integer': lambda rnd: str(rnd.randint(0, 100000)),
+    'boolean': lambda rnd: str(rnd.randint(0, 1)),
+    'string': lambda rnd: f'text_{rnd.randint(0, 9999)}',
+}
+
+
+class LatencyRecorder:
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = []
+        self.bytes_out = 0
+        self.publishes = 0
+        self.elapsed = 0.0
+
+    def run(self, client: FakeMqttClient, callback, messages: list):
+        bytes_before, publishes_before = client.publish_bytes, client.publish_count
+        perf_counter_ns = time.perf_counter_ns
+        samples = self.samples
+        started = time.perf_counter()
+        for message in messages:
+            call_started = perf_counter_ns()
+            callback(client, None, message)
+            samples.append(perf_counter_ns() - call_started)
+        self.elapsed += time.perf_counter() - started
+        self.bytes_out += client.publish_bytes - bytes_before
+        self.publishes += client.publish_count - publishes_before
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+        if not samples:
+            return dict(name=self.name, calls=0)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] / 1000
+
+        return dict(name=self.name, calls=len(samples),
+                    msgs_per_s=round(len(samples) / self.elapsed, 1) if self.elapsed else 0,
+                    p50_us=round(percentile(0.50), 1), p99_us=round(percentile(0.99), 1),
+                    max_us=round(samples[-1] / 1000, 1), publishes=self.publishes, bytes_out=self.bytes_out)
+
+
+class SlowStream:
+    # stdout stand-in whose writes block for write_us, like a slow Docker log driver or a full pipe
+    def __init__(self, write_us: float):
+        self.write_us = write_us
+        self.writes = 0
+
+    def write(self, text: str) -> int:
+        self.writes += 1
+        if self.write_us:
+            time.sleep(self.write_us / 1_000_000)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def parse_mix(text: str) -> list:
+    mix = []
+    for item in text.split(','):
+        datatype, _, weight = item.partition('=')
+        if datatype not in VALUE_GENERATORS:
+            raise argparse.ArgumentTypeError(f'unknown datatype "{datatype}"')
+        mix.append((datatype, float(weight or 1)))
+    return mix
+
+
+def flexy_topic(index: int) -> str:
+    return f'flexy_v1.0/bench/iono2x_bench/flexy_{index:05d}'
+
+
+def make_birth(rnd: random.Random, index: int, tags: int, mix: list, timestamp: int,
+               repeated_groups: bool = False) -> tuple:
+    datatypes = rnd.choices([datatype for datatype, _ in mix], weights=[weight for _, weight in mix], k=tags)
+    if repeated_groups:
+        # Every group of 20 tags has the same members on every Flexy, as for identical equipment
+        group_types = random.Random(0).choices([datatype for datatype, _ in mix],
+                                               weights=[weight for _, weight in mix], k=20)
+        datatypes = [group_types[tag % 20] for tag in range(tags)]
+    metrics = [{'n': f'Group{tag // 20}.Tag{tag % 20 if repeated_groups else tag}', 'a': str(tag + 1), 't': datatype,
+                'v': VALUE_GENERATORS[datatype](rnd)} for tag, datatype in enumerate(datatypes)]
+    payload = json.dumps({'t': timestamp, 'm': metrics}).encode()
+    return FakeMessage(flexy_topic(index) + '/BIRTH', payload), datatypes
+
+
+def make_data(rnd: random.Random, index: int, datatypes: list, changed: int, timestamp: int,
+              data_format: str = 'json') -> FakeMessage:
+    aliases = rnd.sample(range(len(datatypes)), changed)
+    metrics = [{'a': str(alias + 1), 'v': VALUE_GENERATORS[datatypes[alias]](rnd)} for alias in sorted(aliases)]
+    if data_format == 'data2':
+        # Positions in the BIRTH list, which equal the aliases here
+        items = ''.join(f';{metric["a"]},{metric["v"]}' for metric in metrics)
+        return FakeMessage(flexy_topic(index) + '/DATA2', f'{timestamp};{len(datatypes)}{items}'.encode())
+    return FakeMessage(flexy_topic(index) + '/DATA', json.dumps({'t': timestamp, 'm': metrics}).encode())
+
+
+def make_dcmd(sparkplug_node: SparkplugNode, index: int) -> FakeMessage:
+    payload = sparkplug_b_pb2.Payload()
+    metric = payload.metrics.add()
+    metric.name = 'Device Control/Rebirth'
+    metric.datatype = 11
+    metric.boolean_value = True
+    return FakeMessage(sparkplug_node.dcmd_topic(f'flexy_{index:05d}'), payload.SerializeToString())
+
+
+def run(args, shard_index: int = 0, shard_count: int = 1, barrier=None) -> dict:
+    # With shard_count > 1 every message is delivered, as the broker would, and the shard filter skips the
+    # Flexys owned by the other shards. barrier lines up the DATA phase of shards running at the same time
+    rnd = random.Random(args.seed)
+    mix = parse_mix(args.types)
+    shard_filter = ShardFilter(shard_index, shard_count) if shard_count > 1 else None
+    sparkplug_node = SparkplugNode(group_id='bench',
+                                   node_id=f'bench_node-{shard_index}' if shard_filter else 'bench_node')
+    flexy_node = FlexyTranslatorNode(sparkplug_node=sparkplug_node, direct_encoding=args.encoding == 'direct',
+                                     rbe=RbeEngine.from_file(None) if args.rbe else None,
+                                     templates=TemplateRegistry() if args.templates else None)
+    client = FakeMqttClient()
+    timestamp = 1_700_000_000
+    logger.level = LEVELS[args.log_level]
+    if args.log_write_us:
+        logger.stream = SlowStream(args.log_write_us)
+
+    births, device_types = [], []
+    for index in range(args.devices):
+        message, datatypes = make_birth(rnd, index, args.tags, mix, timestamp, repeated_groups=args.repeated_groups)
+        births.append(message)
+        device_types.append(datatypes)
+    changed = max(1, min(args.tags, round(args.tags * args.change_ratio)))
+    data = []
+    for number in range(args.messages):
+        index = rnd.randrange(args.devices)
+        data.append(make_data(rnd, index, device_types[index], changed, timestamp + 1 + number // args.devices,
+                              args.data_format))
+    dcmds = [make_dcmd(sparkplug_node, rnd.randrange(args.devices)) for _ in range(args.dcmds)]
+    birth_callback = flexy_node.process_flexy_birth_message
+    data_callback = flexy_node.process_flexy_data_message
+    if args.data_format == 'data2':
+        data_callback = flexy_node.process_flexy_data2_message
+    if shard_filter is not None:
+        birth_callback = shard_filter.wrap(birth_callback)
+        data_callback = shard_filter.wrap(data_callback)
+        # DCMDs are addressed to this shard's edge node, only its own devices receive them
+        dcmds = [message for message in dcmds if shard_filter.owns_serial(message.topic.split('/')[-1])]
+
+    data_name = 'process_flexy_data2_message' if args.data_format == 'data2' else 'process_flexy_data_message'
+    recorders = [LatencyRecorder('process_flexy_birth_message'), LatencyRecorder(data_name),
+                 LatencyRecorder('process_dcmd_message'), LatencyRecorder('publish_birth')]
+    sink = open(os.devnull, 'w') if not args.show_output else None
+    with contextlib.redirect_stdout(sink) if sink else contextlib.nullcontext():
+        recorders[0].run(client, birth_callback, births)
+        if barrier is not None:
+            barrier.wait()
+        data_window = [time.monotonic()]
+        recorders[1].run(client, data_callback, data)
+        data_window.append(time.monotonic())
+        recorders[2].run(client, flexy_node.process_dcmd_message, dcmds)
+        recorders[3].run(client, lambda c, userdata, message: flexy_node.publish_birth(c, 0), range(args.rebirths))
+        logger.flush()
+    if sink:
+        sink.close()
+
+    return dict(
+        config=dict(devices=args.devices, tags=args.tags, change_ratio=args.change_ratio, changed_per_message=changed,
+                    types=args.types, data_format=args.data_format, encoding=args.encoding, rbe=args.rbe,
+                    repeated_groups=args.repeated_groups, templates=args.templates, log_level=args.log_level,
+                    log_write_us=args.log_write_us, seed=args.seed,
+                    bytes_in=sum(len(message.payload) for message in data),
+                    shard=f'{shard_index}/{shard_count}'),
+        results=[recorder.summary() for recorder in recorders],
+        data_window=data_window,  # monotonic start/end of the DATA phase, the clock is system wide
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    )
+
+
+def run_logging(args) -> dict:
+    # Cost per DDATA on the calling thread of the line logged for it: the print() the translator used to do,
+    # the async logger writing to the same stream, the logger with the event below its level, and 1 in 100 sampling
+    stream = SlowStream(args.log_write_us)
+    timestamp = 1_700_000_000_000
+
+    def print_line(client, userdata, message):
+        print(dt.datetime.fromtimestamp(timestamp / 1000), 'DDATA PUBLISHED, source: process_flexy_data_message()',
+              file=stream, flush=True)
+
+    def log_line(async_logger: AsyncLogger):
+        def log(client, userdata, message):
+            async_logger.info('ddata_published', 'DDATA PUBLISHED, source: process_flexy_data_message()',
+                              device='flexy_00001', t=timestamp)
+        return log
+
+    cases = [
+        ('print', print_line),
+        ('logger', log_line(AsyncLogger(level=INFO, stream=stream))),
+        ('logger_disabled', log_line(AsyncLogger(level=WARNING, stream=stream))),
+        ('logger_sampled_100', log_line(AsyncLogger(level=INFO, stream=stream,
+                                                    limits={'ddata_published': EventLimit(every=100)}))),
+    ]
+    client = FakeMqttClient()
+    recorders = []
+    for name, callback in cases:
+        recorder = LatencyRecorder(name)
+        recorder.run(client, callback, range(args.messages))
+        recorders.append(recorder)
+    return dict(config=dict(messages=args.messages, log_write_us=args.log_write_us, stream_writes=stream.writes),
+                results=[recorder.summary() for recorder in recorders],
+                peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1))
+
+
+def available_cores() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def run_shards(args) -> dict:
+    # Every shard runs in its own process and is handed the full DATA stream, as the broker delivers it.
+    # The shards start their DATA phase together and the aggregate is measured: messages / (last shard done -
+    # first shard started). It only scales with as many free cores as shards.
+    # With --projected they run one after another and the aggregate assumes a core per shard (slowest shard)
+    baseline = _run_in_process(args, 0, 1)
+    with multiprocessing.Manager() as manager:
+        barrier = manager.Barrier(args.shards) if not args.projected else None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1 if args.projected else args.shards) as executor:
+            reports = list(executor.map(_run_shard, [(args, index, args.shards, barrier)
+                                                     for index in range(args.shards)]))
+
+    if args.projected:
+        seconds = max(report['data_window'][1] - report['data_window'][0] for report in reports)
+    else:
+        seconds = max(report['data_window'][1] for report in reports) - \
+            min(report['data_window'][0] for report in reports)
+    baseline_rate = round(args.messages / (baseline['data_window'][1] - baseline['data_window'][0]), 1)
+    aggregate = round(args.messages / seconds, 1)
+    return dict(baseline=baseline, shards=reports,
+                scaling=dict(shards=args.shards, cores=available_cores(), baseline_msgs_per_s=baseline_rate,
+                             aggregate_msgs_per_s=aggregate, speedup=round(aggregate / baseline_rate, 2),
+                             mode='projected' if args.projected else 'measured'))
+
+
+def _run_shard(task: tuple) -> dict:
+    args, index, count, barrier = task
+    return run(args, index, count, barrier)
+
+
+def _run_in_process(args, index: int, count: int) -> dict:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run_shard, (args, index, count, None)).result()
+
+
+def print_report(report: dict):
+    print(' '.join(f'{key}={value}' for key, value in report['config'].items()))
+    header = f'{"callback":<30}{"calls":>8}{"msgs/s":>12}{"p50 us":>10}{"p99 us":>10}{"max us":>10}' \
+             f'{"publishes":>11}{"bytes out":>12}'
+    print(header)
+    print('-' * len(header))
+    for result in report['results']:
+        if not result['calls']:
+            continue
+        print(f'{result["name"]:<30}{result["calls"]:>8}{result["msgs_per_s"]:>12}{result["p50_us"]:>10}'
+              f'{result["p99_us"]:>10}{result["max_us"]:>10}{result["publishes"]:>11}{result["bytes_out"]:>12}')
+    print(f'peak RSS: {report["peak_rss_mb"]} MB')
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description='Benchmark FlexyTranslatorNode callbacks with a fake MQTT client')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=200, help='tags per device')
+    parser.add_argument('--messages', type=int, default=20000, help='DATA messages')
+    parser.add_argument('--change-ratio', type=float, default=0.05, help='fraction of tags changed per DATA message')
+    parser.add_argument('--types', default='float=6,integer=2,boolean=1.5,string=0.5',
+                        help='datatype mix as datatype=weight,...')
+    parser.add_argument('--dcmds', type=int, default=1000, help='DCMD rebirth requests')
+    parser.add_argument('--rebirths', type=int, default=20, help='node wide publish_birth calls')
+    parser.add_argument('--data-format', choices=('json', 'data2'), default='json',
+                        help='Flexy DATA wire format, JSON on /DATA or positional on /DATA2')
+    parser.add_argument('--encoding', choices=('direct', 'parse_dict'), default='direct')
+    parser.add_argument('--rbe', action='store_true', help='enable the default RBE engine (suppress identical)')
+    parser.add_argument('--repeated-groups', action='store_true', help='every group of 20 tags has the same members')
+    parser.add_argument('--templates', action='store_true', help='publish repeated tag groups as Sparkplug Templates')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='run N hash sharded translators, each in its own process, and report the scaling')
+    parser.add_argument('--projected', action='store_true',
+                        help='run the shards one after another and project the aggregate for a core per shard')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--show-output', action='store_true', help='keep the translator log output')
+    parser.add_argument('--log-level', choices=tuple(LEVELS), default='INFO', help='translator log level')
+    parser.add_argument('--log-write-us', type=float, default=0,
+                        help='make every write to stdout block for this many microseconds')
+    parser.add_argument('--logging', action='store_true',
+                        help='only measure the per message cost of the DDATA log line, print vs logger')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    if args.logging:
+        report = run_logging(args)
+    else:
+        report = run(args) if args.shards <= 1 else run_shards(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif args.shards <= 1 or args.logging:
+        print_report(report)
+    else:
+        for shard_report in [report['baseline']] + report['shards']:
+            print_report(shard_report)
+            print()
+        print(' '.join(f'{key}={value}' for key, value in report['scaling'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import gzip
+import struct
+import threading
+import time
+
+from pyapp.fake_mqtt import FakeMessage
+
+MAGIC = b'FLXCAP1\n'
+# arrival time (unix seconds), flags, topic length, payload length
+RECORD_HEADER = struct.Struct('<dBHI')
+FLAG_RETAIN = 0x01
+
+
+def _open(path: str, mode: str):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+class CaptureWriter:
+    # Length prefixed binary records of MQTT messages, gzip compressed when the path ends with .gz
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self.__file = _open(path, 'wb')
+        self.__file.write(MAGIC)
+        self.__lock = threading.Lock()
+
+    def record(self, topic: str, payload: bytes, retain: bool = False, timestamp: float = None):
+        topic_bytes = topic.encode()
+        payload = payload if isinstance(payload, bytes) else (payload or '').encode()
+        header = RECORD_HEADER.pack(time.time() if timestamp is None else timestamp,
+                                    FLAG_RETAIN if retain else 0, len(topic_bytes), len(payload))
+        with self.__lock:
+            self.__file.write(header + topic_bytes + payload)
+            self.count += 1
+
+    def wrap(self, callback):
+        record = self.record
+
+        def recorded(client, userdata, message):
+            record(message.topic, message.payload, message.retain)
+            callback(client, userdata, message)
+        return recorded
+
+    def flush(self):
+        with self.__lock:
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+def read_capture(path: str):
+    # Yields FakeMessage records, timestamp is the arrival time in unix seconds
+    with _open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'"{path}" is not a capture file')
+        header_size = RECORD_HEADER.size
+        while True:
+            header = file.read(header_size)
+            if not header:
+                return
+            if len(header) < header_size:
+                raise ValueError(f'"{path}" ends with a truncated record')
+            timestamp, flags, topic_length, payload_length = RECORD_HEADER.unpack(header)
+            topic = file.read(topic_length).decode()
+            payload = file.read(payload_length)
+            if len(payload) < payload_length:
+                raise ValueError(f'"{path}" ends with a truncated record')
+            yield FakeMessage(topic, payload, retain=bool(flags & FLAG_RETAIN), timestamp=timestamp)
@@ -10,9 +10,106 @@ MQTT_USE_TLS = os.environ.get('MQTT_USE_TLS', default='False') in ['True', 'true
 SPARKPLUG_GROUP_ID = os.environ.get('SPARKPLUG_GROUP_ID')
 SPARKPLUG_EDGE_NODE_ID = os.environ.get('SPARKPLUG_EDGE_NODE_ID')
 
+# Sharded deployment, see shards.py. Each shard is its own edge node "<SPARKPLUG_EDGE_NODE_ID>-<SHARD_INDEX>"
+# with its own bdSeq and MQTT client id, and keeps the Flexys whose serial hashes to SHARD_INDEX
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', default=0))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', default=1))
+# Explicit partitioning as comma separated topic filters, e.g. "flexy_v1.0/site_a/#,flexy_v1.0/site_b/#".
+# The broker then only sends this shard its own Flexys, and the serial hash filter is not applied
+SHARD_SUBSCRIPTIONS = [topic.strip() for topic in os.environ.get('SHARD_SUBSCRIPTIONS', default='').split(',')
+                       if topic.strip()]
+if SHARD_COUNT > 1 or SHARD_SUBSCRIPTIONS:
+    SPARKPLUG_EDGE_NODE_ID = f'{SPARKPLUG_EDGE_NODE_ID}-{SHARD_INDEX}'
+# Multi-tenant mode, see pyapp/tenants.py. JSON file of the edge nodes one process hosts, each with its own
+# group/edge node id, MQTT connection and Flexy routes. SPARKPLUG_GROUP_ID/SPARKPLUG_EDGE_NODE_ID are then unused
+TENANTS_FILE = os.environ.get('TENANTS_FILE')
+SPARKPLUG_DIRECT_ENCODING = os.environ.get('SPARKPLUG_DIRECT_ENCODING', default='True') in ['True', 'true', '1']
+# Repeated Flexy tag groups ("Pump1.Speed", "Pump2.Speed"...) as Template definitions in NBIRTH and instances in
+# DBIRTH, needs the direct encoding. A group becomes a template once a Flexy has MIN_INSTANCES groups with its members
+SPARKPLUG_TEMPLATES = os.environ.get('SPARKPLUG_TEMPLATES', default='False') in ['True', 'true', '1']
+SPARKPLUG_TEMPLATE_MIN_INSTANCES = int(os.environ.get('SPARKPLUG_TEMPLATE_MIN_INSTANCES', default=2))
+
 SPARKPLUG_DEATH_TOPIC = f'spBv1.0/{SPARKPLUG_GROUP_ID}/NDEATH/{SPARKPLUG_EDGE_NODE_ID}'
 SPARKPLUG_BIRTH_TOPIC = f'spBv1.0/{SPARKPLUG_GROUP_ID}/NBIRTH/{SPARKPLUG_EDGE_NODE_ID}'
 SPARKPLUG_REBIRTH_TOPIC = f'spBv1.0/{SPARKPLUG_GROUP_ID}/NCMD/{SPARKPLUG_EDGE_NODE_ID}'
 SPARKPLUG_DCMD_PREFIX = f'spBv1.0/{SPARKPLUG_GROUP_ID}/DCMD/{SPARKPLUG_EDGE_NODE_ID}/'
 
+DDATA_COALESCE_MS = float(os.environ.get('DDATA_COALESCE_MS', default=0))  # 0 publishes one DDATA per Flexy DATA
+# Per device windows as "<flexy serial>=<ms>,<flexy serial>=<ms>", overriding DDATA_COALESCE_MS
+DDATA_COALESCE_DEVICES = {
+    serial.strip(): float(window_ms)
+    for serial, window_ms in (
+        item.split('=') for item in os.environ.get('DDATA_COALESCE_DEVICES', default='').split(',') if item.strip()
+    )
+}
+DDATA_COALESCE_MODE = os.environ.get('DDATA_COALESCE_MODE', default='latest')  # latest or samples
+
+RBE_POLICY_FILE = os.environ.get('RBE_POLICY_FILE')  # JSON deadband/interval policies, see pyapp/rbe.py
+RBE_SUPPRESS_IDENTICAL = os.environ.get('RBE_SUPPRESS_IDENTICAL', default='True') in ['True', 'true', '1']
+
+STORE_FORWARD_PATH = os.environ.get('STORE_FORWARD_PATH')  # SQLite file, unset disables store and forward
+STORE_FORWARD_MAX_MB = float(os.environ.get('STORE_FORWARD_MAX_MB', default=100))
+STORE_FORWARD_EVICTION = os.environ.get('STORE_FORWARD_EVICTION', default='drop_oldest')  # or drop_newest
+STORE_FORWARD_REPLAY_RATE = float(os.environ.get('STORE_FORWARD_REPLAY_RATE', default=100))  # messages per second
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', default=0))  # Prometheus /metrics endpoint, 0 disables it
+METRICS_NDATA_SECONDS = float(os.environ.get('METRICS_NDATA_SECONDS', default=0))  # bridge metrics in NDATA, 0 disables
+
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', default=0))  # 0 runs callbacks inline on the paho thread
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', default=10000))
+PIPELINE_OVERFLOW = os.environ.get('PIPELINE_OVERFLOW', default='block')  # block, drop_newest or drop_oldest
+PIPELINE_REPORT_SECONDS = float(os.environ.get('PIPELINE_REPORT_SECONDS', default=60))
+
+# Outbound publish scheduler, see pyapp/outbound.py. Publishes handed to paho and not yet written, 0 disables it
+OUTBOUND_WINDOW = int(os.environ.get('OUTBOUND_WINDOW', default=0))
+OUTBOUND_QUEUE_SIZE = int(os.environ.get('OUTBOUND_QUEUE_SIZE', default=10000))  # per class, DDATA and historical
+# coalesce merges a DDATA into the device's DDATA still waiting in the queue, whatever the queue length, and a full
+# queue drops its oldest message. drop_oldest and drop_newest never merge, a full queue drops the oldest/new message
+OUTBOUND_DATA_POLICY = os.environ.get('OUTBOUND_DATA_POLICY', default='coalesce')
+OUTBOUND_QOS = int(os.environ.get('OUTBOUND_QOS', default=0))
+
+# Comma separated fnmatch patterns of Sparkplug metric names DCMD may write, e.g. "*/Setpoints/*,*/Mode"
+WRITABLE_TAGS = [pattern.strip() for pattern in os.environ.get('WRITABLE_TAGS', default='').split(',')
+                 if pattern.strip()]
+
+REBIRTH_RATE = float(os.environ.get('REBIRTH_RATE', default=5))  # REBIRTH commands per second node wide, 0 unlimited
+REBIRTH_BURST = int(os.environ.get('REBIRTH_BURST', default=20))
+REBIRTH_TIMEOUT = float(os.environ.get('REBIRTH_TIMEOUT', default=60))  # seconds before resending, doubled per retry
+REBIRTH_MAX_TIMEOUT = float(os.environ.get('REBIRTH_MAX_TIMEOUT', default=900))
+REBIRTH_HOLD_DATA = os.environ.get('REBIRTH_HOLD_DATA', default='drop')  # or buffer, replayed as historical DDATA
+REBIRTH_BUFFER_SIZE = int(os.environ.get('REBIRTH_BUFFER_SIZE', default=10))  # DATA messages held per Flexy
+
+# Flexys sending their poll interval in BIRTH ("p" seconds, "h" polls between heartbeats) get a DDEATH after
+# STALE_DEVICE_FACTOR heartbeat periods without DATA, the others after STALE_DEVICE_SECONDS (0 does not watch them)
+STALE_DEVICE_FACTOR = float(os.environ.get('STALE_DEVICE_FACTOR', default=3))
+STALE_DEVICE_SECONDS = float(os.environ.get('STALE_DEVICE_SECONDS', default=0))
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')  # bdSeq + device registry for warm restarts, unset disables it
+SNAPSHOT_SECONDS = float(os.environ.get('SNAPSHOT_SECONDS', default=60))
+
+# Sampling profiler started by the "Node Control/Profile Start" NCMD, sampling every PROFILE_INTERVAL_MS while a
+# profile runs (5 is a good start). 0 (default) disables it and leaves the Profile NCMDs out of NBIRTH
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', default=0))
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', default=30))  # window when the NCMD value is 0 or true
+PROFILE_DIR = os.environ.get('PROFILE_DIR', default='/tmp')  # profile-<time>.txt files, summary + collapsed stacks
+
+# Logging, see pyapp/log.py. Entries are formatted and written by a background thread
+LOG_LEVEL = os.environ.get('LOG_LEVEL', default='INFO')  # DEBUG, INFO, WARNING or ERROR
+LOG_FORMAT = os.environ.get('LOG_FORMAT', default='text')  # or json, one object per line
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', default=10000))  # entries waiting for the writer
+# Per event limits as "<event>=<n>,...": LOG_SAMPLING keeps 1 in n, LOG_RATE_LIMITS at most n per second,
+# e.g. LOG_SAMPLING="ddata_published=100" LOG_RATE_LIMITS="unknown_alias=1"
+LOG_SAMPLING = {
+    event.strip(): int(every)
+    for event, every in (item.split('=') for item in os.environ.get('LOG_SAMPLING', default='').split(',')
+                         if item.strip())
+}
+LOG_RATE_LIMITS = {
+    event.strip(): float(rate)
+    for event, rate in (item.split('=') for item in os.environ.get('LOG_RATE_LIMITS', default='').split(',')
+                        if item.strip())
+}
+
+CAPTURE_FILE = os.environ.get('CAPTURE_FILE')  # records inbound messages for replay.py, .gz compresses
+
 MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', default=f'{SPARKPLUG_GROUP_ID}__{SPARKPLUG_EDGE_NODE_ID}')
\ No newline at end of file
@@ -0,0 +1,251 @@
+from pyapp.rbe import REPORT, DEFER
+
+
+class FlexyMetric:
+    __slots__ = ('index', 'alias', 'alias_id', 'name', 'datatype', 'value', 'timestamp', 'birth_metric', 'policy',
+                 'value_published', 'published_at', 'writable', 'instance', 'member_name')
+
+    def __init__(self, index: int, alias: str, name: str, datatype, value, timestamp: int, birth_metric=None):
+        self.index = index
+        self.alias = alias          # alias as sent by the Flexy (tag ID string)
+        self.alias_id = int(alias)  # Sparkplug alias
+        self.name = name
+        self.datatype = datatype
+        self.value = value          # already cast with datatype.cast_value
+        self.timestamp = timestamp
+        self.birth_metric = birth_metric
+        self.policy = None          # RbePolicy, None publishes every update
+        self.value_published = value
+        self.published_at = timestamp
+        self.writable = False       # DCMD writes allowed, readOnly=False in the DBIRTH
+        self.instance = None        # TemplateInstance the metric is a member of, None for plain metrics
+        self.member_name = None     # name inside the template instance
+
+
+class FlexyTopic:
+    __slots__ = ('flexy_topic', 'client_id', 'iono2x_serial', 'flexy_serial', 'cmd_topic')
+
+    def __init__(self, flexy_topic: str):
+        self.flexy_topic = flexy_topic
+        _, self.client_id, self.iono2x_serial, self.flexy_serial = flexy_topic.split('/')
+        self.cmd_topic = f'{flexy_topic}/CMD'
+
+
+class FlexyDevice:
+    __slots__ = ('flexy_topic', 'device_id', 'timestamp', 'metrics', 'aliases', 'changed', 'birth_cache',
+                 'topic', 'dbirth_topic', 'ddata_topic', 'ddeath_topic', 'coalesce_seconds', 'samples', 'flush_call',
+                 'deferred', 'periodic', 'online', 'command_index', 'stale_seconds', 'last_seen', 'liveness_call',
+                 'stale')
+
+    def __init__(self, topic: FlexyTopic, device_id: str, timestamp: int, birth_cache=None, sparkplug_node=None):
+        self.topic = topic
+        self.flexy_topic = topic.flexy_topic
+        self.device_id = device_id
+        self.timestamp = timestamp
+        self.metrics = []        # FlexyMetric records in BIRTH order
+        self.aliases = {}        # Flexy alias -> FlexyMetric
+        self.changed = set()     # indexes of metrics changed since the last DDATA/DBIRTH
+        self.birth_cache = birth_cache
+        self.coalesce_seconds = 0   # DDATA coalescing window, 0 publishes every DATA message
+        self.samples = None         # list of (metric, value, timestamp) when every sample is kept while coalescing
+        self.flush_call = None      # pending coalescing flush
+        self.deferred = set()       # indexes of metrics held back by their RBE min_interval
+        self.periodic = []          # metrics with an RBE max_interval
+        self.online = True          # False once a DDEATH was published for the device
+        self.command_index = None   # Sparkplug alias (int) and name (str) -> FlexyMetric, built by the first DCMD
+        self.stale_seconds = 0      # silence before the device gets a DDEATH, 0 does not watch it
+        self.last_seen = 0          # liveness clock time of the last BIRTH/DATA
+        self.liveness_call = None   # pending liveness check
+        self.stale = False          # DDEATH published for silence, the next DATA requests a rebirth
+        # Outbound topics are built once per device instead of on every publish
+        self.dbirth_topic = self.ddata_topic = self.ddeath_topic = None
+        if sparkplug_node is not None:
+            self.dbirth_topic = sparkplug_node.dbirth_topic(device_id)
+            self.ddata_topic = sparkplug_node.ddata_topic(device_id)
+            self.ddeath_topic = sparkplug_node.ddeath_topic(device_id)
+
+    @property
+    def cmd_topic(self) -> str:
+        return self.topic.cmd_topic
+
+    def add_metric(self, alias: str, name: str, datatype, value, timestamp: int, policy=None,
+                   writable: bool = False, template: tuple = None) -> FlexyMetric:
+        # template: (TemplateInstance, member name) when the metric is published inside a template instance
+        metric = FlexyMetric(index=len(self.metrics), alias=alias, name=name, datatype=datatype,
+                             value=value, timestamp=timestamp)
+        metric.policy = policy
+        metric.writable = writable
+        if template is not None:
+            metric.instance, metric.member_name = template
+        if policy is not None and policy.max_interval_ms:
+            self.periodic.append(metric)
+        if self.birth_cache is not None:
+            if metric.instance is not None:
+                metric.birth_metric = self.birth_cache.add_member(metric.instance, name=metric.member_name,
+                                                                  datatype=datatype, value=value, timestamp=timestamp,
+                                                                  writable=writable)
+            else:
+                metric.birth_metric = self.birth_cache.add_metric(name=name, alias=metric.alias_id, datatype=datatype,
+                                                                  value=value, timestamp=timestamp, writable=writable)
+        self.metrics.append(metric)
+        self.aliases[alias] = metric
+        return metric
+
+    def get_metric(self, alias: str) -> FlexyMetric or None:
+        return self.aliases.get(alias)
+
+    def resolve_command_metric(self, alias: int or None, name: str):
+        # Commands address metrics by Sparkplug alias or by name, the index is only built for devices that get any
+        index = self.command_index
+        if index is None:
+            index = {}
+            for metric in self.metrics:
+                index[metric.alias_id] = metric
+                index[metric.name] = metric
+                if metric.instance is not None:
+                    # A DCMD for template members addresses the instance, resolved to its members by name
+                    index[metric.instance.alias] = metric.instance
+                    index[metric.instance.name] = metric.instance
+            self.command_index = index
+        metric = index.get(alias) if alias is not None else None
+        return metric if metric is not None else index.get(name)
+
+    def update_metric(self, metric: FlexyMetric, value, timestamp: int):
+        metric.value = value
+        metric.timestamp = timestamp
+        metric.value_published = value
+        metric.published_at = timestamp
+        self.changed.add(metric.index)
+        if self.samples is not None:
+            self.samples.append((metric, value, timestamp))
+        if metric.birth_metric is not None:
+            self.birth_cache.update_metric(metric.birth_metric, metric.datatype, value, timestamp)
+
+    def ingest(self, metric: FlexyMetric, value, timestamp: int):
+        # Runs the metric's RBE policy, suppressed values are still kept so births carry the latest value
+        policy = metric.policy
+        if policy is None:
+            self.update_metric(metric, value, timestamp)
+            return
+        action = policy.check(metric, value, timestamp)
+        if action == REPORT:
+            self.deferred.discard(metric.index)
+            self.update_metric(metric, value, timestamp)
+            return
+        if action == DEFER:
+            self.deferred.add(metric.index)
+        self.store_metric(metric, value, timestamp)
+
+    def store_metric(self, metric: FlexyMetric, value, timestamp: int):
+        metric.value = value
+        metric.timestamp = timestamp
+        if metric.birth_metric is not None:
+            self.birth_cache.update_metric(metric.birth_metric, metric.datatype, value, timestamp)
+
+    def release_due(self, timestamp: int):
+        # RBE intervals are evaluated against the Flexy timestamps each time the device sends DATA
+        if self.deferred:
+            metrics = self.metrics
+            for index in [index for index in self.deferred
+                          if metrics[index].policy.min_interval_elapsed(metrics[index], timestamp)]:
+                self.deferred.discard(index)
+                metric = metrics[index]
+                self.update_metric(metric, metric.value, metric.timestamp)
+        for metric in self.periodic:
+            if metric.policy.max_interval_elapsed(metric, timestamp):
+                self.update_metric(metric, metric.value, timestamp)
+
+    def on_birth(self):
+        # The DBIRTH publishes every current value, including the ones RBE was holding back
+        self.clear_changed()
+        if self.deferred:
+            for index in self.deferred:
+                metric = self.metrics[index]
+                metric.value_published = metric.value
+            self.deferred = set()
+
+    def pop_changed(self) -> list:
+        # Changed metrics in BIRTH order, only the dirty ones are visited
+        if not self.changed:
+            return []
+        changed, self.changed = self.changed, set()
+        metrics = self.metrics
+        return [metrics[index] for index in sorted(changed)]
+
+    def pop_updates(self) -> list:
+        # (metric, value, timestamp) for the next DDATA, every sample or only the latest value per metric
+        if self.samples is not None:
+            samples, self.samples = self.samples, []
+            self.changed = set()
+            return samples
+        return [(metric, metric.value, metric.timestamp) for metric in self.pop_changed()]
+
+    def clear_changed(self):
+        self.changed = set()
+        if self.samples:
+            self.samples = []
+
+    def cancel_flush(self):
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+
+    def cancel_liveness(self):
+        if self.liveness_call is not None:
+            self.liveness_call.cancel()
+            self.liveness_call = None
+
+
+class FlexyDeviceRegistry:
+    def __init__(self):
+        self.__devices = {}       # flexy topic -> FlexyDevice, in first seen order
+        self.__by_serial = {}     # flexy serial -> FlexyDevice
+        self.__by_device_id = {}  # Sparkplug device_id -> FlexyDevice
+        self.__topics = {}        # inbound topic -> FlexyTopic
+
+    def __len__(self):
+        return len(self.__devices)
+
+    def __iter__(self):
+        return iter(self.__devices.values())
+
+    def __contains__(self, flexy_topic: str):
+        return flexy_topic in self.__devices
+
+    def parse_topic(self, topic: str) -> FlexyTopic or None:
+        parsed = self.__topics.get(topic)
+        if parsed is not None:
+            return parsed
+        topic_split = topic.split('/')
+        if len(topic_split) < 4:
+            return None
+        flexy_topic = '/'.join(topic_split[:4])
+        parsed = self.__topics.get(flexy_topic)
+        if parsed is None:
+            parsed = FlexyTopic(flexy_topic)
+            self.__topics[flexy_topic] = parsed
+        self.__topics[topic] = parsed
+        return parsed
+
+    def add(self, device: FlexyDevice):
+        previous = self.__devices.get(device.flexy_topic)
+        if previous is not None and self.__by_device_id.get(previous.device_id) is previous:
+            del self.__by_device_id[previous.device_id]
+        self.__devices[device.flexy_topic] = device
+        self.__by_serial[device.topic.flexy_serial] = device
+        self.__by_device_id[device.device_id] = device
+
+    def get(self, flexy_topic: str) -> FlexyDevice or None:
+        return self.__devices.get(flexy_topic)
+
+    def get_by_topic(self, topic: str) -> FlexyDevice or None:
+        parsed = self.parse_topic(topic)
+        if parsed is None:
+            return None
+        return self.__devices.get(parsed.flexy_topic)
+
+    def get_by_serial(self, flexy_serial: str) -> FlexyDevice or None:
+        return self.__by_serial.get(flexy_serial)
+
+    def get_by_device_id(self, device_id: str) -> FlexyDevice or None:
+        return self.__by_device_id.get(device_id)
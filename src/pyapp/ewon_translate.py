@@ -1,9 +1,31 @@
 import paho.mqtt.client as mqtt
 from pyapp.protobuf import sparkplug_b_pb2
 from pyapp import config
-from google.protobuf.json_format import ParseDict, MessageToDict
+from pyapp import metrics
+from pyapp.capture import CaptureWriter
+from pyapp.devices import FlexyDevice, FlexyDeviceRegistry, FlexyMetric, FlexyTopic
+from pyapp.log import logger
+from pyapp.outbound import OutboundMessage, OutboundScheduler
+from pyapp.outbound import PRIORITY_NODE, PRIORITY_DEVICE, PRIORITY_DATA, PRIORITY_HISTORICAL
+from pyapp.pipeline import IngestPipeline
+from pyapp.profiler import SamplingProfiler, ProfileReport
+from pyapp.rbe import RbeEngine
+from pyapp.rebirth import RebirthScheduler, rebirth_requests_counter
+from pyapp.scheduler import Scheduler, TimingWheel
+from pyapp.shard import ShardFilter
+from pyapp.snapshot import read_snapshot, write_snapshot
+from pyapp.store_forward import StoreAndForward
+from pyapp.templates import TEMPLATE_DATATYPE, TemplateInstance, TemplateRegistry
+from google.protobuf.json_format import ParseDict
+from collections import deque
 from enum import Enum
+import fnmatch
+import math
+import os
+import re
+import atexit
 import json
+import threading
 import time
 
 import logging
@@ -30,40 +52,57 @@ def str_to_bool(string) -> bool:
 
 
 class Sequencer:
+    # Thread safe, callbacks may run on the paho network thread and on pipeline workers at the same time
     def __init__(self, minimum: int = 0, maximum: int = 255, increment: int = 1, start: int = None):
         self.__min = minimum
         self.__max = maximum
         self.__current = minimum if start is None else start
         self.__increment = increment
+        self.__lock = threading.Lock()
 
     def increment(self):
-        new_val = self.__current + self.__increment
-        if new_val > self.__max:
-            new_val = self.__min
-        self.__current = new_val
+        self.next_value()
+
+    def next_value(self) -> int:
+        with self.__lock:
+            new_val = self.__current + self.__increment
+            if new_val > self.__max:
+                new_val = self.__min
+            self.__current = new_val
+            return new_val
 
     def reset(self):
-        self.__current = self.__min
+        with self.__lock:
+            self.__current = self.__min
 
     @property
     def current_value(self) -> int:
         return self.__current
 
 
-bd_seq_start = None  # Todo make this a durable value that persists across script restarts
+# Warm restart state, bdSeq continues from the last snapshot so the next NDEATH never repeats an old value
+snapshot = read_snapshot(config.SNAPSHOT_PATH) if config.SNAPSHOT_PATH else None
+bd_seq_start = (snapshot['bd_seq'] + 1) % 256 if snapshot else None
 last_bdseq = None
-bd_seq = Sequencer(start=bd_seq_start)
-sequence = Sequencer()
 
 
 class SparkplugNode:
     NAMESPACE = 'spBv1.0'
 
-    def __init__(self, group_id: str, node_id: str):
+    def __init__(self, group_id: str, node_id: str, bd_seq_start: int = None):
         self.group_id = group_id
         self.node_id = node_id
-        self.__node_topic = f'{self.NAMESPACE}/{group_id}/%%%/{node_id}'
+        # bdSeq and seq belong to the edge node, each node hosted by the process counts on its own
+        self.bd_seq = Sequencer(start=bd_seq_start)
+        self.sequence = Sequencer()
+        # Topic strings are built once here rather than on every publish
+        self.__topics = {
+            message_type: f'{self.NAMESPACE}/{group_id}/{message_type}/{node_id}'
+            for message_type in ('NBIRTH', 'NDEATH', 'NDATA', 'NCMD', 'DBIRTH', 'DDEATH', 'DDATA', 'DCMD')
+        }
         self.__birth_published = False
+        self.__node_metric_providers = []
+        self.__birth_metric_providers = []
 
     @property
     def birth_published(self) -> bool:
@@ -75,31 +114,31 @@ class SparkplugNode:
 
     @property
     def nbirth_topic(self):
-        return self.__node_topic.replace('/%%%/', '/NBIRTH/')
+        return self.__topics['NBIRTH']
 
     @property
     def ndeath_topic(self):
-        return self.__node_topic.replace('/%%%/', '/NDEATH/')
+        return self.__topics['NDEATH']
 
     @property
     def ndata_topic(self):
-        return self.__node_topic.replace('/%%%/', '/NDATA/')
+        return self.__topics['NDATA']
 
     @property
     def ncmd_topic(self):
-        return self.__node_topic.replace('/%%%/', '/NCMD/')
+        return self.__topics['NCMD']
 
     def dbirth_topic(self, device_id: str):
-        return self.__node_topic.replace('/%%%/', '/DBIRTH/') + f'/{device_id}'
+        return f"{self.__topics['DBIRTH']}/{device_id}"
 
     def ddeath_topic(self, device_id: str):
-        return self.__node_topic.replace('/%%%/', '/DDEATH/') + f'/{device_id}'
+        return f"{self.__topics['DDEATH']}/{device_id}"
 
     def ddata_topic(self, device_id: str):
-        return self.__node_topic.replace('/%%%/', '/DDATA/') + f'/{device_id}'
+        return f"{self.__topics['DDATA']}/{device_id}"
 
     def dcmd_topic(self, device_id: str):
-        return self.__node_topic.replace('/%%%/', '/DCMD/') + f'/{device_id}'
+        return f"{self.__topics['DCMD']}/{device_id}"
 
     def on_disconnect(self):
         self.__birth_published = False
@@ -112,6 +151,36 @@ class SparkplugNode:
         sp_payload = ParseDict(payload_data, sparkplug_b_pb2.Payload())
         return sp_payload.SerializeToString()
 
+    def add_node_metrics(self, provider):
+        # provider() returns metric dicts (name, datatype, value key), declared in NBIRTH and published in NDATA
+        self.__node_metric_providers.append(provider)
+
+    def add_birth_metrics(self, provider):
+        # provider(timestamp) returns Payload.Metric messages only declared in NBIRTH, e.g. Template definitions
+        self.__birth_metric_providers.append(provider)
+
+    @property
+    def has_node_metrics(self) -> bool:
+        return bool(self.__node_metric_providers)
+
+    def node_metrics(self) -> list:
+        timestamp = self.current_timestamp
+        node_metrics = []
+        for provider in self.__node_metric_providers:
+            for metric in provider():
+                node_metrics.append(dict(metric, timestamp=timestamp))
+        return node_metrics
+
+    def ndata_payload(self, seq: int or None, node_metrics: list = None):
+        # node_metrics publishes these metric dicts instead of the providers' ones
+        if node_metrics is not None:
+            node_metrics = [dict(metric, timestamp=self.current_timestamp) for metric in node_metrics]
+        payload_data = {'timestamp': self.current_timestamp,
+                        'metrics': self.node_metrics() if node_metrics is None else node_metrics}
+        if seq is not None:
+            payload_data['seq'] = seq
+        return self.payload_dict_to_bytes(payload_data)
+
     def nbirth_payload(self, bdseq: int):
         payload_data = {
             'seq': 0,
@@ -135,9 +204,14 @@ class SparkplugNode:
                     'datatype': 11,
                     'boolean_value': True
                 }
-            ]
+            ] + self.node_metrics()
         }
-        return self.payload_dict_to_bytes(payload_data)
+        if not self.__birth_metric_providers:
+            return self.payload_dict_to_bytes(payload_data)
+        sp_payload = ParseDict(payload_data, sparkplug_b_pb2.Payload())
+        for provider in self.__birth_metric_providers:
+            sp_payload.metrics.extend(provider(payload_data['timestamp']))
+        return sp_payload.SerializeToString()
 
     def ndeath_payload(self, bdseq: int):
         payload_data = {
@@ -171,33 +245,242 @@ class FlexyDataTypes(Enum):
     def cast_value(self, value):
         return self.value['cast_fn'](value)
 
+    def sparkplug_value(self, value):
+        # long_value is unsigned, negative Int64 values go out as two's complement
+        return value & 0xFFFFFFFFFFFFFFFF if self is FlexyDataTypes.integer else value
+
+
+def _make_birth_properties(read_only: bool = True) -> sparkplug_b_pb2.Payload.PropertySet:
+    properties = sparkplug_b_pb2.Payload.PropertySet()
+    properties.keys.extend(['Quality', 'readOnly'])
+    quality = properties.values.add()
+    quality.type = 3
+    quality.int_value = 192
+    read_only_value = properties.values.add()
+    read_only_value.type = 11
+    read_only_value.boolean_value = read_only
+    return properties
+
+
+BIRTH_PROPERTIES = _make_birth_properties()
+WRITABLE_BIRTH_PROPERTIES = _make_birth_properties(read_only=False)
+
+
+def encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_seq(seq: int) -> bytes:
+    # seq is the last field written by SerializeToString, so it can be appended to an already encoded payload
+    return b'\x18' + encode_varint(seq)
+
+
+class DeviceBirthCache:
+    def __init__(self):
+        self.__payload = sparkplug_b_pb2.Payload()
+        self.__metrics_bytes = None
+        self.__instances = {}  # TemplateInstance -> its Template metric
+
+    def add_metric(self, name: str, alias: int, datatype: FlexyDataTypes, value, timestamp: int,
+                   writable: bool = False):
+        metric = self.__payload.metrics.add()
+        metric.name = name
+        metric.alias = alias
+        metric.datatype = datatype.sparkplug_code
+        metric.properties.CopyFrom(WRITABLE_BIRTH_PROPERTIES if writable else BIRTH_PROPERTIES)
+        self.update_metric(metric, datatype, value, timestamp)
+        return metric
+
+    def add_member(self, instance, name: str, datatype: FlexyDataTypes, value, timestamp: int,
+                   writable: bool = False):
+        # The Template metric of the instance is added with its first member, at that member's position
+        instance_metric = self.__instances.get(instance)
+        if instance_metric is None:
+            instance_metric = self.__payload.metrics.add()
+            instance_metric.name = instance.name
+            instance_metric.alias = instance.alias
+            instance_metric.timestamp = timestamp
+            instance_metric.datatype = TEMPLATE_DATATYPE
+            instance_metric.template_value.template_ref = instance.template.name
+            instance_metric.template_value.is_definition = False
+            self.__instances[instance] = instance_metric
+        metric = instance_metric.template_value.metrics.add()
+        metric.name = name
+        metric.datatype = datatype.sparkplug_code
+        if writable:
+            # readOnly=True comes from the definition
+            metric.properties.CopyFrom(WRITABLE_BIRTH_PROPERTIES)
+        self.update_metric(metric, datatype, value, timestamp)
+        return metric
+
+    def update_metric(self, metric, datatype: FlexyDataTypes, value, timestamp: int):
+        metric.timestamp = timestamp
+        setattr(metric, datatype.sparkplug_value_key, datatype.sparkplug_value(value))
+        self.__metrics_bytes = None
+
+    def encode(self, timestamp: int, rebirth_timestamp: int, seq: int or None) -> bytes:
+        if self.__metrics_bytes is None:
+            self.__metrics_bytes = self.__payload.SerializeToString()
+        header = sparkplug_b_pb2.Payload()
+        header.timestamp = timestamp
+        rebirth_metric = header.metrics.add()
+        rebirth_metric.timestamp = rebirth_timestamp
+        rebirth_metric.name = 'Device Control/Rebirth'
+        rebirth_metric.datatype = 11
+        rebirth_metric.boolean_value = False
+        payload = header.SerializeToString() + self.__metrics_bytes
+        return payload + encode_seq(seq) if seq is not None else payload
+
+
+DECODE_SECONDS = metrics.registry.histogram('flexy_bridge_stage_seconds', 'Time spent per stage', stage='decode')
+ENCODE_SECONDS = metrics.registry.histogram('flexy_bridge_stage_seconds', 'Time spent per stage', stage='encode')
+PUBLISH_SECONDS = metrics.registry.histogram('flexy_bridge_stage_seconds', 'Time spent per stage', stage='publish')
+DCMD_WRITES = metrics.registry.counter('flexy_bridge_dcmd_writes_total', 'Tag writes forwarded to Flexys')
+DCMD_REJECTED = metrics.registry.counter('flexy_bridge_dcmd_rejected_total',
+                                         'DCMD metrics for unknown, read only or non numeric tags')
+UNKNOWN_ALIASES = metrics.registry.counter('flexy_bridge_unknown_alias_total', 'DATA with an alias missing from BIRTH')
+INVALID_VALUES = metrics.registry.counter('flexy_bridge_invalid_values_total',
+                                          'DATA/DATA2 values that do not cast to the BIRTH datatype, skipped')
+DDATA_PUBLISHED = metrics.registry.counter('flexy_bridge_published_total', 'Sparkplug messages published',
+                                           message_type='DDATA')
+DBIRTH_PUBLISHED = metrics.registry.counter('flexy_bridge_published_total', 'Sparkplug messages published',
+                                            message_type='DBIRTH')
+DDEATH_PUBLISHED = metrics.registry.counter('flexy_bridge_published_total', 'Sparkplug messages published',
+                                            message_type='DDEATH')
+DDATA_STORED = metrics.registry.counter('flexy_bridge_ddata_stored_total',
+                                        'DDATA kept in store and forward instead of published')
+DDATA_DROPPED = metrics.registry.counter('flexy_bridge_ddata_dropped_total',
+                                         'DDATA neither published nor stored (store full or disabled)')
+# What became of the changed values of a device, see _publish_ddata()
+PUBLISHED, STORED, DROPPED = 'published', 'stored', 'dropped'
+# Sparkplug Int8..Int64 datatype codes and their width, hosts send them as two's complement in int/long_value
+SIGNED_INT_BITS = {1: 8, 2: 16, 3: 32, 4: 64}
+PROFILE_START = 'Node Control/Profile Start'  # seconds to sample, 0 or true for the default window
+PROFILE_STOP = 'Node Control/Profile Stop'
+PROFILE_MAX_SECONDS = 3600
+STALE_DEVICES = metrics.registry.counter('flexy_bridge_stale_devices_total', 'DDEATHs for Flexys that went silent')
+
 
 class FlexyTranslatorNode:
-    def __init__(self, sparkplug_node: SparkplugNode):
-        self.__flexy_devices = dict()
+    def __init__(self, sparkplug_node: SparkplugNode, direct_encoding: bool = True, coalesce_ms: float = 0,
+                 coalesce_devices: dict = None, coalesce_samples: bool = False, scheduler: Scheduler = None,
+                 rbe: RbeEngine = None, store: StoreAndForward = None, replay_rate: float = 100,
+                 rebirths: RebirthScheduler = None, writable_tags: list = None,
+                 outbound: OutboundScheduler = None, templates: TemplateRegistry = None,
+                 stale_factor: float = 0, stale_seconds: float = 0, profiler: SamplingProfiler = None,
+                 profile_dir: str = '.', profile_seconds: float = 30, profile_top: int = 5,
+                 metric_labels: dict = None, clock=time.monotonic):
+        self.__flexy_devices = FlexyDeviceRegistry()
         self.__flexy_data_types = {e.name: e for e in FlexyDataTypes}
         self.__sparkplug_node = sparkplug_node
-        self.__payload_queue = []
+        # Guards device state, seq assignment and publishing so seq values reach the broker in order
+        self.__lock = threading.RLock()
+        # Extra labels on the gauges, e.g. edge_node when the process hosts several nodes.
+        # The gauges run on the metrics HTTP thread, self.devices copies the registry under the lock
+        metric_labels = metric_labels or {}
+        metrics.registry.gauge('flexy_bridge_devices', 'Flexy devices known to the bridge',
+                               fn=lambda: len(self.__flexy_devices), **metric_labels)
+        metrics.registry.gauge('flexy_bridge_devices_online', 'Flexy devices without a DDEATH',
+                               fn=lambda: sum(1 for device in self.devices if device.online), **metric_labels)
+        metrics.registry.gauge('flexy_bridge_device_metrics', 'Metrics per Flexy device', label='device_id',
+                               fn=lambda: {device.device_id: len(device.metrics) for device in self.devices},
+                               **metric_labels)
+        # False falls back to building dicts and running them through ParseDict, kept for A/B comparison
+        self.__direct_encoding = direct_encoding
+        # DDATA coalescing window in ms, node wide default and per Flexy serial overrides
+        self.__coalesce_ms = coalesce_ms
+        self.__coalesce_devices = coalesce_devices or {}
+        self.__coalesce_samples = coalesce_samples
+        self.__scheduler = scheduler
+        # Report by exception policies, None publishes every value the Flexy sends
+        self.__rbe = rbe
+        # Store and forward buffer for DDATA produced while the Sparkplug session is down,
+        # replayed in batches of replay_batch messages at replay_rate messages per second
+        self.__store = store
+        self.__replay_call = None
+        self.__replay_batch = max(1, int(replay_rate / 10))
+        self.__replay_interval = self.__replay_batch / replay_rate
+        if self.__scheduler is None:
+            # The thread only starts with the first scheduled call
+            self.__scheduler = Scheduler(name='translator')
+        # Deduplicates, rate limits and retries the REBIRTH commands sent to the Flexys
+        self.__rebirths = rebirths if rebirths is not None else RebirthScheduler(self.__scheduler)
+        # Sparkplug name patterns (fnmatch) of the tags DCMD may write, everything else stays readOnly
+        self.__writable = re.compile('|'.join(fnmatch.translate(pattern) for pattern in writable_tags)).match \
+            if writable_tags else None
+        # Prioritised publishing with an in-flight window, None publishes straight to the client
+        self.__outbound = outbound
+        if outbound is not None and outbound.on_failed is None:
+            outbound.on_failed = self.on_outbound_failed
+        # Repeated tag groups published as Sparkplug Templates, built on the birth cache of the direct encoding
+        self.__templates = templates if direct_encoding else None
+        if self.__templates is not None:
+            sparkplug_node.add_birth_metrics(self.__templates.birth_metrics)
+        elif templates is not None:
+            logger.warning('templates_disabled', 'SPARKPLUG TEMPLATES NEED THE DIRECT ENCODING, DISABLED')
+        # Liveness: a device is DDEATHed after stale_factor heartbeat periods (from its BIRTH) without DATA,
+        # or stale_seconds for devices that do not send one. One wheel timer per device, DATA only stamps last_seen.
+        # clock is the wheel's, the scheduler advances it every tick
+        self.__stale_factor = stale_factor
+        self.__stale_seconds = stale_seconds
+        self.__liveness = TimingWheel(tick=1, clock=clock)
+        self.__liveness_call = None
+        metrics.registry.gauge('flexy_bridge_liveness_timers', 'Pending device liveness checks',
+                               fn=lambda: len(self.__liveness), **metric_labels)
+        # Sampling profiler started and stopped through NCMD, results go to profile_dir and NDATA
+        self.__profiler = profiler
+        self.__profile_dir = profile_dir
+        self.__profile_seconds = profile_seconds
+        self.__profile_top = profile_top
+        self.__profile_call = None
+        if profiler is not None:
+            sparkplug_node.add_birth_metrics(self._profiler_birth_metrics)
+
+    @property
+    def direct_encoding(self) -> bool:
+        return self.__direct_encoding
+
+    def message_callbacks(self) -> list:
+        # (subscription, callback name, handler) for every inbound message type
+        return [
+            ('flexy_v1.0/+/+/+/STATE', 'flexy_state', self.process_flexy_state_message),
+            ('flexy_v1.0/+/+/+/DATA', 'flexy_data', self.process_flexy_data_message),
+            ('flexy_v1.0/+/+/+/DATA2', 'flexy_data2', self.process_flexy_data2_message),
+            ('flexy_v1.0/+/+/+/BIRTH', 'flexy_birth', self.process_flexy_birth_message),
+            ('spBv1.0/+/NCMD/+', 'ncmd', self.process_ncmd_message),
+            ('spBv1.0/+/DCMD/+/+', 'dcmd', self.process_dcmd_message),
+        ]
 
     @staticmethod
     def decode_flexy_payload(payload: bytes or str) -> dict or None:
+        started = time.perf_counter()
         try:
             decoded = json.loads(payload)
             return decoded
         except json.JSONDecodeError as err:
-            print(err)
+            logger.warning('invalid_payload', 'INVALID FLEXY PAYLOAD: %s', err)
+        finally:
+            DECODE_SECONDS.time(started)
         return None
 
     @staticmethod
-    def flexy_metric_to_sparkplug_metric(metric: dict, birth: bool = False):
-        pass
+    def _cast_value(metric: FlexyMetric, value, flexy_topic: str):
+        # None for a value that does not fit the BIRTH datatype, the metric is skipped and the rest still goes out
+        try:
+            return metric.datatype.cast_value(value)
+        except (TypeError, ValueError, OverflowError) as err:
+            INVALID_VALUES.inc()
+            logger.warning('invalid_value', 'INVALID VALUE FOR %s, SKIPPED: %s', metric.name, err, flexy=flexy_topic)
+        return None
 
-    @staticmethod
-    def _trim_topic(topic: str):
-        topic_split = topic.split('/')
-        if not topic_split or len(topic_split) < 4:
-            return None
-        return '/'.join(topic_split[:4])
+    def _request_rebirth(self, client, flexy_topic: FlexyTopic, reason: str, message=None) -> bool:
+        # message is the DATA that triggered the request, held until the BIRTH arrives
+        return self.__rebirths.request(client, flexy_topic, reason, message)
 
     def get_data_type(self, data_type: str) -> FlexyDataTypes:
         if data_type in self.__flexy_data_types:
@@ -205,19 +488,21 @@ class FlexyTranslatorNode:
         return FlexyDataTypes.string
 
     def get_flexy_device(self, topic: str):
-        return self.__flexy_devices.get(self._trim_topic(topic))
+        return self.__flexy_devices.get_by_topic(topic)
 
     def get_flexy_device_by_id(self, device_id: str):
-        for data in self.__flexy_devices.values():
-            if data['device_id'] == device_id:
-                return data
+        return self.__flexy_devices.get_by_device_id(device_id)
 
-    def _make_sparkplug_payload(self, topic: str, seq: int, is_birth: bool = False) -> bytes or None:
-        if not topic:
-            return
-        device_data = self.get_flexy_device(topic)
-        if not device_data:
+    def get_flexy_device_by_serial(self, flexy_serial: str):
+        return self.__flexy_devices.get_by_serial(flexy_serial)
+
+    def _make_sparkplug_payload(self, device: FlexyDevice, seq: int or None, is_birth: bool = False,
+                                is_historical: bool = False) -> bytes or None:
+        # seq=None leaves the seq field out, encode_seq() can append it later
+        if not device:
             return
+        if self.__direct_encoding:
+            return self._encode_sparkplug_payload(device, seq=seq, is_birth=is_birth, is_historical=is_historical)
 
         metrics = []
         if is_birth:
@@ -227,15 +512,14 @@ class FlexyTranslatorNode:
                 'datatype': 11,
                 'boolean_value': False
             })
-        for metric_data in device_data['metrics'].values():
-            metric_datatype: FlexyDataTypes = metric_data['datatype']
-            if is_birth:
+            for metric_data in device.metrics:
+                metric_datatype: FlexyDataTypes = metric_data.datatype
                 metrics.append({
-                    'timestamp': metric_data['timestamp'],
-                    'name': metric_data['name'],
-                    'alias': metric_data['alias'],
+                    'timestamp': metric_data.timestamp,
+                    'name': metric_data.name,
+                    'alias': metric_data.alias,
                     'datatype': metric_datatype.sparkplug_code,
-                    metric_datatype.sparkplug_value_key: metric_datatype.cast_value(metric_data['value']),
+                    metric_datatype.sparkplug_value_key: metric_datatype.sparkplug_value(metric_data.value),
                     'properties': {
                         'keys': [
                             'Quality',
@@ -248,72 +532,180 @@ class FlexyTranslatorNode:
                             },
                             {
                                 'type': 11,
-                                'booleanValue': True
+                                'booleanValue': not metric_data.writable
                             }
                         ]
                     }
                 })
-                metric_data['value_changed'] = False
-                continue
-            if not metric_data['value_changed']:
-                continue
-            metrics.append({
-                'timestamp': metric_data['timestamp'],
-                'alias': metric_data['alias'],
-                'datatype': metric_datatype.sparkplug_code,
-                metric_datatype.sparkplug_value_key: metric_datatype.cast_value(metric_data['value'])
-            })
-            metric_data['value_changed'] = False
+            device.on_birth()
+        else:
+            for metric_data, value, timestamp in device.pop_updates():
+                metric_datatype: FlexyDataTypes = metric_data.datatype
+                metrics.append({
+                    'timestamp': timestamp,
+                    'alias': metric_data.alias,
+                    'datatype': metric_datatype.sparkplug_code,
+                    metric_datatype.sparkplug_value_key: metric_datatype.sparkplug_value(value)
+                })
+                if is_historical:
+                    metrics[-1]['is_historical'] = True
 
         payload = dict(
             metrics=metrics,
-            timestamp=millis(),
-            seq=seq
+            timestamp=millis()
         )
+        if seq is not None:
+            payload['seq'] = seq
         return self.__sparkplug_node.payload_dict_to_bytes(payload)
 
+    def _encode_sparkplug_payload(self, device: FlexyDevice, seq: int or None, is_birth: bool = False,
+                                  is_historical: bool = False) -> bytes:
+        # Fills the protobuf fields directly, output is byte-identical to the ParseDict path above
+        if is_birth:
+            rebirth_timestamp = self.__sparkplug_node.current_timestamp
+            device.on_birth()
+            return device.birth_cache.encode(timestamp=millis(), rebirth_timestamp=rebirth_timestamp, seq=seq)
+
+        return self._encode_ddata(device.pop_updates(), seq=seq, is_historical=is_historical)
+
+    @staticmethod
+    def _encode_ddata(updates: list, seq: int or None, is_historical: bool = False) -> bytes:
+        # updates: (FlexyMetric, value, timestamp) tuples
+        sp_payload = sparkplug_b_pb2.Payload()
+        sp_metrics = sp_payload.metrics
+        instances = None
+        for metric_data, value, timestamp in updates:
+            if metric_data.instance is not None:
+                # Template members go out as a Template metric of the instance carrying the changed members only
+                if instances is None:
+                    instances = {}
+                instance_metric = instances.get(metric_data.instance)
+                if instance_metric is None:
+                    instance_metric = sp_metrics.add()
+                    instance_metric.timestamp = timestamp
+                    instance_metric.alias = metric_data.instance.alias
+                    instance_metric.datatype = TEMPLATE_DATATYPE
+                    instance_metric.template_value.template_ref = metric_data.instance.template.name
+                    if is_historical:
+                        instance_metric.is_historical = True
+                    instances[metric_data.instance] = instance_metric
+                metric = instance_metric.template_value.metrics.add()
+                metric.timestamp = timestamp
+                metric.name = metric_data.member_name
+                metric.datatype = metric_data.datatype.sparkplug_code
+                setattr(metric, metric_data.datatype.sparkplug_value_key, metric_data.datatype.sparkplug_value(value))
+                continue
+            metric = sp_metrics.add()
+            metric.timestamp = timestamp
+            metric.alias = metric_data.alias_id
+            metric.datatype = metric_data.datatype.sparkplug_code
+            setattr(metric, metric_data.datatype.sparkplug_value_key, metric_data.datatype.sparkplug_value(value))
+            if is_historical:
+                metric.is_historical = True
+
+        sp_payload.timestamp = millis()
+        if seq is not None:
+            sp_payload.seq = seq
+        return sp_payload.SerializeToString()
+
     def process_flexy_birth_message(self, client, userdata, message):
         payload_data = self.decode_flexy_payload(message.payload)
         if not payload_data:
             return
 
-        flexy_topic = self._trim_topic(message.topic)
-        _, client_id, iono2x_serial, flexy_serial = flexy_topic.split('/')
-
-        if flexy_topic not in self.__flexy_devices.keys():
-            dcmd_topic = self.__sparkplug_node.dcmd_topic(flexy_serial)
-            print(f'Subscribe to topic: "{dcmd_topic}"')
+        with self.__lock:
+            self._add_flexy_device(client, message.topic, payload_data)
+            self.publish_birth(client, self.__sparkplug_node.bd_seq.current_value)
+            device = self.__flexy_devices.get_by_topic(message.topic)
+            for held in self.__rebirths.on_birth(device.flexy_topic):
+                self._publish_held_data(client, device, held)
+
+    def _add_flexy_device(self, client, topic: str, payload_data: dict):
+        flexy_topic = self.__flexy_devices.parse_topic(topic)
+        if flexy_topic.flexy_topic not in self.__flexy_devices:
+            dcmd_topic = self.__sparkplug_node.dcmd_topic(flexy_topic.flexy_serial)
+            logger.info('dcmd_subscribe', 'Subscribe to topic: "%s"', dcmd_topic)
             client.subscribe(dcmd_topic)
 
-        device_dict = {}
-
         timestamp = payload_data['t'] * 1000
+        name_prefix = f'{flexy_topic.client_id}/{flexy_topic.iono2x_serial}/'
+        metrics = []
         for metric_dict in payload_data['m']:
-            alias = metric_dict['a']
-            device_dict[alias] = dict(
-                datatype=self.get_data_type(metric_dict['t']),
-                name=f'{client_id}/{iono2x_serial}/' + metric_dict['n'].replace('.', '/'),
-                value_previous=None,
-                value_changed=False,
-                value=metric_dict['v'],
-                timestamp=timestamp,
-                alias=alias
-            )
-
-        self.__flexy_devices[flexy_topic] = dict(metrics=device_dict,
-                                                 timestamp=timestamp,
-                                                 device_id=flexy_serial,
-                                                 flexy_topic=flexy_topic)
-
-        self.publish_birth(client, bd_seq.current_value)
+            datatype = self.get_data_type(metric_dict['t'])
+            metrics.append((metric_dict['a'], name_prefix + metric_dict['n'].replace('.', '/'), datatype,
+                            datatype.cast_value(metric_dict['v']), timestamp))
+        # "p" poll seconds and "h" polls per heartbeat, see program.bas
+        stale_seconds = self.__stale_seconds
+        if self.__stale_factor and payload_data.get('p'):
+            stale_seconds = self.__stale_factor * payload_data['p'] * payload_data.get('h', 1)
+        self._build_flexy_device(flexy_topic, timestamp, metrics, stale_seconds)
+
+    def _build_flexy_device(self, flexy_topic: FlexyTopic, timestamp: int, metrics: list,
+                            stale_seconds: float = 0) -> FlexyDevice:
+        # metrics: (alias, Sparkplug name, FlexyDataTypes, cast value, timestamp) in BIRTH order
+        # Static part of the DBIRTH (names, aliases, datatypes, properties) is only encoded here
+        device = FlexyDevice(topic=flexy_topic, device_id=flexy_topic.flexy_serial, timestamp=timestamp,
+                             birth_cache=DeviceBirthCache() if self.__direct_encoding else None,
+                             sparkplug_node=self.__sparkplug_node)
+        templated = {}
+        if self.__templates is not None:
+            templated = self.__templates.assign(f'{flexy_topic.client_id}/{flexy_topic.iono2x_serial}/', metrics)
+        for alias, name, datatype, value, metric_timestamp in metrics:
+            device.add_metric(alias=alias,
+                              name=name,
+                              datatype=datatype,
+                              value=value,
+                              timestamp=metric_timestamp,
+                              policy=self.__rbe.policy_for(name) if self.__rbe is not None else None,
+                              writable=self.__writable is not None and self.__writable(name) is not None,
+                              template=templated.get(name))
+
+        device.stale_seconds = stale_seconds
+        device.last_seen = self.__liveness.now()
+
+        coalesce_ms = self.__coalesce_devices.get(flexy_topic.flexy_serial, self.__coalesce_ms)
+        if coalesce_ms:
+            device.coalesce_seconds = coalesce_ms / 1000
+            if self.__coalesce_samples:
+                device.samples = []
+        previous = self.__flexy_devices.get(flexy_topic.flexy_topic)
+        if previous is not None:
+            previous.cancel_flush()
+            previous.cancel_liveness()
+        self.__flexy_devices.add(device)
+        return device
+
+    def snapshot_state(self) -> dict:
+        # Registry contents for a warm restart, values are the latest ones the Flexy sent
+        with self.__lock:
+            return dict(devices=[dict(topic=device.flexy_topic, t=device.timestamp, s=device.stale_seconds,
+                                      m=[[metric.alias, metric.name, metric.datatype.name, metric.value,
+                                          metric.timestamp] for metric in device.metrics])
+                                 for device in self.__flexy_devices])
+
+    def restore_state(self, state: dict) -> int:
+        # Rebuilds the registry from snapshot_state() output, the devices are announced by the next publish_birth
+        with self.__lock:
+            for device_state in state.get('devices', []):
+                flexy_topic = self.__flexy_devices.parse_topic(device_state['topic'])
+                metrics = []
+                for alias, name, datatype_name, value, timestamp in device_state['m']:
+                    datatype = self.get_data_type(datatype_name)
+                    metrics.append((alias, name, datatype, value, timestamp))
+                self._build_flexy_device(flexy_topic, device_state['t'], metrics, device_state.get('s', 0))
+        return len(self.__flexy_devices)
 
     def process_flexy_data_message(self, client, userdata, message):
-        topic = self._trim_topic(message.topic)
-        _, client_id, iono2x_serial, flexy_serial = topic.split('/')
-        device_data = self.get_flexy_device(topic)
-        if not device_data:
-            print(f'DATA FROM UNCACHED DEVICE RECEIVED')
-            client.publish(f'{topic}/CMD', b'REBIRTH')
+        flexy_topic = self.__flexy_devices.parse_topic(message.topic)
+        device = self.__flexy_devices.get(flexy_topic.flexy_topic)
+        if not device:
+            if self._request_rebirth(client, flexy_topic, 'uncached_device', message):
+                logger.info('uncached_device', 'DATA FROM UNCACHED DEVICE RECEIVED', flexy=flexy_topic.flexy_topic)
+            return
+        if self.__rebirths.hold(flexy_topic.flexy_topic, message):
+            # The cached aliases are known to be stale, wait for the BIRTH
+            return
+        if not self._device_seen(client, device, message):
             return
 
         payload_data = self.decode_flexy_payload(message.payload)
@@ -321,86 +713,463 @@ class FlexyTranslatorNode:
             return
 
         timestamp = payload_data['t'] * 1000
-        for data in payload_data['m']:
-            if data['a'] not in device_data['metrics']:
-                print(f'Unknown alias received, request rebirth')
-                client.publish(f'{topic}/CMD', b'REBIRTH')
+        with self.__lock:
+            for data in payload_data['m']:
+                metric = device.get_metric(data['a'])
+                if metric is None:
+                    logger.info('unknown_alias', 'Unknown alias received, request rebirth', alias=data['a'],
+                                flexy=flexy_topic.flexy_topic)
+                    UNKNOWN_ALIASES.inc()
+                    self._request_rebirth(client, flexy_topic, 'unknown_alias', message)
+                    return
+                value = self._cast_value(metric, data['v'], flexy_topic.flexy_topic)
+                if value is not None:
+                    device.ingest(metric, value, timestamp)
+            outcome = self._publish_ingested(client, device, timestamp)
+
+        self._log_ddata(outcome, 'process_flexy_data_message()', device, t=timestamp)
+
+    @staticmethod
+    def decode_flexy_data2(payload: bytes or str) -> tuple or None:
+        # DATA2 is "<t>;<tag count>;<index>,<value>;<index>,<value>..." with 1 based indexes into the BIRTH
+        # metric list, see RBE2() in program.bas. Returns (t, tag count, [index, ...], [value string, ...])
+        started = time.perf_counter()
+        try:
+            if isinstance(payload, bytes):
+                payload = payload.decode()
+            # Split once on both separators and convert the index column in one pass
+            fields = payload.replace(',', ';').split(';')
+            tag_count = int(fields[1])
+            indexes = list(map(int, fields[2::2]))
+            values = fields[3::2]
+            if len(indexes) != len(values):
+                raise ValueError('index without a value')
+            if indexes and (min(indexes) < 1 or max(indexes) > tag_count):
+                raise ValueError(f'index outside of 1..{tag_count}')
+            return int(fields[0]), tag_count, indexes, values
+        except (ValueError, IndexError) as err:
+            logger.warning('invalid_payload', 'INVALID DATA2 PAYLOAD: %s', err)
+        finally:
+            DECODE_SECONDS.time(started)
+        return None
+
+    def process_flexy_data2_message(self, client, userdata, message):
+        flexy_topic = self.__flexy_devices.parse_topic(message.topic)
+        device = self.__flexy_devices.get(flexy_topic.flexy_topic)
+        if not device:
+            if self._request_rebirth(client, flexy_topic, 'uncached_device', message):
+                logger.info('uncached_device', 'DATA2 FROM UNCACHED DEVICE RECEIVED', flexy=flexy_topic.flexy_topic)
+            return
+        if self.__rebirths.hold(flexy_topic.flexy_topic, message):
+            return
+        if not self._device_seen(client, device, message):
+            return
+
+        decoded = self.decode_flexy_data2(message.payload)
+        if not decoded:
+            return
+        timestamp, tag_count, indexes, values = decoded
+        metrics = device.metrics
+        if tag_count != len(metrics):
+            # Positions are only meaningful against the same tag list the BIRTH was built from
+            logger.info('tag_count', 'DATA2 TAG COUNT %s DOES NOT MATCH BIRTH (%s), request rebirth', tag_count,
+                        len(metrics), flexy=flexy_topic.flexy_topic)
+            self._request_rebirth(client, flexy_topic, 'tag_count', message)
+            return
+
+        timestamp *= 1000
+        with self.__lock:
+            ingest = device.ingest
+            for index, value in zip(indexes, values):
+                metric = metrics[index - 1]
+                value = self._cast_value(metric, value, flexy_topic.flexy_topic)
+                if value is not None:
+                    ingest(metric, value, timestamp)
+            outcome = self._publish_ingested(client, device, timestamp)
+
+        self._log_ddata(outcome, 'process_flexy_data2_message()', device, t=timestamp)
+
+    def _device_seen(self, client, device: FlexyDevice, message) -> bool:
+        # Any DATA/DATA2, heartbeats included, keeps the device alive. After a stale DDEATH the device needs
+        # a new BIRTH, False means its data waits for it
+        device.last_seen = self.__liveness.now()
+        if device.stale:
+            self._request_rebirth(client, device.topic, 'stale_device', message)
+            return False
+        return True
+
+    def _watch_device(self, client, device: FlexyDevice, delay: float):
+        device.liveness_call = self.__liveness.call_later(delay, self.check_liveness, client, device)
+        if self.__liveness_call is None:
+            self.__liveness_call = self.__scheduler.call_every(self.__liveness.tick, self.__liveness.advance)
+
+    def check_liveness(self, client, device: FlexyDevice):
+        with self.__lock:
+            device.liveness_call = None
+            if self.__flexy_devices.get(device.flexy_topic) is not device or not device.online:
                 return
-            device_data["metrics"][data["a"]]['value_previous'] = device_data["metrics"][data["a"]]['value']
-            device_data["metrics"][data["a"]]['value'] = data['v']
-            device_data["metrics"][data["a"]]['value_changed'] = True
-            device_data["metrics"][data["a"]]['timestamp'] = timestamp
+            silent = self.__liveness.now() - device.last_seen
+            if silent < device.stale_seconds:
+                # Seen since the check was armed, the timer is only moved when it comes due
+                self._watch_device(client, device, device.stale_seconds - silent)
+                return
+            device.stale = True
+            self._publish_ddeath(client, device)
+            STALE_DEVICES.inc()
+        logger.warning('stale_device', 'NO DATA FROM %s FOR %.0fs, DDEATH PUBLISHED', device.flexy_topic, silent)
+
+    def _publish_ddeath(self, client, device: FlexyDevice):
+        # Pending coalesced data goes out before the device is declared dead
+        device.cancel_flush()
+        device.cancel_liveness()
+        self.__rebirths.cancel(device.flexy_topic)
+        self._publish_ddata(client, device)
+        ddeath_payload = {
+            'timestamp': self.__sparkplug_node.current_timestamp
+        }
+        payload_bytes = self.__sparkplug_node.payload_dict_to_bytes(ddeath_payload)
+        self._send(client, device.ddeath_topic, payload_bytes, PRIORITY_DEVICE, device=device)
+        device.online = False
+        DDEATH_PUBLISHED.inc()
+
+    def _publish_ingested(self, client, device: FlexyDevice, timestamp: int) -> str or None:
+        # Runs after a DATA/DATA2 message was ingested, the _publish_ddata() outcome when it ran straight away
+        if device.deferred or device.periodic:
+            device.release_due(timestamp)
+
+        if device.coalesce_seconds:
+            # Merged with the following DATA messages into one DDATA when the window closes
+            if device.flush_call is None and device.changed:
+                device.flush_call = self.__scheduler.call_later(device.coalesce_seconds,
+                                                                self.flush_device, client, device)
+            return None
+        return self._publish_ddata(client, device)
 
-        sequence.increment()
-        payload = self._make_sparkplug_payload(topic=topic, is_birth=False, seq=sequence.current_value)
+    def _session_online(self, client) -> bool:
+        return self.__sparkplug_node.birth_published and client.is_connected()
 
-        client.publish(self.__sparkplug_node.ddata_topic(flexy_serial), payload)
+    def _publish_ddata(self, client, device: FlexyDevice) -> str or None:
+        # PUBLISHED (handed to paho or the outbound scheduler), STORED for replay, DROPPED, None if nothing changed
+        if not device.changed:
+            return None
+        if self.__store is not None and not self._session_online(client):
+            # Kept as historical data and replayed once the NBIRTH/DBIRTH(s) are out again
+            payload = self._make_sparkplug_payload(device, is_birth=False, seq=None, is_historical=True)
+            return self._store_ddata(device.ddata_topic, payload)
+        started = time.perf_counter()
+        payload = self._make_sparkplug_payload(device, is_birth=False, seq=None)
+        published = time.perf_counter()
+        ENCODE_SECONDS.observe(published - started)
+        sent = self._send(client, device.ddata_topic, payload, PRIORITY_DATA, device=device)
+        PUBLISH_SECONDS.time(published)
+        if sent:
+            DDATA_PUBLISHED.inc()
+            return PUBLISHED
+        if self.__store is not None:
+            return self._store_ddata(device.ddata_topic, self._to_historical(payload))
+        DDATA_DROPPED.inc()
+        logger.warning('ddata_dropped', 'DDATA PUBLISH FAILED, DROPPED: %s', device.ddata_topic)
+        return DROPPED
+
+    def _store_ddata(self, topic: str, payload: bytes) -> str:
+        if self.__store.store(topic, payload):
+            DDATA_STORED.inc()
+            return STORED
+        DDATA_DROPPED.inc()
+        logger.warning('store_full', 'STORE AND FORWARD FULL, DDATA DROPPED: %s', topic)
+        return DROPPED
+
+    @staticmethod
+    def _log_ddata(outcome: str or None, source: str, device: FlexyDevice, **fields):
+        # Dropped DDATA was logged as a warning where it happened
+        if outcome == PUBLISHED:
+            logger.info('ddata_published', 'DDATA PUBLISHED, source: %s', source, device=device.device_id, **fields)
+        elif outcome == STORED:
+            logger.info('ddata_stored', 'DDATA STORED FOR REPLAY, source: %s', source, device=device.device_id,
+                        **fields)
+
+    def _send(self, client, topic: str, payload: bytes, priority: int, device: FlexyDevice = None,
+              seq: bool = True, reset_seq: bool = False) -> bool:
+        # payload is encoded without the seq field, it gets the next seq when it actually goes out
+        if self.__outbound is not None:
+            return self.__outbound.publish(client, topic, payload, priority, device=device, seq=seq,
+                                           reset_seq=reset_seq)
+        if seq:
+            payload += encode_seq(self.__sparkplug_node.sequence.next_value())
+        result = client.publish(topic, payload)
+        if reset_seq:
+            self.__sparkplug_node.sequence.reset()
+        return result.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def on_outbound_failed(self, message: OutboundMessage):
+        # A DDATA paho refused after publish() had queued it, kept as historical data when store and forward is
+        # enabled. Refused historical DDATA was already taken out of the store by the replay, it goes back in
+        if self.__store is None or '/DDATA/' not in message.topic:
+            return
+        self.__store.store(message.topic, message.payload if message.priority == PRIORITY_HISTORICAL
+                           else self._to_historical(message.payload))
+
+    @staticmethod
+    def _to_historical(payload: bytes) -> bytes:
+        sp_payload = sparkplug_b_pb2.Payload()
+        sp_payload.ParseFromString(payload)
+        for metric in sp_payload.metrics:
+            metric.is_historical = True
+        return sp_payload.SerializeToString()
 
-        print(dt.datetime.fromtimestamp(timestamp / 1000), 'DDATA PUBLISHED, source: process_flexy_data_message()')
+    def _publish_stored(self, client, topic: str, payload: bytes) -> bool:
+        if not self._session_online(client):
+            return False
+        return self._send(client, topic, payload, PRIORITY_HISTORICAL)
+
+    def replay_stored(self, client):
+        with self.__lock:
+            self.__replay_call = None
+            if not self._session_online(client):
+                return
+            replayed = self.__store.replay(lambda topic, payload: self._publish_stored(client, topic, payload),
+                                           limit=self.__replay_batch)
+            if len(self.__store):
+                self.__replay_call = self.__scheduler.call_later(self.__replay_interval, self.replay_stored, client)
+        if replayed:
+            logger.info('store_replayed', 'STORE AND FORWARD REPLAYED %s, %s remaining', replayed, len(self.__store))
+
+    def _publish_held_data(self, client, device: FlexyDevice, message):
+        # DATA held while the REBIRTH was pending is older than the DBIRTH values, it goes out as historical DDATA
+        updates = []
+        if message.topic.endswith('/DATA2'):
+            decoded = self.decode_flexy_data2(message.payload)
+            if not decoded or decoded[1] != len(device.metrics):
+                return
+            timestamp = decoded[0] * 1000
+            for index, value in zip(decoded[2], decoded[3]):
+                metric = device.metrics[index - 1]
+                value = self._cast_value(metric, value, device.flexy_topic)
+                if value is not None:
+                    updates.append((metric, value, timestamp))
+        else:
+            payload_data = self.decode_flexy_payload(message.payload)
+            if not payload_data:
+                return
+            timestamp = payload_data['t'] * 1000
+            for data in payload_data['m']:
+                metric = device.get_metric(data['a'])
+                value = self._cast_value(metric, data['v'], device.flexy_topic) if metric is not None else None
+                if value is not None:
+                    updates.append((metric, value, timestamp))
+        if not updates:
+            return
+        payload = self._encode_ddata(updates, seq=None, is_historical=True)
+        if not self._publish_stored(client, device.ddata_topic, payload) and self.__store is not None:
+            self.__store.store(device.ddata_topic, payload)
+
+    def flush_device(self, client, device: FlexyDevice):
+        with self.__lock:
+            device.flush_call = None
+            if self.__flexy_devices.get(device.flexy_topic) is not device:
+                return
+            outcome = self._publish_ddata(client, device)
+        self._log_ddata(outcome, 'flush_device()', device)
 
     def process_flexy_state_message(self, client, userdata, message):
-        topic = self._trim_topic(message.topic)
-        if message.payload == b'ONLINE':
-            client.publish(f'{topic}/CMD', b'REBIRTH')
-        elif message.payload == b'OFFLINE':
-            topic = self._trim_topic(message.topic)
-            _, client_id, iono2x_serial, flexy_serial = topic.split('/')
-            device_data = self.get_flexy_device(topic)
-            if not device_data:
-                print(f'OFFLINE FROM UNCACHED DEVICE, IGNORE')
+        flexy_topic = self.__flexy_devices.parse_topic(message.topic)
+        # "ONLINE;<id>,<id>..." lists the Flexy tag IDs, see program.bas. A plain "ONLINE" lists none
+        state, _, tag_ids = message.payload.partition(b';')
+        if state == b'ONLINE':
+            device = self.__flexy_devices.get(flexy_topic.flexy_topic)
+            if message.retain and device is not None:
+                # Retained STATE replayed on subscribe, not a Flexy restart. The device is already cached
+                # (or restored from the snapshot) and gets its DBIRTH from publish_birth, unless tags were
+                # added or removed since its BIRTH
+                if not tag_ids or set(tag_ids.decode(errors='replace').split(',')) == device.aliases.keys():
+                    return
+                self._request_rebirth(client, flexy_topic, 'alias_set')
                 return
-            sequence.increment()
-            ddeath_payload = {
-                'timestamp': self.__sparkplug_node.current_timestamp,
-                'seq': sequence.current_value
-            }
-            payload_bytes = self.__sparkplug_node.payload_dict_to_bytes(ddeath_payload)
-            topic = self.__sparkplug_node.ddeath_topic(flexy_serial)
-            client.publish(topic, payload_bytes)
+            self._request_rebirth(client, flexy_topic, 'state_online')
+        elif state == b'OFFLINE':
+            device = self.__flexy_devices.get(flexy_topic.flexy_topic)
+            if not device:
+                self.__rebirths.cancel(flexy_topic.flexy_topic)
+                logger.info('uncached_device', 'OFFLINE FROM UNCACHED DEVICE, IGNORE', flexy=flexy_topic.flexy_topic)
+                return
+            with self.__lock:
+                self._publish_ddeath(client, device)
 
     def process_dcmd_message(self, client, userdata, message):
         spb_payload = sparkplug_b_pb2.Payload()
         spb_payload.ParseFromString(message.payload)
-        payload_data = MessageToDict(spb_payload)
-        if 'metrics' not in payload_data.keys():
-            return
-        for metric_data in payload_data['metrics']:
-            if metric_data['name'] == 'Device Control/Rebirth':
-                break
-        else:
-            print('No rebirth command, skipping')
+        if not spb_payload.metrics:
             return
 
         _, group_id, _, node_id, device_id = message.topic.split('/')
-        device_data = self.get_flexy_device_by_id(device_id)
-        if not device_data:
-            sequence.increment()
-            ddeath_payload = {
-                'timestamp': self.__sparkplug_node.current_timestamp,
-                'seq': sequence.current_value
-            }
-            payload_bytes = self.__sparkplug_node.payload_dict_to_bytes(ddeath_payload)
-            client.publish(message.topic.replace('/DCMD/', '/DDEATH/'), payload_bytes)
-            print(f'DEVICE WITH device_id "{device_id}" not found!')
+        device = self.get_flexy_device_by_id(device_id)
+        if not device:
+            with self.__lock:
+                ddeath_payload = {
+                    'timestamp': self.__sparkplug_node.current_timestamp
+                }
+                payload_bytes = self.__sparkplug_node.payload_dict_to_bytes(ddeath_payload)
+                self._send(client, message.topic.replace('/DCMD/', '/DDEATH/'), payload_bytes, PRIORITY_DEVICE)
+            logger.warning('unknown_device', 'DEVICE WITH device_id "%s" not found!', device_id)
+            return
+
+        # The protobuf metrics are read directly, values come from whichever oneof field the host set
+        rebirth = False
+        writes = []
+        for spb_metric in spb_payload.metrics:
+            if spb_metric.name == 'Device Control/Rebirth':
+                rebirth = True
+                continue
+            metric = device.resolve_command_metric(spb_metric.alias if spb_metric.HasField('alias') else None,
+                                                   spb_metric.name)
+            if isinstance(metric, TemplateInstance):
+                # Template members are addressed by their name inside the instance
+                for spb_member in spb_metric.template_value.metrics:
+                    self._add_command_write(writes, spb_member,
+                                            device.resolve_command_metric(None, f'{metric.name}/{spb_member.name}'))
+                continue
+            self._add_command_write(writes, spb_metric, metric)
+
+        if writes:
+            self._write_flexy_tags(client, device, writes)
+        if rebirth:
+            self._request_rebirth(client, device.topic, 'dcmd')
+            logger.info('flexy_rebirth', 'FLEXY REBIRTH REQUESTED %s', device.flexy_topic)
+        elif not writes:
+            logger.info('no_command', 'No rebirth command, skipping')
+
+    @staticmethod
+    def _add_command_write(writes: list, spb_metric, metric: FlexyMetric or None):
+        if metric is None or not metric.writable:
+            logger.warning('dcmd_rejected', 'DCMD FOR %s METRIC "%s" IGNORED',
+                           'UNKNOWN' if metric is None else 'READ ONLY', spb_metric.name or spb_metric.alias)
+            DCMD_REJECTED.inc()
+            return
+        value_key = spb_metric.WhichOneof('value')
+        if value_key is None:
+            DCMD_REJECTED.inc()
             return
-        client.publish(device_data['flexy_topic'] + '/CMD', b'REBIRTH')
-        print('FLEXY REBIRTH REQUESTED', device_data['flexy_topic'])
+        # Without a datatype on the DCMD metric the BIRTH datatype tells how to read the value
+        writes.append((metric, getattr(spb_metric, value_key), spb_metric.datatype or metric.datatype.sparkplug_code))
+
+    @staticmethod
+    def format_write_value(value, datatype: int = 0) -> str or None:
+        # Flexy tags are numeric, SETIO gets the value through VAL() in program.bas. None for values it cannot take
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, int):
+            bits = SIGNED_INT_BITS.get(datatype)
+            if bits is not None:
+                value &= (1 << bits) - 1
+                if value >> (bits - 1):
+                    value -= 1 << bits
+            return repr(value)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return repr(value) if math.isfinite(value) else None
+
+    def _write_flexy_tags(self, client, device: FlexyDevice, writes: list):
+        # Every write of one DCMD goes out as a single Flexy CMD, "WRITE;<count>;<index>,<value>;..."
+        # with 1 based indexes into the BIRTH metric list, see WriteTags() in program.bas
+        items = []
+        for metric, value, datatype in writes:
+            formatted = self.format_write_value(value, datatype)
+            if formatted is None:
+                logger.warning('dcmd_rejected', 'DCMD VALUE "%s" FOR "%s" IS NOT A FINITE NUMBER, IGNORED',
+                               value, metric.name)
+                DCMD_REJECTED.inc()
+                continue
+            items.append(f'{metric.index + 1},{formatted}')
+        if not items:
+            return
+        client.publish(device.cmd_topic, f'WRITE;{len(items)};{";".join(items)}'.encode())
+        DCMD_WRITES.inc(len(items))
+        logger.info('flexy_write', 'FLEXY WRITE REQUESTED %s: %s tag(s)', device.flexy_topic, len(items))
 
     def process_ncmd_message(self, client, userdata, message):
         spb_payload = sparkplug_b_pb2.Payload()
         spb_payload.ParseFromString(message.payload)
-        payload_data = MessageToDict(spb_payload)
-        if 'metrics' not in payload_data.keys():
+        # Every command of the NCMD is handled, the rebirth last so the NBIRTH shows the resulting state
+        rebirth = handled = False
+        for spb_metric in spb_payload.metrics:
+            if spb_metric.name == 'Node Control/Rebirth':
+                rebirth = True
+            elif spb_metric.name == PROFILE_START and self.__profiler is not None:
+                value_key = spb_metric.WhichOneof('value')
+                seconds = getattr(spb_metric, value_key) if value_key else 0
+                if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0:
+                    seconds = self.__profile_seconds
+                self.start_profile(client, min(seconds, PROFILE_MAX_SECONDS))
+                handled = True
+            elif spb_metric.name == PROFILE_STOP and self.__profiler is not None:
+                self.stop_profile(client)
+                handled = True
+        if not rebirth:
+            if spb_payload.metrics and not handled:
+                logger.info('no_command', 'No rebirth command, skipping')
             return
-        for metric_data in payload_data['metrics']:
-            if metric_data['name'] == 'Node Control/Rebirth':
-                break
-        else:
-            print('No rebirth command, skipping')
+
+        self.publish_birth(client, self.__sparkplug_node.bd_seq.current_value)
+
+    def start_profile(self, client, seconds: float):
+        if not self.__profiler.start():
+            logger.warning('profiler', 'PROFILER ALREADY RUNNING')
             return
+        self.__profile_call = self.__scheduler.call_later(seconds, self.stop_profile, client)
+        logger.info('profiler', 'PROFILER STARTED FOR %ss', seconds)
+        self.publish_node_data(client, self._profiler_metrics())
+
+    def stop_profile(self, client):
+        if self.__profile_call is not None:
+            self.__profile_call.cancel()
+            self.__profile_call = None
+        report = self.__profiler.stop()
+        if report is None:
+            return
+        path = os.path.join(self.__profile_dir, f'profile-{time.strftime("%Y%m%d-%H%M%S")}.txt')
+        try:
+            report.write(path)
+            logger.info('profiler', 'PROFILE OF %s SAMPLES WRITTEN TO "%s"', report.samples, path)
+        except OSError as err:
+            logger.error('profiler', 'PROFILE WRITE TO "%s" FAILED: %s', path, err)
+            path = ''
+        self.publish_node_data(client, self._profiler_metrics(report, path))
+
+    def _profiler_metrics(self, report: ProfileReport = None, path: str = '') -> list:
+        top = report.top(self.__profile_top) if report is not None else []
+        profiler_metrics = [
+            {'name': 'Profiler/Running', 'datatype': 11, 'boolean_value': self.__profiler.running},
+            {'name': 'Profiler/Samples', 'datatype': 4, 'long_value': report.samples if report is not None else 0},
+            {'name': 'Profiler/File', 'datatype': 12, 'string_value': path},
+        ]
+        for rank in range(self.__profile_top):
+            summary = ''
+            if rank < len(top):
+                function, self_percent, total_percent = top[rank]
+                summary = f'{self_percent:.1f}% self, {total_percent:.1f}% total: {function}'
+            profiler_metrics.append({'name': f'Profiler/Top {rank + 1}', 'datatype': 12, 'string_value': summary})
+        return profiler_metrics
+
+    def _profiler_birth_metrics(self, timestamp: int) -> list:
+        control_metrics = [
+            {'name': PROFILE_START, 'datatype': 4, 'long_value': 0},
+            {'name': PROFILE_STOP, 'datatype': 11, 'boolean_value': False},
+        ]
+        payload_data = {'metrics': [dict(metric, timestamp=timestamp)
+                                    for metric in control_metrics + self._profiler_metrics()]}
+        return ParseDict(payload_data, sparkplug_b_pb2.Payload()).metrics
 
-        _, group_id, _, node_id = message.topic.split('/')
-        self.publish_birth(client, bd_seq.current_value)
+    @property
+    def devices(self) -> list:
+        # Safe from any thread, the registry is only changed under the lock
+        with self.__lock:
+            return list(self.__flexy_devices)
+
+    @property
+    def store(self) -> StoreAndForward or None:
+        return self.__store
 
     @property
     def flexy_devices_count(self) -> int:
@@ -408,64 +1177,253 @@ class FlexyTranslatorNode:
 
     @property
     def flexy_device_ids(self):
-        return [v['device_id'] for v in self.__flexy_devices.values()]
+        return [device.device_id for device in self.devices]
+
+    def publish_node_data(self, client, node_metrics: list = None):
+        with self.__lock:
+            if not self._session_online(client):
+                return
+            self._send(client, self.__sparkplug_node.ndata_topic,
+                       self.__sparkplug_node.ndata_payload(None, node_metrics), PRIORITY_DATA)
 
     def publish_birth(self, client, bdseq: int):
-        client.publish(self.__sparkplug_node.nbirth_topic, self.__sparkplug_node.nbirth_payload(bdseq))
-        sequence.reset()
-        for i, (flexy_topic, data) in enumerate(self.__flexy_devices.items()):
-            sequence.increment()
-            seq = sequence.current_value
-            dbirth_topic = self.__sparkplug_node.dbirth_topic(data['device_id'])
-            dbirth_payload = self._make_sparkplug_payload(topic=flexy_topic, is_birth=True, seq=seq)
-            client.publish(dbirth_topic, dbirth_payload)
+        with self.__lock:
+            # The NBIRTH carries seq 0, the DBIRTH(s) continue from 1
+            self._send(client, self.__sparkplug_node.nbirth_topic, self.__sparkplug_node.nbirth_payload(bdseq),
+                       PRIORITY_NODE, seq=False, reset_seq=True)
+            for device in self.__flexy_devices:
+                if not device.online:
+                    # DDEATHed (OFFLINE or stale), it is born again with its next Flexy BIRTH. A DBIRTH here would
+                    # leave it offline for the liveness check, never DDEATHed when it stays silent
+                    continue
+                # The DBIRTH carries the latest values, so it also flushes any pending coalesced data
+                device.cancel_flush()
+                if device.liveness_call is None and device.stale_seconds:
+                    self._watch_device(client, device, device.stale_seconds)
+                started = time.perf_counter()
+                dbirth_payload = self._make_sparkplug_payload(device, is_birth=True, seq=None)
+                published = time.perf_counter()
+                ENCODE_SECONDS.observe(published - started)
+                self._send(client, device.dbirth_topic, dbirth_payload, PRIORITY_DEVICE, device=device)
+                PUBLISH_SECONDS.time(published)
+                DBIRTH_PUBLISHED.inc()
+            self.__sparkplug_node.on_publish_birth()
+            if self.__store is not None and len(self.__store) and self.__replay_call is None:
+                self.__replay_call = self.__scheduler.call_later(self.__replay_interval, self.replay_stored, client)
+
+        logger.info('birth_published', 'NBIRTH + DBIRTH(s) PUBLISHED, source: publish_birth()',
+                    node=self.__sparkplug_node.node_id)
+
+
+
+class TrackedClient(mqtt.Client):
+    # paho Client that knows how many accepted publishes it has not written yet, paho has no public accessor
+    # for its packet queue. Counted from the MQTTMessageInfo each publish() returns, written ones are dropped
+    # from the head on every publish so nothing builds up when the count is never read
+    def __init__(self, client_id: str = '', *args, **kwargs):
+        super().__init__(client_id, *args, **kwargs)
+        self.client_id = client_id
+        self.__pending = deque()
+        self.__compact_at = 1024
+        self.__pending_lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        info = super().publish(topic, payload, qos=qos, retain=retain, properties=properties)
+        with self.__pending_lock:
+            self._prune()
+            if info.rc == mqtt.MQTT_ERR_SUCCESS and not info.is_published():
+                self.__pending.append(info)
+        return info
+
+    def _prune(self):
+        pending = self.__pending
+        while pending and pending[0].is_published():
+            pending.popleft()
+        if len(pending) > self.__compact_at:
+            # A QoS 1/2 head waiting for its ack keeps written packets behind it, those go too
+            self.__pending = deque(info for info in pending if not info.is_published())
+            self.__compact_at = max(1024, 2 * len(self.__pending))
 
-        print(dt.datetime.fromtimestamp(self.__sparkplug_node.current_timestamp / 1000),
-              'NBIRTH + DBIRTH(s) PUBLISHED, source: publish_birth()')
+    @property
+    def pending_publishes(self) -> int:
+        with self.__pending_lock:
+            self._prune()
+            return sum(1 for info in self.__pending if not info.is_published())
 
+    def forget_pending(self):
+        # paho drops its packet queue with the connection, those packets are never written.
+        # QoS 1/2 messages it sends again after the reconnect are not counted a second time
+        with self.__pending_lock:
+            self.__pending.clear()
 
 
-sparkplug_node = SparkplugNode(group_id=config.SPARKPLUG_GROUP_ID, node_id=config.SPARKPLUG_EDGE_NODE_ID)
-flexy_node = FlexyTranslatorNode(sparkplug_node=sparkplug_node)
+def make_outbound(sparkplug_node: SparkplugNode, metric_labels: dict = None) -> OutboundScheduler or None:
+    # Sparkplug publishes wait here by priority while OUTBOUND_WINDOW of them are in flight in paho
+    if config.OUTBOUND_WINDOW <= 0:
+        return None
+    return OutboundScheduler(sparkplug_node.sequence, encode_seq, window=config.OUTBOUND_WINDOW,
+                             queue_size=config.OUTBOUND_QUEUE_SIZE, data_policy=config.OUTBOUND_DATA_POLICY,
+                             qos=config.OUTBOUND_QOS, metric_labels=metric_labels)
+
+
+def make_flexy_node(sparkplug_node: SparkplugNode, scheduler: Scheduler, outbound: OutboundScheduler = None,
+                    store_path: str = None, writable_tags: list = None,
+                    metric_labels: dict = None) -> FlexyTranslatorNode:
+    # Translator configured from config.py, shared by the single node below and the nodes of pyapp/tenants.py
+    return FlexyTranslatorNode(sparkplug_node=sparkplug_node, direct_encoding=config.SPARKPLUG_DIRECT_ENCODING,
+                               coalesce_ms=config.DDATA_COALESCE_MS, coalesce_devices=config.DDATA_COALESCE_DEVICES,
+                               coalesce_samples=config.DDATA_COALESCE_MODE == 'samples', scheduler=scheduler,
+                               rbe=RbeEngine.from_file(config.RBE_POLICY_FILE,
+                                                       suppress_identical=config.RBE_SUPPRESS_IDENTICAL),
+                               store=StoreAndForward(store_path,
+                                                     max_bytes=int(config.STORE_FORWARD_MAX_MB * 1024 * 1024),
+                                                     eviction=config.STORE_FORWARD_EVICTION)
+                               if store_path else None,
+                               replay_rate=config.STORE_FORWARD_REPLAY_RATE,
+                               rebirths=RebirthScheduler(scheduler, rate=config.REBIRTH_RATE,
+                                                         burst=config.REBIRTH_BURST, timeout=config.REBIRTH_TIMEOUT,
+                                                         max_timeout=config.REBIRTH_MAX_TIMEOUT,
+                                                         hold=config.REBIRTH_HOLD_DATA,
+                                                         buffer_size=config.REBIRTH_BUFFER_SIZE,
+                                                         metric_labels=metric_labels),
+                               writable_tags=writable_tags,
+                               outbound=outbound,
+                               templates=TemplateRegistry(min_instances=config.SPARKPLUG_TEMPLATE_MIN_INSTANCES)
+                               if config.SPARKPLUG_TEMPLATES else None,
+                               stale_factor=config.STALE_DEVICE_FACTOR, stale_seconds=config.STALE_DEVICE_SECONDS,
+                               profiler=profiler, profile_dir=config.PROFILE_DIR,
+                               profile_seconds=config.PROFILE_SECONDS, metric_labels=metric_labels)
+
+
+sparkplug_node = SparkplugNode(group_id=config.SPARKPLUG_GROUP_ID, node_id=config.SPARKPLUG_EDGE_NODE_ID,
+                               bd_seq_start=bd_seq_start)
+# Module level names of the single node's sequencers
+bd_seq = sparkplug_node.bd_seq
+sequence = sparkplug_node.sequence
+scheduler = Scheduler()
+# One sampler for the whole process, it sees the threads of every node anyway
+profiler = SamplingProfiler(interval=config.PROFILE_INTERVAL_MS / 1000) if config.PROFILE_INTERVAL_MS > 0 else None
+outbound = make_outbound(sparkplug_node)
+# With TENANTS_FILE the nodes of pyapp/tenants.py open their own stores, this one stays unused
+flexy_node = make_flexy_node(sparkplug_node, scheduler, outbound=outbound,
+                             store_path=config.STORE_FORWARD_PATH if not config.TENANTS_FILE else None,
+                             writable_tags=config.WRITABLE_TAGS)
+if snapshot:
+    logger.info('snapshot', 'SNAPSHOT "%s" RESTORED: %s device(s), bdSeq %s', config.SNAPSHOT_PATH,
+                flexy_node.restore_state(snapshot), bd_seq.current_value)
+
+
+def save_snapshot():
+    try:
+        write_snapshot(config.SNAPSHOT_PATH, dict(bd_seq=bd_seq.current_value, **flexy_node.snapshot_state()))
+    except Exception as err:
+        logger.error('snapshot', 'SNAPSHOT "%s" WRITE FAILED: %s', config.SNAPSHOT_PATH, err)
 
 
 def publish_birth(client):
-    # flexy_node.fill_birth_payload_queue()
-    # flexy_node.publish_payload_queue(client)
     flexy_node.publish_birth(client, sparkplug_node.last_bdseq)
     sparkplug_node.on_publish_birth()
 
 
 def on_connect(client, userdata, flags, rc):
-    print('CLIENT CONNECTED, SUBSCRIBING TO TOPICS\n\n')
-    client.subscribe('flexy_v1.0/#')
+    logger.info('connected', 'CLIENT CONNECTED, SUBSCRIBING TO TOPICS')
+    for topic in config.SHARD_SUBSCRIPTIONS or ['flexy_v1.0/#']:
+        client.subscribe(topic)
     client.subscribe(sparkplug_node.ncmd_topic)
+    for device_id in flexy_node.flexy_device_ids:
+        client.subscribe(sparkplug_node.dcmd_topic(device_id))
     flexy_node.publish_birth(client, bd_seq.current_value)
 
 
-def on_disconnect(client, userdata, flags, rc):
-    print('ON DISCONNECT')
-    bd_seq.increment()
+def on_disconnect(client, userdata, rc):
+    logger.warning('disconnected', 'ON DISCONNECT', rc=rc)
+    client.forget_pending()
     client.will_set(topic=sparkplug_node.ndeath_topic,
-                    payload=sparkplug_node.ndeath_payload(bd_seq.current_value))
+                    payload=sparkplug_node.ndeath_payload(bd_seq.next_value()))
     sparkplug_node.on_disconnect()
+    if outbound is not None:
+        outbound.reset()
+    if config.SNAPSHOT_PATH:
+        # bdSeq just moved, persist it now rather than at the next periodic snapshot
+        scheduler.call_later(0, save_snapshot)
 
 
 def on_message(client, userdata, message):
-    print('\n', dt.datetime.today(), '--->', message.topic)
+    logger.debug('message', '---> %s', message.topic)
 
 
-mqtt_client = mqtt.Client(client_id=config.MQTT_CLIENT_ID, protocol=mqtt.MQTTv311)
+mqtt_client = TrackedClient(client_id=config.MQTT_CLIENT_ID, protocol=mqtt.MQTTv311)
 
 mqtt_client.on_connect = on_connect
 mqtt_client.on_disconnect = on_disconnect
+if outbound is not None:
+    # Each written packet frees a slot in the window for the next queued publish
+    mqtt_client.on_publish = outbound.on_publish
+
+# With PIPELINE_WORKERS > 0 the callbacks only enqueue and the translation runs on the worker pool
+pipeline = None
+if config.PIPELINE_WORKERS > 0:
+    pipeline = IngestPipeline(workers=config.PIPELINE_WORKERS, queue_size=config.PIPELINE_QUEUE_SIZE,
+                              overflow=config.PIPELINE_OVERFLOW, report_seconds=config.PIPELINE_REPORT_SECONDS)
+
+
+# Hash sharding, Flexys owned by other shards are skipped on the paho thread before anything else runs
+shard_filter = None
+if config.SHARD_COUNT > 1 and not config.SHARD_SUBSCRIPTIONS:
+    shard_filter = ShardFilter(config.SHARD_INDEX, config.SHARD_COUNT)
 
-mqtt_client.message_callback_add('flexy_v1.0/+/+/+/STATE', flexy_node.process_flexy_state_message)
-mqtt_client.message_callback_add('flexy_v1.0/+/+/+/DATA', flexy_node.process_flexy_data_message)
-mqtt_client.message_callback_add('flexy_v1.0/+/+/+/BIRTH', flexy_node.process_flexy_birth_message)
+
+# CAPTURE_FILE records every inbound message for replay.py, before sharding or the pipeline touch it
+capture = CaptureWriter(config.CAPTURE_FILE) if config.CAPTURE_FILE else None
+
+
+def message_callback(name: str, callback, flexy: bool = False):
+    callback = metrics.instrument(name, callback)
+    if pipeline is not None:
+        callback = pipeline.wrap(callback)
+    if flexy and shard_filter is not None:
+        callback = shard_filter.wrap(callback)
+    return capture.wrap(callback) if capture is not None else callback
+
+
+for subscription, callback_name, handler in flexy_node.message_callbacks():
+    mqtt_client.message_callback_add(subscription, message_callback(callback_name, handler,
+                                                                    flexy=subscription.startswith('flexy_v1.0/')))
 # mqtt_client.message_callback_add('flexy_v1.0/+/+/+/CMD', on_message)
-mqtt_client.message_callback_add('spBv1.0/+/NCMD/+', flexy_node.process_ncmd_message)
-mqtt_client.message_callback_add('spBv1.0/+/DCMD/+/+', flexy_node.process_dcmd_message)
+
+metrics.registry.gauge('flexy_bridge_mqtt_out_queue', 'Packets waiting in the paho outgoing queue',
+                       fn=lambda: mqtt_client.pending_publishes)
+if pipeline is not None:
+    metrics.registry.gauge('flexy_bridge_pipeline_depth', 'Messages waiting for a pipeline worker',
+                           fn=lambda: pipeline.depth)
+    metrics.registry.gauge('flexy_bridge_pipeline_dropped', 'Messages dropped by the pipeline',
+                           fn=lambda: pipeline.stats()['dropped'])
+if flexy_node.store is not None:
+    metrics.registry.gauge('flexy_bridge_store_forward_messages', 'DDATA buffered for replay',
+                           fn=lambda: len(flexy_node.store))
+
+
+def bridge_node_metrics(translator: FlexyTranslatorNode = None, client=None) -> list:
+    # Devices and MQTT queue of one node (the module's by default), counters and latency are process wide
+    translator = translator or flexy_node
+    client = client or mqtt_client
+    data_latency = metrics.registry.histogram('flexy_bridge_callback_seconds', '', callback='flexy_data')
+    return [
+        {'name': 'Bridge/Devices Online', 'datatype': 4,
+         'long_value': sum(1 for device in translator.devices if device.online)},
+        {'name': 'Bridge/DDATA Published', 'datatype': 4, 'long_value': DDATA_PUBLISHED.value},
+        {'name': 'Bridge/Unknown Aliases', 'datatype': 4, 'long_value': UNKNOWN_ALIASES.value},
+        {'name': 'Bridge/Rebirth Requests', 'datatype': 4,
+         'long_value': sum(rebirth_requests_counter(reason).value
+                           for reason in ('uncached_device', 'unknown_alias', 'tag_count', 'state_online',
+                                          'alias_set', 'dcmd', 'stale_device'))},
+        {'name': 'Bridge/MQTT Queue Depth', 'datatype': 4, 'long_value': client.pending_publishes},
+        {'name': 'Bridge/DATA Latency p99 ms', 'datatype': 10, 'double_value': data_latency.quantile(0.99) * 1000},
+    ]
+
+
+if config.METRICS_NDATA_SECONDS > 0:
+    sparkplug_node.add_node_metrics(bridge_node_metrics)
 
 # mqtt_client.on_message = on_message
 
@@ -481,6 +1439,20 @@ def start():
                         payload=sparkplug_node.ndeath_payload(bd_seq.current_value))
 
 
+    if pipeline is not None:
+        pipeline.start()
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT)
+    if config.METRICS_NDATA_SECONDS > 0:
+        scheduler.call_every(config.METRICS_NDATA_SECONDS, flexy_node.publish_node_data, mqtt_client)
+    if config.SNAPSHOT_PATH:
+        scheduler.call_every(config.SNAPSHOT_SECONDS, save_snapshot)
+        atexit.register(save_snapshot)
+    if capture is not None:
+        logger.info('capture', 'CAPTURING INBOUND MESSAGES TO "%s"', capture.path)
+        scheduler.call_every(1, capture.flush)
+        atexit.register(capture.close)
+
     mqtt_client.connect(host=config.MQTT_HOST, port=config.MQTT_PORT)
     mqtt_client.loop_forever()
 
@@ -0,0 +1,78 @@
+import paho.mqtt.client as mqtt
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'timestamp')
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False, timestamp: float = 0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = timestamp
+
+
+class FakePublishInfo:
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc: int, mid: int):
+        self.rc = rc
+        self.mid = mid
+
+
+class FakeMqttClient:
+    # Offline stand-in for paho's Client, used by the benchmark and replay tools.
+    # Publishes are counted, and kept in .published when keep_published is set.
+    def __init__(self, keep_published: bool = False):
+        self.keep_published = keep_published
+        self.published = []
+        self.publish_count = 0
+        self.publish_bytes = 0
+        self.subscriptions = set()
+        self.connected = True
+        self.on_publish = None
+        self.pending_publishes = 0  # publishes are written as soon as they are made
+        self.__callbacks = []
+        self.__matches = {}  # topic -> matching callbacks, topic_matches_sub is too slow to run per message
+        self.__mid = 0
+
+    def publish(self, topic: str, payload: bytes = None, qos: int = 0, retain: bool = False):
+        if not self.connected:
+            return FakePublishInfo(mqtt.MQTT_ERR_NO_CONN, 0)
+        self.__mid += 1
+        self.publish_count += 1
+        self.publish_bytes += len(topic) + (len(payload) if payload else 0)
+        if self.keep_published:
+            self.published.append((topic, payload))
+        if self.on_publish is not None:
+            self.on_publish(self, None, self.__mid)
+        return FakePublishInfo(mqtt.MQTT_ERR_SUCCESS, self.__mid)
+
+    def subscribe(self, topic, qos: int = 0):
+        self.subscriptions.add(topic if isinstance(topic, str) else topic[0])
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def unsubscribe(self, topic):
+        self.subscriptions.discard(topic)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def will_set(self, topic: str, payload: bytes = None, qos: int = 0, retain: bool = False):
+        pass
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def message_callback_add(self, sub: str, callback):
+        self.__callbacks.append((sub, callback))
+        self.__matches = {}
+
+    def deliver(self, topic: str, payload: bytes, retain: bool = False, timestamp: float = 0) -> int:
+        # Dispatches like paho does, to every callback whose subscription matches the topic
+        message = FakeMessage(topic, payload, retain=retain, timestamp=timestamp)
+        callbacks = self.__matches.get(topic)
+        if callbacks is None:
+            callbacks = [callback for sub, callback in self.__callbacks if mqtt.topic_matches_sub(sub, topic)]
+            self.__matches[topic] = callbacks
+        for callback in callbacks:
+            callback(self, None, message)
+        return len(callbacks)
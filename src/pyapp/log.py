@@ -0,0 +1,173 @@
+import atexit
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from pyapp import config
+from pyapp import metrics
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+FORMATS = ('text', 'json')
+
+
+class EventLimit:
+    __slots__ = ('every', 'rate', 'tokens', 'refilled', 'seen', 'suppressed')
+
+    # Keeps 1 event in every, and at most rate events per second (burst of rate). Unlocked, under contention a
+    # count may be off by one, which does not matter for log sampling
+    def __init__(self, every: int = 1, rate: float = 0):
+        self.every = max(1, every)
+        self.rate = rate
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.seen = 0
+        self.suppressed = 0  # events dropped since the last one that went out
+
+    def allow(self) -> bool:
+        self.seen += 1
+        if self.seen % self.every:
+            self.suppressed += 1
+            return False
+        if self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+        return True
+
+
+class AsyncLogger:
+    # The calling thread only checks the level, appends (time, level, event, message, args, fields) to a deque
+    # and returns. Formatting and writing happen on a background thread every flush_seconds, in one write per
+    # batch, so a slow stdout never blocks the paho callbacks. The deque is bounded: when the writer falls behind,
+    # the oldest entries are overwritten and counted in flexy_bridge_log_dropped_total.
+    # message is a %-format string, args and fields are only formatted for entries that pass the level and limits
+    def __init__(self, level: int = INFO, stream=None, buffer_size: int = 10000, flush_seconds: float = 0.1,
+                 json_lines: bool = False, limits: dict = None):
+        self.level = level
+        self.stream = stream        # None writes to the sys.stdout of the moment, redirect_stdout applies
+        self.__size = buffer_size
+        self.__buffer = deque(maxlen=buffer_size)
+        self.__flush_seconds = flush_seconds
+        self.__json_lines = json_lines
+        self.__limits = limits or {}  # event -> EventLimit
+        self.__write_lock = threading.Lock()
+        self.__thread = None
+        self.__dropped = metrics.registry.counter('flexy_bridge_log_dropped_total',
+                                                  'Log entries overwritten before the writer got to them')
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def set_limit(self, event: str, every: int = 1, rate: float = 0):
+        self.__limits[event] = EventLimit(every=every, rate=rate)
+
+    def log(self, level: int, event: str, message: str, *args, **fields):
+        if level < self.level:
+            return
+        if self.__limits:
+            limit = self.__limits.get(event)
+            if limit is not None:
+                if not limit.allow():
+                    return
+                if limit.suppressed:
+                    fields['suppressed'] = limit.suppressed
+                    limit.suppressed = 0
+        buffer = self.__buffer
+        if len(buffer) >= self.__size:
+            self.__dropped.inc()
+        buffer.append((time.time(), level, event, message, args, fields))
+        if self.__thread is None:
+            self._start()
+
+    def debug(self, event: str, message: str, *args, **fields):
+        self.log(DEBUG, event, message, *args, **fields)
+
+    def info(self, event: str, message: str, *args, **fields):
+        self.log(INFO, event, message, *args, **fields)
+
+    def warning(self, event: str, message: str, *args, **fields):
+        self.log(WARNING, event, message, *args, **fields)
+
+    def error(self, event: str, message: str, *args, **fields):
+        self.log(ERROR, event, message, *args, **fields)
+
+    def _start(self):
+        with self.__write_lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self.__thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.__flush_seconds)
+            try:
+                self.flush()
+            except Exception as err:
+                # A broken stream must not kill the writer, the entries of the batch are lost
+                sys.__stderr__.write(f'LOG WRITE FAILED: {err}\n')
+
+    def flush(self):
+        # Writes everything buffered so far, also called directly before exit or a stdout redirect ends
+        with self.__write_lock:
+            buffer = self.__buffer
+            lines = []
+            while buffer:
+                try:
+                    lines.append(self._format(*buffer.popleft()))
+                except IndexError:
+                    break
+            if not lines:
+                return
+            stream = self.stream or sys.stdout
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    def _format(self, timestamp: float, level: int, event: str, message: str, args: tuple, fields: dict) -> str:
+        try:
+            text = message % args if args else message
+        except (TypeError, ValueError):
+            text = f'{message} {args!r}'
+        if self.__json_lines:
+            return json.dumps(dict(ts=round(timestamp, 3), level=LEVEL_NAMES.get(level, level), event=event,
+                                   msg=text, **fields), default=str)
+        line = f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))}.{int(timestamp * 1000) % 1000:03d} ' \
+               f'{LEVEL_NAMES.get(level, level):<7} {event}: {text}'
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+def level_from_config() -> int:
+    level = LEVELS.get(config.LOG_LEVEL.strip().upper())
+    if level is None:
+        raise ValueError(f'LOG_LEVEL must be one of {tuple(LEVELS)}, got "{config.LOG_LEVEL}"')
+    return level
+
+
+def limits_from_config() -> dict:
+    limits = {}
+    for event, every in config.LOG_SAMPLING.items():
+        limits[event] = EventLimit(every=int(every))
+    for event, rate in config.LOG_RATE_LIMITS.items():
+        limit = limits.setdefault(event, EventLimit())
+        limit.rate = limit.tokens = rate
+    return limits
+
+
+if config.LOG_FORMAT not in FORMATS:
+    raise ValueError(f'LOG_FORMAT must be one of {FORMATS}, got "{config.LOG_FORMAT}"')
+logger = AsyncLogger(level=level_from_config(), buffer_size=config.LOG_BUFFER_SIZE,
+                     json_lines=config.LOG_FORMAT == 'json', limits=limits_from_config())
@@ -0,0 +1,193 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: tuple) -> list:
+        return [f'{name}{_format_labels(labels)} {self.value}']
+
+
+class Gauge:
+    __slots__ = ('value', 'fn', 'label')
+
+    def __init__(self, fn=None, label: str = None):
+        # fn is evaluated when metrics are collected, with label set it returns {label value: value}
+        self.value = 0
+        self.fn = fn
+        self.label = label
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self):
+        return self.fn() if self.fn is not None else self.value
+
+    def samples(self, name: str, labels: tuple) -> list:
+        value = self.collect()
+        if self.label is None:
+            return [f'{name}{_format_labels(labels)} {value}']
+        return [f'{name}{_format_labels(labels + ((self.label, key),))} {item}' for key, item in value.items()]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self, started: float):
+        self.observe(time.perf_counter() - started)
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def samples(self, name: str, labels: tuple) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{_format_labels(labels)} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__families = {}  # name -> (type, help, {labels: metric})
+        self.__lock = threading.Lock()
+
+    def _get(self, kind: str, cls, name: str, help_text: str, labels: dict, **kwargs):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.setdefault(name, (kind, help_text, {}))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = cls(**kwargs)
+                family[2][key] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get('counter', Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str, fn=None, label: str = None, **labels) -> Gauge:
+        gauge = self._get('gauge', Gauge, name, help_text, labels)
+        if fn is not None:
+            gauge.fn = fn
+            gauge.label = label
+        return gauge
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._get('histogram', Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self) -> str:
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        with self.__lock:
+            families = [(name, kind, help_text, list(metrics.items()))
+                        for name, (kind, help_text, metrics) in self.__families.items()]
+        for name, kind, help_text, metrics in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics:
+                try:
+                    lines.extend(metric.samples(name, labels))
+                except Exception as err:
+                    # Imported here, pyapp.log registers its own counter in this module's registry
+                    from pyapp.log import logger
+                    logger.error('metrics', 'METRIC "%s" COLLECTION FAILED: %s', name, err)
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def instrument(name: str, callback):
+    # Counts calls and records the latency of a paho message callback
+    calls = registry.counter('flexy_bridge_callback_calls_total', 'Message callbacks handled', callback=name)
+    errors = registry.counter('flexy_bridge_callback_errors_total', 'Message callbacks that raised', callback=name)
+    latency = registry.histogram('flexy_bridge_callback_seconds', 'Message callback latency', callback=name)
+    perf_counter = time.perf_counter
+
+    def instrumented(client, userdata, message):
+        started = perf_counter()
+        try:
+            callback(client, userdata, message)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(perf_counter() - started)
+            calls.inc()
+
+    return instrumented
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics_registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.metrics_registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '0.0.0.0', metrics_registry: MetricsRegistry = registry) -> ThreadingHTTPServer:
+    handler = type('MetricsHandler', (_MetricsHandler,), {'metrics_registry': metrics_registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    from pyapp.log import logger
+    logger.info('metrics', 'METRICS SERVED ON http://%s:%s/metrics', host, port)
+    return server
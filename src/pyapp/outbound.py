@@ -0,0 +1,251 @@
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+from pyapp import metrics
+
+PRIORITY_NODE, PRIORITY_DEVICE, PRIORITY_DATA, PRIORITY_HISTORICAL = range(4)
+CLASS_NAMES = ('node', 'device', 'data', 'historical')
+QUEUE_POLICIES = ('coalesce', 'drop_oldest', 'drop_newest')
+
+QUEUED, SENT, DROPPED = range(3)
+
+
+class OutboundMessage:
+    __slots__ = ('topic', 'payload', 'priority', 'device', 'seq', 'reset_seq', 'state')
+
+    def __init__(self, topic: str, payload: bytes, priority: int, device, seq: bool, reset_seq: bool):
+        self.topic = topic
+        self.payload = payload      # encoded without the seq field
+        self.priority = priority
+        self.device = device        # key for per device ordering, None for node and historical messages
+        self.seq = seq              # append the next seq when the message is sent
+        self.reset_seq = reset_seq  # NBIRTH, the seq starts over after it
+        self.state = QUEUED
+
+
+class OutboundScheduler:
+    # Sits between the translator and paho. Messages wait in one queue per priority class
+    # (NBIRTH > DBIRTH/DDEATH > DDATA/NDATA > historical) and are handed to paho while fewer than window
+    # publishes are in flight, so paho's own unbounded queue stays short. The seq is appended at send time,
+    # which keeps it in wire order whatever the class order was. Messages of one device leave in the order
+    # they were queued: a DDEATH waiting behind DDATA of the same device sends that DDATA first.
+    # With the coalesce data policy a DDATA is merged into the device's queued DDATA whenever there is one,
+    # not only once the queue is full.
+    def __init__(self, sequencer, encode_seq, window: int = 100, queue_size: int = 10000, data_policy: str = 'coalesce',
+                 qos: int = 0, on_failed=None, metric_labels: dict = None):
+        if data_policy not in QUEUE_POLICIES:
+            raise ValueError(f'data_policy must be one of {QUEUE_POLICIES}, got "{data_policy}"')
+        self.__sequencer = sequencer
+        self.__encode_seq = encode_seq      # seq -> the serialized seq field, appended to the payload
+        self.__window = window
+        self.__queue_size = queue_size
+        self.__data_policy = data_policy
+        self.__qos = qos
+        # on_failed(message) for queued publishes paho refused after publish() returned, a message refused
+        # within its own publish() call is reported by publish() returning False instead
+        self.on_failed = on_failed
+        self.__queues = [deque() for _ in CLASS_NAMES]
+        self.__queued = [0] * len(CLASS_NAMES)  # live messages per class, the deques also hold dropped ones
+        self.__devices = {}                 # device -> deque of its queued messages, oldest first
+        self.__latest = {}                  # device -> its newest queued PRIORITY_DATA message, the coalesce target
+        self.__in_flight = set()            # mids handed to paho without an on_publish yet
+        self.__early = set()                # mids paho confirmed before publish() returned them
+        self.__sending = False
+        self.__publishing = None            # the message of the publish() call running on this lock
+        self.__lock = threading.RLock()
+        self.__draining = False
+        self.__labels = metric_labels or {}  # e.g. edge_node when the process hosts several nodes
+        self.__delayed = [metrics.registry.counter('flexy_bridge_outbound_delayed_total',
+                                                   'Publishes queued behind the in-flight window or other messages',
+                                                   priority=name, **self.__labels) for name in CLASS_NAMES]
+        self.__coalesced = metrics.registry.counter('flexy_bridge_outbound_coalesced_total',
+                                                    'DDATA merged into a queued DDATA of the same device',
+                                                    **self.__labels)
+        self.__dropped = {}
+        metrics.registry.gauge('flexy_bridge_outbound_queued', 'Publishes waiting in the outbound scheduler',
+                               label='priority', fn=lambda: dict(zip(CLASS_NAMES, self.__queued)), **self.__labels)
+        metrics.registry.gauge('flexy_bridge_outbound_in_flight', 'Publishes handed to paho and not yet sent',
+                               fn=lambda: len(self.__in_flight), **self.__labels)
+
+    def __len__(self):
+        return sum(self.__queued)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.__in_flight)
+
+    def queued(self, priority: int) -> int:
+        return self.__queued[priority]
+
+    def _count_dropped(self, priority: int, reason: str, amount: int = 1):
+        counter = self.__dropped.get((priority, reason))
+        if counter is None:
+            counter = metrics.registry.counter('flexy_bridge_outbound_dropped_total', 'Publishes dropped',
+                                               priority=CLASS_NAMES[priority], reason=reason, **self.__labels)
+            self.__dropped[(priority, reason)] = counter
+        counter.inc(amount)
+
+    def publish(self, client, topic: str, payload: bytes, priority: int, device=None, seq: bool = True,
+                reset_seq: bool = False) -> bool:
+        # False when the message was not accepted (a full historical queue) or paho refused it straight away,
+        # so the caller can keep it
+        with self.__lock:
+            if priority == PRIORITY_NODE and reset_seq:
+                # A new session, the DBIRTHs queued after the NBIRTH carry every current value
+                self._supersede(None)
+            elif priority == PRIORITY_DEVICE and device is not None and topic.split('/', 3)[2] == 'DBIRTH':
+                self._supersede(device)
+
+            if priority == PRIORITY_DATA and device is not None and self.__data_policy == 'coalesce':
+                latest = self.__latest.get(device)
+                if latest is not None and latest.state == QUEUED:
+                    # Concatenated protobuf messages parse as one: the metrics are appended, the payload
+                    # timestamp is the newer one
+                    latest.payload += payload
+                    self.__coalesced.inc()
+                    return True
+
+            if priority >= PRIORITY_DATA and self.__queued[priority] >= self.__queue_size:
+                if priority == PRIORITY_HISTORICAL or self.__data_policy == 'drop_newest':
+                    self._count_dropped(priority, 'queue_full')
+                    return False
+                self._drop_oldest(priority)
+
+            message = OutboundMessage(topic, payload, priority, device if priority != PRIORITY_HISTORICAL else None,
+                                      seq, reset_seq)
+            if len(self.__in_flight) >= self.__window or any(self.__queued):
+                self.__delayed[priority].inc()
+            self.__queues[priority].append(message)
+            self.__queued[priority] += 1
+            if message.device is not None:
+                self.__devices.setdefault(message.device, deque()).append(message)
+                if priority == PRIORITY_DATA:
+                    self.__latest[message.device] = message
+                else:
+                    # DDATA queued after a DBIRTH/DDEATH must not be merged into one queued before it
+                    self.__latest.pop(message.device, None)
+            self.__publishing = message
+            try:
+                self._drain(client)
+            finally:
+                self.__publishing = None
+            return message.state != DROPPED
+
+    def _supersede(self, device):
+        # Drops queued DDATA/DDEATH (one device, or all devices and NDATA with device None) that a birth replaces
+        dropped = 0
+        for priority in (PRIORITY_DEVICE, PRIORITY_DATA):
+            for message in self.__queues[priority]:
+                if message.state == QUEUED and (device is None or message.device == device):
+                    message.state = DROPPED
+                    self.__queued[priority] -= 1
+                    dropped += 1
+                    self._count_dropped(priority, 'superseded')
+        if device is None:
+            self.__devices.clear()
+            self.__latest.clear()
+        else:
+            self.__devices.pop(device, None)
+            self.__latest.pop(device, None)
+        return dropped
+
+    def _drop_oldest(self, priority: int):
+        queue = self.__queues[priority]
+        while queue:
+            message = queue.popleft()
+            if message.state == QUEUED:
+                self._unlink(message)
+                message.state = DROPPED
+                self.__queued[priority] -= 1
+                self._count_dropped(priority, 'queue_full')
+                return
+
+    def _unlink(self, message: OutboundMessage):
+        if message.device is None:
+            return
+        device_queue = self.__devices.get(message.device)
+        if device_queue:
+            try:
+                device_queue.remove(message)
+            except ValueError:
+                pass
+            if not device_queue:
+                del self.__devices[message.device]
+        if self.__latest.get(message.device) is message:
+            del self.__latest[message.device]
+
+    def _next(self) -> OutboundMessage or None:
+        for priority, queue in enumerate(self.__queues):
+            while queue:
+                message = queue[0]
+                if message.state != QUEUED:
+                    queue.popleft()
+                    continue
+                if message.device is not None:
+                    head = self.__devices[message.device][0]
+                    if head is not message:
+                        # An older message of the same device goes first
+                        return head
+                return message
+        return None
+
+    def _drain(self, client):
+        if self.__draining:
+            return
+        self.__draining = True
+        try:
+            while len(self.__in_flight) < self.__window:
+                message = self._next()
+                if message is None:
+                    break
+                self._send(client, message)
+        finally:
+            self.__draining = False
+
+    def _send(self, client, message: OutboundMessage):
+        message.state = SENT
+        self.__queued[message.priority] -= 1
+        if message.device is not None:
+            device_queue = self.__devices[message.device]
+            device_queue.popleft()
+            if not device_queue:
+                del self.__devices[message.device]
+            if self.__latest.get(message.device) is message:
+                del self.__latest[message.device]
+        payload = message.payload
+        if message.seq:
+            payload += self.__encode_seq(self.__sequencer.next_value())
+        self.__sending = True
+        try:
+            result = client.publish(message.topic, payload, qos=self.__qos)
+        finally:
+            self.__sending = False
+        if message.reset_seq:
+            self.__sequencer.reset()
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            message.state = DROPPED
+            self._count_dropped(message.priority, 'send_failed')
+            if self.on_failed is not None and message is not self.__publishing:
+                self.on_failed(message)
+            return
+        if result.mid not in self.__early:
+            self.__in_flight.add(result.mid)
+        # Anything else confirmed during publish() was a packet the scheduler did not send
+        self.__early.clear()
+
+    def on_publish(self, client, userdata, mid: int):
+        with self.__lock:
+            if mid in self.__in_flight:
+                self.__in_flight.discard(mid)
+            elif self.__sending:
+                # paho wrote the packet from inside publish(), before the mid was returned
+                self.__early.add(mid)
+            self._drain(client)
+
+    def reset(self):
+        # After a disconnect nothing in flight will be confirmed anymore
+        with self.__lock:
+            self.__in_flight.clear()
+            self.__early.clear()
@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+from pyapp.log import logger
+
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+
+class IngestPipeline:
+    # Moves message handling off the paho network thread. Messages are sharded by their first four topic
+    # levels (the Flexy device for flexy_v1.0 topics), so each device is handled by one worker and stays in order.
+    def __init__(self, workers: int = 4, queue_size: int = 10000, overflow: str = 'block',
+                 report_seconds: float = 60):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of {OVERFLOW_POLICIES}, got "{overflow}"')
+        self.__overflow = overflow
+        self.__report_seconds = report_seconds
+        shard_size = max(1, queue_size // workers)
+        self.__queues = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        self.__shards = {}
+        self.__threads = []
+        self.__running = False
+        self.__stats_lock = threading.Lock()
+        self.__submitted = 0
+        self.__processed = 0
+        self.__dropped = 0
+        self.__blocked = 0
+        self.__errors = 0
+
+    @property
+    def workers(self) -> int:
+        return len(self.__queues)
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.__queues)
+
+    @property
+    def shard_depths(self) -> list:
+        return [q.qsize() for q in self.__queues]
+
+    def stats(self) -> dict:
+        return dict(depth=self.depth, submitted=self.__submitted, processed=self.__processed,
+                    dropped=self.__dropped, blocked=self.__blocked, errors=self.__errors)
+
+    def _shard(self, topic: str) -> int:
+        shard = self.__shards.get(topic)
+        if shard is None:
+            key = '/'.join(topic.split('/')[:4])
+            shard = zlib.crc32(key.encode()) % len(self.__queues)
+            self.__shards[topic] = shard
+        return shard
+
+    def wrap(self, callback):
+        def enqueue(client, userdata, message):
+            self.submit(callback, client, userdata, message)
+        return enqueue
+
+    def submit(self, callback, client, userdata, message):
+        shard_queue = self.__queues[self._shard(message.topic)]
+        item = (callback, client, userdata, message)
+        self.__submitted += 1
+        try:
+            shard_queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        if self.__overflow == 'block':
+            # Backpressure, the paho thread stops reading from the socket until a worker catches up
+            self.__blocked += 1
+            shard_queue.put(item)
+        elif self.__overflow == 'drop_newest':
+            self._count_drop()
+        else:
+            while True:
+                try:
+                    shard_queue.get_nowait()
+                    self._count_drop()
+                except queue.Empty:
+                    pass
+                try:
+                    shard_queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    continue
+
+    def _count_drop(self):
+        with self.__stats_lock:
+            self.__dropped += 1
+
+    def _work(self, shard_queue: queue.Queue):
+        while True:
+            item = shard_queue.get()
+            if item is None:
+                return
+            callback, client, userdata, message = item
+            try:
+                callback(client, userdata, message)
+            except Exception:
+                logger.error('pipeline_error', 'PIPELINE CALLBACK FAILED\n%s', traceback.format_exc().rstrip())
+                with self.__stats_lock:
+                    self.__errors += 1
+            with self.__stats_lock:
+                self.__processed += 1
+
+    def _report(self):
+        while self.__running:
+            time.sleep(self.__report_seconds)
+            stats = self.stats()
+            logger.info('pipeline', 'PIPELINE depth: %s %s', stats['depth'], self.shard_depths,
+                        processed=stats['processed'], dropped=stats['dropped'], blocked=stats['blocked'],
+                        errors=stats['errors'])
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        for index, shard_queue in enumerate(self.__queues):
+            thread = threading.Thread(target=self._work, args=(shard_queue,), name=f'pipeline-{index}', daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        if self.__report_seconds > 0:
+            threading.Thread(target=self._report, name='pipeline-report', daemon=True).start()
+
+    def stop(self, timeout: float = None):
+        self.__running = False
+        for shard_queue in self.__queues:
+            shard_queue.put(None)
+        for thread in self.__threads:
+            thread.join(timeout)
+        self.__threads = []
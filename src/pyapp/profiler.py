@@ -0,0 +1,108 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Leaf frames of threads waiting for work, counted as idle instead of showing up as hot functions
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py')
+
+
+class ProfileReport:
+    __slots__ = ('started', 'seconds', 'samples', 'idle', 'self_counts', 'total_counts', 'stacks')
+
+    def __init__(self, started: float, seconds: float, samples: int, idle: int, self_counts: Counter,
+                 total_counts: Counter, stacks: Counter):
+        self.started = started      # unix time
+        self.seconds = seconds
+        self.samples = samples      # busy thread samples
+        self.idle = idle
+        self.self_counts = self_counts    # function -> samples with it as the innermost frame
+        self.total_counts = total_counts  # function -> samples with it anywhere on the stack
+        self.stacks = stacks              # "thread;outer;...;inner" -> samples
+
+    def top(self, count: int = 10) -> list:
+        # (function, self %, total %) of the functions with the most self samples
+        samples = self.samples or 1
+        return [(function, 100 * hits / samples, 100 * self.total_counts[function] / samples)
+                for function, hits in self.self_counts.most_common(count)]
+
+    def write(self, path: str, count: int = 30):
+        # Summary table followed by the collapsed stacks, the part flamegraph.pl reads
+        with open(path, 'w') as file:
+            file.write(f'# {self.samples} busy + {self.idle} idle samples in {self.seconds:.1f}s, '
+                       f'started {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))}\n')
+            file.write(f'# {"self %":>7} {"total %":>7}  function\n')
+            for function, self_percent, total_percent in self.top(count):
+                file.write(f'# {self_percent:7.2f} {total_percent:7.2f}  {function}\n')
+            for stack, hits in self.stacks.most_common():
+                file.write(f'{stack} {hits}\n')
+
+
+class SamplingProfiler:
+    # Samples the Python stacks of every thread from a thread of its own, so the translator threads run
+    # unmodified. The cost is one sys._current_frames() walk per interval, nothing while it is stopped.
+    def __init__(self, interval: float = 0.005):
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__reset()
+
+    def __reset(self):
+        self.__started = 0
+        self.__samples = 0
+        self.__idle = 0
+        self.__self_counts = Counter()
+        self.__total_counts = Counter()
+        self.__stacks = Counter()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None
+
+    def start(self) -> bool:
+        with self.__lock:
+            if self.__thread is not None:
+                return False
+            self.__reset()
+            self.__started = time.time()
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.__thread.start()
+            return True
+
+    def stop(self) -> ProfileReport or None:
+        with self.__lock:
+            thread = self.__thread
+            if thread is None:
+                return None
+            self.__stop.set()
+            thread.join()
+            self.__thread = None
+            return ProfileReport(self.__started, time.time() - self.__started, self.__samples, self.__idle,
+                                 self.__self_counts, self.__total_counts, self.__stacks)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        interval = self.__interval
+        while not self.__stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._sample(names.get(thread_id, str(thread_id)), frame)
+
+    def _sample(self, thread_name: str, frame):
+        if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+            self.__idle += 1
+            return
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.__samples += 1
+        self.__self_counts[functions[0]] += 1
+        self.__total_counts.update(set(functions))
+        functions.append(thread_name)
+        self.__stacks[';'.join(reversed(functions))] += 1
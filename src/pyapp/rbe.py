@@ -0,0 +1,80 @@
+import json
+from fnmatch import fnmatchcase
+
+from pyapp.log import logger
+
+REPORT = 0    # publish the value in the next DDATA
+SUPPRESS = 1  # keep the value for births but do not publish it
+DEFER = 2     # publish once the policy's min_interval has passed
+
+NUMERIC_TYPES = (int, float)
+
+
+class RbePolicy:
+    __slots__ = ('deadband', 'percent_deadband', 'min_interval_ms', 'max_interval_ms', 'suppress_identical')
+
+    def __init__(self, deadband: float = 0.0, percent_deadband: float = 0.0, min_interval: float = 0.0,
+                 max_interval: float = 0.0, suppress_identical: bool = True):
+        self.deadband = deadband
+        self.percent_deadband = percent_deadband
+        self.min_interval_ms = min_interval * 1000
+        self.max_interval_ms = max_interval * 1000
+        self.suppress_identical = suppress_identical
+
+    @classmethod
+    def from_dict(cls, data: dict, defaults: 'RbePolicy' = None) -> 'RbePolicy':
+        defaults = defaults or cls()
+        return cls(deadband=data.get('deadband', defaults.deadband),
+                   percent_deadband=data.get('percent_deadband', defaults.percent_deadband),
+                   min_interval=data.get('min_interval', defaults.min_interval_ms / 1000),
+                   max_interval=data.get('max_interval', defaults.max_interval_ms / 1000),
+                   suppress_identical=data.get('suppress_identical', defaults.suppress_identical))
+
+    def check(self, metric, value, timestamp: int) -> int:
+        # value is already cast, so it is compared as a typed value against the last published one
+        previous = metric.value_published
+        if value == previous:
+            if self.suppress_identical:
+                return SUPPRESS
+        elif type(value) in NUMERIC_TYPES and type(previous) in NUMERIC_TYPES:
+            delta = abs(value - previous)
+            if self.deadband and delta <= self.deadband:
+                return SUPPRESS
+            if self.percent_deadband and delta <= abs(previous) * self.percent_deadband / 100:
+                return SUPPRESS
+        if self.min_interval_ms and timestamp - metric.published_at < self.min_interval_ms:
+            return DEFER
+        return REPORT
+
+    def min_interval_elapsed(self, metric, timestamp: int) -> bool:
+        return timestamp - metric.published_at >= self.min_interval_ms
+
+    def max_interval_elapsed(self, metric, timestamp: int) -> bool:
+        return bool(self.max_interval_ms) and timestamp - metric.published_at >= self.max_interval_ms
+
+
+class RbeEngine:
+    # Resolves the report by exception policy of a metric from its Sparkplug name, first matching pattern wins
+    def __init__(self, default: RbePolicy = None, policies: list = None):
+        self.__default = default
+        self.__policies = policies or []  # (fnmatch pattern, RbePolicy)
+
+    @classmethod
+    def from_file(cls, path: str = None, suppress_identical: bool = True) -> 'RbeEngine':
+        # {"default": {...}, "policies": [{"pattern": "*/Tank*/Level", "deadband": 0.5, "max_interval": 300}]}
+        default = RbePolicy(suppress_identical=suppress_identical)
+        if not path:
+            return cls(default=default)
+        with open(path) as policy_file:
+            data = json.load(policy_file)
+        default = RbePolicy.from_dict(data.get('default', {}), defaults=default)
+        policies = [(policy['pattern'], RbePolicy.from_dict(policy, defaults=default))
+                    for policy in data.get('policies', [])]
+        logger.info('rbe', 'RBE policies loaded from "%s": %s pattern(s)', path, len(policies))
+        return cls(default=default, policies=policies)
+
+    def policy_for(self, name: str) -> RbePolicy or None:
+        for pattern, policy in self.__policies:
+            if fnmatchcase(name, pattern):
+                return policy
+        return self.__default
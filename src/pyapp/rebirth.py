@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import deque
+
+from pyapp import metrics
+from pyapp.log import logger
+from pyapp.scheduler import Scheduler
+
+HOLD_POLICIES = ('drop', 'buffer')
+
+
+def rebirth_requests_counter(reason: str) -> metrics.Counter:
+    return metrics.registry.counter('flexy_bridge_rebirth_requests_total', 'REBIRTH commands sent to Flexys',
+                                    reason=reason)
+
+
+class PendingRebirth:
+    __slots__ = ('topic', 'reason', 'attempts', 'timeout_call', 'holding', 'held', 'queued')
+
+    def __init__(self, topic, reason: str, buffer_size: int):
+        self.topic = topic              # FlexyTopic
+        self.reason = reason
+        self.attempts = 0
+        self.timeout_call = None
+        self.holding = False            # set once DATA could not be decoded with the cached aliases
+        self.held = deque(maxlen=buffer_size) if buffer_size else None  # DATA received while waiting for the BIRTH
+        self.queued = False
+
+
+class RebirthScheduler:
+    # Sends at most one outstanding REBIRTH per Flexy. Commands pass a node wide token bucket (rate per second,
+    # burst tokens) so a mass reconnect spreads the BIRTHs out, and are resent with exponential backoff until the
+    # BIRTH arrives. DATA from a Flexy waiting for its BIRTH is dropped or held, never answered with another command
+    def __init__(self, scheduler: Scheduler, rate: float = 5, burst: int = 20, timeout: float = 60,
+                 max_timeout: float = 900, hold: str = 'drop', buffer_size: int = 10, metric_labels: dict = None,
+                 clock=time.monotonic):
+        if hold not in HOLD_POLICIES:
+            raise ValueError(f'hold must be one of {HOLD_POLICIES}, got "{hold}"')
+        self.__scheduler = scheduler
+        self.__clock = clock
+        self.__rate = rate
+        self.__burst = burst if rate > 0 else float('inf')  # rate 0 sends every command straight away
+        self.__tokens = float(self.__burst)
+        self.__refilled = clock()
+        self.__timeout = timeout
+        self.__max_timeout = max_timeout
+        self.__buffer_size = buffer_size if hold == 'buffer' else 0
+        self.__pending = {}     # flexy topic -> PendingRebirth
+        self.__queue = deque()  # PendingRebirth waiting for a token
+        self.__drain_call = None
+        self.__lock = threading.Lock()
+        self.__retries = metrics.registry.counter('flexy_bridge_rebirth_retries_total',
+                                                  'REBIRTH commands resent after a timeout')
+        self.__deduplicated = metrics.registry.counter('flexy_bridge_rebirth_deduplicated_total',
+                                                       'REBIRTH requests for a Flexy that already had one pending')
+        self.__held = metrics.registry.counter('flexy_bridge_rebirth_held_data_total',
+                                               'DATA received while a REBIRTH was pending', action='buffered')
+        self.__dropped = metrics.registry.counter('flexy_bridge_rebirth_held_data_total',
+                                                  'DATA received while a REBIRTH was pending', action='dropped')
+        metric_labels = metric_labels or {}
+        metrics.registry.gauge('flexy_bridge_rebirths_pending', 'Flexys with an unanswered REBIRTH',
+                               fn=lambda: len(self.__pending), **metric_labels)
+        metrics.registry.gauge('flexy_bridge_rebirths_queued', 'REBIRTH commands waiting for a token',
+                               fn=lambda: len(self.__queue), **metric_labels)
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def __contains__(self, flexy_topic: str):
+        return flexy_topic in self.__pending
+
+    def request(self, client, flexy_topic, reason: str, message=None) -> bool:
+        # True when a new REBIRTH was queued, False when one is already pending for the Flexy
+        with self.__lock:
+            pending = self.__pending.get(flexy_topic.flexy_topic)
+            new = pending is None
+            if new:
+                pending = PendingRebirth(flexy_topic, reason, self.__buffer_size)
+                self.__pending[flexy_topic.flexy_topic] = pending
+                self._enqueue(pending)
+            else:
+                self.__deduplicated.inc()
+            if message is not None:
+                pending.holding = True
+                self._hold(pending, message)
+            self._drain(client)
+        return new
+
+    def hold(self, flexy_topic: str, message) -> bool:
+        # Holds DATA for a Flexy whose cached aliases are stale, False lets the DATA through
+        with self.__lock:
+            pending = self.__pending.get(flexy_topic)
+            if pending is None or not pending.holding:
+                return False
+            self._hold(pending, message)
+        return True
+
+    def on_birth(self, flexy_topic: str) -> list:
+        # Clears the pending REBIRTH, returns the DATA messages held while waiting
+        with self.__lock:
+            pending = self._pop(flexy_topic)
+        return list(pending.held) if pending is not None and pending.held else []
+
+    def cancel(self, flexy_topic: str) -> bool:
+        # The Flexy is OFFLINE or DDEATHed, its REBIRTH is not retried and the held DATA is dropped.
+        # It asks for a new one when it comes back (STATE ONLINE or DATA)
+        with self.__lock:
+            pending = self._pop(flexy_topic)
+            if pending is None:
+                return False
+            if pending.held:
+                self.__dropped.inc(len(pending.held))
+        return True
+
+    def _pop(self, flexy_topic: str) -> PendingRebirth or None:
+        pending = self.__pending.pop(flexy_topic, None)
+        if pending is None:
+            return None
+        if pending.timeout_call is not None:
+            pending.timeout_call.cancel()
+        if pending.queued:
+            self.__queue.remove(pending)
+            pending.queued = False
+        return pending
+
+    def _hold(self, pending: PendingRebirth, message):
+        if pending.held is None:
+            self.__dropped.inc()
+            return
+        if len(pending.held) == pending.held.maxlen:
+            self.__dropped.inc()
+        pending.held.append(message)
+        self.__held.inc()
+
+    def _enqueue(self, pending: PendingRebirth):
+        pending.queued = True
+        self.__queue.append(pending)
+
+    def _refill(self):
+        now = self.__clock()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__refilled) * self.__rate)
+        self.__refilled = now
+
+    def _drain(self, client):
+        self._refill()
+        while self.__queue and self.__tokens >= 1:
+            pending = self.__queue.popleft()
+            pending.queued = False
+            self.__tokens -= 1
+            self._send(client, pending)
+        if self.__queue and self.__drain_call is None:
+            self.__drain_call = self.__scheduler.call_later((1 - self.__tokens) / self.__rate, self._drain_later,
+                                                            client)
+
+    def _drain_later(self, client):
+        with self.__lock:
+            self.__drain_call = None
+            self._drain(client)
+
+    def _send(self, client, pending: PendingRebirth):
+        client.publish(pending.topic.cmd_topic, b'REBIRTH')
+        rebirth_requests_counter(pending.reason).inc()
+        if pending.attempts:
+            self.__retries.inc()
+        timeout = min(self.__max_timeout, self.__timeout * 2 ** pending.attempts)
+        pending.attempts += 1
+        pending.timeout_call = self.__scheduler.call_later(timeout, self._on_timeout, client, pending)
+
+    def _on_timeout(self, client, pending: PendingRebirth):
+        with self.__lock:
+            if self.__pending.get(pending.topic.flexy_topic) is not pending:
+                return
+            logger.warning('rebirth_timeout', 'NO BIRTH FROM %s AFTER %s REBIRTH(S), RETRYING',
+                           pending.topic.flexy_topic, pending.attempts)
+            pending.timeout_call = None
+            self._enqueue(pending)
+            self._drain(client)
@@ -0,0 +1,166 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from pyapp.log import logger
+
+
+class ScheduledCall:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline: float, callback, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    # One daemon thread running timed callbacks from a heap, cancelled calls are skipped when they come due
+    def __init__(self, name: str = 'scheduler'):
+        self.__name = name
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def call_later(self, delay: float, callback, *args) -> ScheduledCall:
+        call = ScheduledCall(time.monotonic() + delay, callback, args)
+        with self.__condition:
+            heapq.heappush(self.__heap, (call.deadline, next(self.__counter), call))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self._run, name=self.__name, daemon=True)
+                self.__thread.start()
+            elif self.__heap[0][2] is call:
+                self.__condition.notify()
+        return call
+
+    def call_every(self, interval: float, callback, *args) -> ScheduledCall:
+        # The returned call stays valid across repeats, cancelling it stops the repetition
+        periodic = ScheduledCall(0, callback, args)
+
+        def run():
+            if periodic.cancelled:
+                return
+            try:
+                callback(*args)
+            finally:
+                if not periodic.cancelled:
+                    self.call_later(interval, run)
+
+        self.call_later(interval, run)
+        return periodic
+
+    def _run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    if not self.__heap:
+                        self.__condition.wait()
+                        continue
+                    timeout = self.__heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.__condition.wait(timeout)
+                _, _, call = heapq.heappop(self.__heap)
+            if call.cancelled:
+                continue
+            try:
+                call.callback(*call.args)
+            except Exception:
+                logger.error('scheduler_error', 'SCHEDULED CALL FAILED\n%s', traceback.format_exc().rstrip())
+
+
+class TimingWheel:
+    # Hierarchical timing wheel for many long lived timers, e.g. one liveness timer per Flexy. Adding or
+    # cancelling a timer is O(1) and each tick only touches the timers of one slot, timers further out than the
+    # lowest wheel wait in the coarser wheels and cascade down as their slot comes up.
+    # advance() does the work, call it every tick (Scheduler.call_every) rather than running a thread of its own.
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, clock=time.monotonic):
+        self.__tick = tick
+        self.__slots = slots
+        self.__clock = clock
+        # Level n slots are slots ** n ticks wide, timers past the top level are parked in its last slot
+        self.__wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.__widths = [slots ** level for level in range(levels)]
+        self.__start = clock()
+        self.__current = 0    # ticks processed since start
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def tick(self) -> float:
+        return self.__tick
+
+    def now(self) -> float:
+        return self.__clock()
+
+    def call_later(self, delay: float, callback, *args) -> ScheduledCall:
+        call = ScheduledCall(self.__clock() + delay, callback, args)
+        with self.__lock:
+            self._insert(call, self._ticks(call.deadline))
+            self.__count += 1
+        return call
+
+    def _ticks(self, deadline: float) -> int:
+        # Rounded up, a timer never fires before its deadline
+        return -int(-(deadline - self.__start) // self.__tick)
+
+    def _insert(self, call: ScheduledCall, expires: int):
+        expires = max(expires, self.__current + 1)
+        position = expires
+        for level, width in enumerate(self.__widths):
+            if expires - self.__current < width * self.__slots:
+                break
+        else:
+            position = self.__current + width * (self.__slots - 1)
+        self.__wheels[level][(position // width) % self.__slots].append((expires, call))
+
+    def advance(self) -> int:
+        # Runs the timers due up to now, returns how many ran
+        due = []
+        with self.__lock:
+            target = int((self.__clock() - self.__start) // self.__tick)
+            while self.__current < target:
+                self.__current += 1
+                current = self.__current
+                for level in range(len(self.__widths) - 1, 0, -1):
+                    width = self.__widths[level]
+                    if current % width == 0:
+                        slot = self.__wheels[level][(current // width) % self.__slots]
+                        cascaded = slot[:]
+                        slot.clear()
+                        for expires, call in cascaded:
+                            if call.cancelled:
+                                self.__count -= 1
+                            elif expires <= current:
+                                due.append(call)
+                            else:
+                                self._insert(call, expires)
+                slot = self.__wheels[0][current % self.__slots]
+                for expires, call in slot:
+                    if not call.cancelled:
+                        due.append(call)
+                    else:
+                        self.__count -= 1
+                slot.clear()
+            self.__count -= len(due)
+        for call in due:
+            if call.cancelled:
+                continue
+            try:
+                call.callback(*call.args)
+            except Exception:
+                logger.error('scheduler_error', 'TIMER FAILED\n%s', traceback.format_exc().rstrip())
+        return len(due)
@@ -0,0 +1,43 @@
+import zlib
+
+from pyapp import metrics
+
+
+def shard_for(flexy_serial: str, count: int) -> int:
+    # crc32 is stable across processes and Python versions, unlike hash() with PYTHONHASHSEED
+    return zlib.crc32(flexy_serial.encode()) % count
+
+
+class ShardFilter:
+    # Every shard receives the whole flexy_v1.0/# stream and keeps the Flexys whose serial hashes to its index.
+    # The check runs on the topic alone, before any payload is decoded, and is cached per topic
+    def __init__(self, index: int, count: int):
+        if not 0 <= index < count:
+            raise ValueError(f'shard index must be in [0, {count}), got {index}')
+        self.index = index
+        self.count = count
+        self.__owned = {}  # inbound topic -> bool
+        self.__skipped = metrics.registry.counter('flexy_bridge_shard_skipped_total',
+                                                  'Flexy messages belonging to another shard')
+
+    def owns_serial(self, flexy_serial: str) -> bool:
+        return shard_for(flexy_serial, self.count) == self.index
+
+    def owns(self, topic: str) -> bool:
+        owned = self.__owned.get(topic)
+        if owned is None:
+            topic_split = topic.split('/')
+            owned = len(topic_split) >= 4 and self.owns_serial(topic_split[3])
+            self.__owned[topic] = owned
+        return owned
+
+    def wrap(self, callback):
+        owns = self.owns
+        skipped = self.__skipped
+
+        def filtered(client, userdata, message):
+            if owns(message.topic):
+                callback(client, userdata, message)
+            else:
+                skipped.inc()
+        return filtered
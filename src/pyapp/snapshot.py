@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+import zlib
+
+from pyapp.log import logger
+
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path: str, state: dict) -> int:
+    # zlib compressed compact JSON, written to a temp file in the same directory and swapped in with os.replace
+    # so a crash mid write leaves the previous snapshot intact
+    data = zlib.compress(json.dumps(dict(state, v=SNAPSHOT_VERSION), separators=(',', ':')).encode(), 6)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+
+def read_snapshot(path: str) -> dict or None:
+    try:
+        with open(path, 'rb') as file:
+            state = json.loads(zlib.decompress(file.read()))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as err:
+        logger.warning('snapshot', 'SNAPSHOT "%s" UNREADABLE, STARTING COLD: %s', path, err)
+        return None
+    if state.get('v') != SNAPSHOT_VERSION:
+        logger.warning('snapshot', 'SNAPSHOT "%s" HAS VERSION %s, EXPECTED %s, STARTING COLD', path, state.get('v'),
+                       SNAPSHOT_VERSION)
+        return None
+    return state
@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+
+from pyapp.log import logger
+
+EVICTION_POLICIES = ('drop_oldest', 'drop_newest')
+
+
+class StoreAndForward:
+    # Append only SQLite (WAL) buffer of DDATA payloads encoded while the Sparkplug session is down.
+    # Payloads are stored without their seq field, it is appended when they are replayed.
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024, eviction: str = 'drop_oldest'):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f'eviction must be one of {EVICTION_POLICIES}, got "{eviction}"')
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__eviction = eviction
+        self.__lock = threading.Lock()
+        # Only one replay at a time, held while publishing, unlike __lock which is never held while calling out
+        self.__replay_lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS buffer ('
+                          'id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB NOT NULL)')
+        self.__count, self.__size = self.__db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(topic) + LENGTH(payload)), 0) FROM buffer').fetchone()
+        self.__stored = 0
+        self.__replayed = 0
+        self.__evicted = 0
+        self.__rejected = 0
+        if self.__count:
+            logger.info('store_forward', 'STORE AND FORWARD "%s": %s buffered message(s), %s bytes', path,
+                        self.__count, self.__size)
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def stats(self) -> dict:
+        return dict(count=self.__count, size=self.__size, stored=self.__stored, replayed=self.__replayed,
+                    evicted=self.__evicted, rejected=self.__rejected)
+
+    def store(self, topic: str, payload: bytes) -> bool:
+        record_size = len(topic) + len(payload)
+        with self.__lock:
+            if self.__size + record_size > self.__max_bytes:
+                if self.__eviction == 'drop_newest' or record_size > self.__max_bytes:
+                    self.__rejected += 1
+                    return False
+                self._evict(self.__size + record_size - self.__max_bytes)
+            self.__db.execute('INSERT INTO buffer (topic, payload) VALUES (?, ?)', (topic, payload))
+            self.__count += 1
+            self.__size += record_size
+            self.__stored += 1
+        return True
+
+    def _evict(self, free_bytes: int):
+        freed = 0
+        evicted = []
+        for row_id, record_size in self.__db.execute(
+                'SELECT id, LENGTH(topic) + LENGTH(payload) FROM buffer ORDER BY id'):
+            evicted.append(row_id)
+            freed += record_size
+            if freed >= free_bytes:
+                break
+        self._delete(evicted, freed)
+        self.__evicted += len(evicted)
+
+    def _delete(self, row_ids: list, freed: int):
+        if not row_ids:
+            return
+        self.__db.execute('DELETE FROM buffer WHERE id <= ?', (row_ids[-1],))
+        self.__count -= len(row_ids)
+        self.__size -= freed
+
+    def replay(self, publish, limit: int) -> int:
+        # publish(topic, payload) -> bool, replay stops at the first failed publish and keeps that message.
+        # The batch is published without holding the lock, publish may end up in store() (e.g. an outbound
+        # failure callback) on this or another thread
+        with self.__replay_lock:
+            with self.__lock:
+                rows = self.__db.execute('SELECT id, topic, payload FROM buffer ORDER BY id LIMIT ?',
+                                         (limit,)).fetchall()
+            last_published = None
+            for row_id, topic, payload in rows:
+                if not publish(topic, payload):
+                    break
+                last_published = row_id
+            if last_published is None:
+                return 0
+            with self.__lock:
+                # Rows evicted while the batch was out are already gone, only count the ones still there
+                deleted, freed = self.__db.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(LENGTH(topic) + LENGTH(payload)), 0) FROM buffer WHERE id <= ?',
+                    (last_published,)).fetchone()
+                self.__db.execute('DELETE FROM buffer WHERE id <= ?', (last_published,))
+                self.__count -= deleted
+                self.__size -= freed
+                self.__replayed += deleted
+                if not self.__count:
+                    self.__db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return deleted
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,112 @@
+import re
+
+from pyapp.protobuf import sparkplug_b_pb2
+
+TEMPLATE_DATATYPE = 19
+
+# Definition members are readOnly, instances only repeat the properties of writable members
+READ_ONLY_PROPERTIES = sparkplug_b_pb2.Payload.PropertySet()
+READ_ONLY_PROPERTIES.keys.extend(['Quality', 'readOnly'])
+READ_ONLY_PROPERTIES.values.add(type=3, int_value=192)
+READ_ONLY_PROPERTIES.values.add(type=11, boolean_value=True)
+
+
+class TemplateDefinition:
+    __slots__ = ('name', 'members')
+
+    def __init__(self, name: str, members: tuple):
+        self.name = name
+        self.members = members  # (member name, FlexyDataTypes) in the order of the first group seen
+
+    def fill_metric(self, metric):
+        # NBIRTH metric, member values are null in the definition
+        metric.name = self.name
+        metric.datatype = TEMPLATE_DATATYPE
+        metric.template_value.is_definition = True
+        for member, datatype in self.members:
+            member_metric = metric.template_value.metrics.add()
+            member_metric.name = member
+            member_metric.datatype = datatype.sparkplug_code
+            member_metric.is_null = True
+            member_metric.properties.CopyFrom(READ_ONLY_PROPERTIES)
+
+
+class TemplateInstance:
+    __slots__ = ('name', 'alias', 'template')
+
+    def __init__(self, name: str, alias: int, template: TemplateDefinition):
+        self.name = name          # Sparkplug name of the group, e.g. "client/iono2x/Pump1"
+        self.alias = alias
+        self.template = template
+
+
+class TemplateRegistry:
+    # Finds repeated tag groups in the Flexy BIRTHs. "Pump1.Speed", "Pump1.Status", "Pump2.Speed", "Pump2.Status"
+    # are two groups with the same members, published as one Template definition "Pump" in NBIRTH and two
+    # instances in the DBIRTH. Groups are the names sharing everything up to the last "/" after the device prefix.
+    def __init__(self, min_instances: int = 2, min_members: int = 2):
+        self.__min_instances = min_instances  # groups a device needs before its signature becomes a template
+        self.__min_members = min_members
+        self.__definitions = {}               # signature -> TemplateDefinition, in the order they were found
+        self.__names = set()
+        self.__birth_payload = sparkplug_b_pb2.Payload()  # the definitions encoded once, for every NBIRTH
+
+    def __len__(self):
+        return len(self.__definitions)
+
+    @property
+    def definitions(self) -> list:
+        return list(self.__definitions.values())
+
+    def birth_metrics(self, timestamp: int) -> list:
+        # SparkplugNode birth metric provider
+        metrics = self.__birth_payload.metrics
+        for metric in metrics:
+            metric.timestamp = timestamp
+        return metrics
+
+    def assign(self, name_prefix: str, metrics: list) -> dict:
+        # metrics: (alias, Sparkplug name, FlexyDataTypes, ...) tuples of one device
+        # Returns Sparkplug name -> (TemplateInstance, member name) for the metrics that go into an instance
+        groups = {}
+        for metric in metrics:
+            name, datatype = metric[1], metric[2]
+            group, _, member = name.rpartition('/')
+            if len(group) < len(name_prefix) or not member:
+                continue
+            groups.setdefault(group, []).append((member, datatype))
+
+        signatures = {}
+        for group, members in groups.items():
+            if len(members) < self.__min_members:
+                continue
+            signature = tuple(sorted((member, datatype.name) for member, datatype in members))
+            signatures.setdefault(signature, []).append(group)
+
+        assigned = {}
+        # Instances need aliases of their own, numbered after the Flexy tag IDs used as metric aliases
+        instance_alias = max((int(metric[0]) for metric in metrics), default=0) + 1
+        for signature, group_names in signatures.items():
+            definition = self.__definitions.get(signature)
+            if definition is None:
+                if len(group_names) < self.__min_instances:
+                    continue
+                definition = TemplateDefinition(self._definition_name(group_names[0]), tuple(groups[group_names[0]]))
+                self.__definitions[signature] = definition
+                definition.fill_metric(self.__birth_payload.metrics.add())
+            for group in group_names:
+                instance = TemplateInstance(group, instance_alias, definition)
+                instance_alias += 1
+                for member, _ in groups[group]:
+                    assigned[f'{group}/{member}'] = (instance, member)
+        return assigned
+
+    def _definition_name(self, group: str) -> str:
+        # "Pump1" -> "Pump", "Line_2" -> "Line", numbered when a different signature already took the name
+        base = re.sub(r'[\W_]*\d+$', '', group.rsplit('/', 1)[-1]) or 'Group'
+        name, number = base, 1
+        while name in self.__names:
+            number += 1
+            name = f'{base}_{number}'
+        self.__names.add(name)
+        return name
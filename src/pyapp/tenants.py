@@ -0,0 +1,234 @@
+import atexit
+import json
+import os
+import select
+import socket
+import time
+
+import paho.mqtt.client as mqtt
+
+from pyapp import config
+from pyapp import ewon_translate
+from pyapp import metrics
+from pyapp.log import logger
+from pyapp.ewon_translate import SparkplugNode, TrackedClient, make_flexy_node, make_outbound
+from pyapp.scheduler import Scheduler
+from pyapp.snapshot import read_snapshot, write_snapshot
+
+
+def tenant_path(path: str or None, group_id: str, edge_node_id: str) -> str or None:
+    # Files a node must not share with the others, suffixed with its ids like shards.py does with the shard index
+    if not path:
+        return None
+    root, ext = os.path.splitext(path)
+    return f'{root}-{group_id}-{edge_node_id}{ext}'
+
+
+def parse_route(route: str) -> tuple:
+    # "<client id>/<iono2x serial>", the 2nd and 3rd segments of the Flexy topics, "+" matches any value
+    segments = tuple(route.split('/'))
+    if len(segments) != 2 or not all(segments) or any('#' in segment for segment in segments):
+        raise ValueError(f'Flexy route must be "<client id>/<iono2x serial>" with optional "+", got "{route}"')
+    return segments
+
+
+def routes_overlap(first: tuple, second: tuple) -> bool:
+    return all(a == b or '+' in (a, b) for a, b in zip(first, second))
+
+
+class Tenant:
+    # One hosted edge node: its SparkplugNode (bdSeq, seq, topics), translator and MQTT connection.
+    # The connection is its own because the NDEATH has to be the Will of the connection that sent the NBIRTH,
+    # and the broker routes it the Flexys of its routes through the subscriptions, nothing is filtered here
+    def __init__(self, group_id: str, edge_node_id: str, routes: list, scheduler: Scheduler,
+                 client_id: str = None, writable_tags: list = None):
+        self.routes = routes
+        self.name = f'{group_id}/{edge_node_id}'
+        self.__scheduler = scheduler
+        self.__snapshot_path = tenant_path(config.SNAPSHOT_PATH, group_id, edge_node_id)
+        snapshot = read_snapshot(self.__snapshot_path) if self.__snapshot_path else None
+        labels = {'group': group_id, 'edge_node': edge_node_id}
+        self.sparkplug_node = SparkplugNode(group_id=group_id, node_id=edge_node_id,
+                                            bd_seq_start=(snapshot['bd_seq'] + 1) % 256 if snapshot else None)
+        self.outbound = make_outbound(self.sparkplug_node, metric_labels=labels)
+        if writable_tags is None:
+            writable_tags = config.WRITABLE_TAGS
+        self.flexy_node = make_flexy_node(self.sparkplug_node, scheduler, outbound=self.outbound,
+                                          store_path=tenant_path(config.STORE_FORWARD_PATH, group_id, edge_node_id),
+                                          writable_tags=writable_tags, metric_labels=labels)
+        if snapshot:
+            logger.info('snapshot', 'SNAPSHOT "%s" RESTORED: %s device(s), bdSeq %s', self.__snapshot_path,
+                        self.flexy_node.restore_state(snapshot), self.sparkplug_node.bd_seq.current_value)
+
+        self.client = TrackedClient(client_id=client_id or f'{group_id}__{edge_node_id}', protocol=mqtt.MQTTv311)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        if self.outbound is not None:
+            self.client.on_publish = self.outbound.on_publish
+        for subscription, callback_name, handler in self.flexy_node.message_callbacks():
+            # Shared pipeline, capture and callback metrics, the hash shard filter does not apply to tenants
+            self.client.message_callback_add(subscription, ewon_translate.message_callback(callback_name, handler))
+
+        metrics.registry.gauge('flexy_bridge_mqtt_out_queue', 'Packets waiting in the paho outgoing queue',
+                               fn=lambda: self.client.pending_publishes, **labels)
+        if self.flexy_node.store is not None:
+            metrics.registry.gauge('flexy_bridge_store_forward_messages', 'DDATA buffered for replay',
+                                   fn=lambda: len(self.flexy_node.store), **labels)
+        if config.METRICS_NDATA_SECONDS > 0:
+            self.sparkplug_node.add_node_metrics(
+                lambda: ewon_translate.bridge_node_metrics(self.flexy_node, self.client))
+
+    @property
+    def subscriptions(self) -> list:
+        return [f'flexy_v1.0/{client_id}/{iono2x_serial}/#' for client_id, iono2x_serial in self.routes]
+
+    def save_snapshot(self):
+        try:
+            write_snapshot(self.__snapshot_path, dict(bd_seq=self.sparkplug_node.bd_seq.current_value,
+                                                      **self.flexy_node.snapshot_state()))
+        except Exception as err:
+            logger.error('snapshot', 'SNAPSHOT "%s" WRITE FAILED: %s', self.__snapshot_path, err)
+
+    def on_connect(self, client, userdata, flags, rc):
+        logger.info('connected', '%s CONNECTED, SUBSCRIBING TO TOPICS', self.name)
+        for topic in self.subscriptions:
+            client.subscribe(topic)
+        client.subscribe(self.sparkplug_node.ncmd_topic)
+        for device_id in self.flexy_node.flexy_device_ids:
+            client.subscribe(self.sparkplug_node.dcmd_topic(device_id))
+        self.flexy_node.publish_birth(client, self.sparkplug_node.bd_seq.current_value)
+
+    def on_disconnect(self, client, userdata, rc):
+        logger.warning('disconnected', '%s DISCONNECTED', self.name, rc=rc)
+        client.forget_pending()
+        client.will_set(topic=self.sparkplug_node.ndeath_topic,
+                        payload=self.sparkplug_node.ndeath_payload(self.sparkplug_node.bd_seq.next_value()))
+        self.sparkplug_node.on_disconnect()
+        if self.outbound is not None:
+            self.outbound.reset()
+        if self.__snapshot_path:
+            self.__scheduler.call_later(0, self.save_snapshot)
+
+    def start(self):
+        # Only prepares the connection, NetworkLoop connects it
+        self.client.username_pw_set(username=config.MQTT_USERNAME, password=config.MQTT_PASSWORD)
+        if config.MQTT_USE_TLS:
+            self.client.tls_set(cert_reqs=mqtt.ssl.CERT_REQUIRED)
+        self.client.will_set(topic=self.sparkplug_node.ndeath_topic,
+                             payload=self.sparkplug_node.ndeath_payload(self.sparkplug_node.bd_seq.current_value))
+        self.client.connect_async(host=config.MQTT_HOST, port=config.MQTT_PORT)
+        if config.METRICS_NDATA_SECONDS > 0:
+            self.__scheduler.call_every(config.METRICS_NDATA_SECONDS, self.flexy_node.publish_node_data, self.client)
+        if self.__snapshot_path:
+            self.__scheduler.call_every(config.SNAPSHOT_SECONDS, self.save_snapshot)
+            atexit.register(self.save_snapshot)
+
+
+def load_tenants(path: str, scheduler: Scheduler) -> list:
+    # {"tenants": [{"group_id": "plant_a", "edge_node_id": "bridge_a", "flexys": ["site_a/+"],
+    #               "mqtt_client_id": "...", "writable_tags": ["*/Setpoints/*"]}, ...]}
+    with open(path) as tenants_file:
+        data = json.load(tenants_file)
+    tenants = []
+    owners = []  # (route, tenant name), a Flexy must belong to one node only
+    for entry in data['tenants']:
+        name = f'{entry["group_id"]}/{entry["edge_node_id"]}'
+        routes = [parse_route(route) for route in entry['flexys']]
+        for route in routes:
+            for owned, owner in owners:
+                if routes_overlap(route, owned):
+                    raise ValueError(f'Flexy route "{"/".join(route)}" of {name} overlaps "{"/".join(owned)}" '
+                                     f'of {owner}')
+        if any(tenant.name == name for tenant in tenants):
+            raise ValueError(f'Edge node {name} is configured twice')
+        owners.extend((route, name) for route in routes)
+        tenants.append(Tenant(entry['group_id'], entry['edge_node_id'], routes, scheduler,
+                              client_id=entry.get('mqtt_client_id'), writable_tags=entry.get('writable_tags')))
+    logger.info('tenants', 'TENANTS LOADED FROM "%s": %s edge node(s)', path, len(tenants))
+    return tenants
+
+
+class NetworkLoop:
+    # Runs the network side of many paho clients on one thread with select(), where loop_forever() needs a
+    # thread per client. Publishes from other threads only queue their packet and wake the loop through a socket
+    # pair, the loop writes it. Dropped connections are retried with a backoff doubling up to max_delay seconds
+    def __init__(self, clients: list, timeout: float = 1.0, max_delay: float = 120):
+        self.__clients = clients
+        self.__timeout = timeout
+        self.__max_delay = max_delay
+        self.__wake_read, self.__wake_write = socket.socketpair()
+        self.__wake_read.setblocking(False)
+        self.__wake_write.setblocking(False)
+        self.__retry_at = {client: 0 for client in clients}  # monotonic time of the next connect attempt
+        self.__delays = {client: 1 for client in clients}
+        for client in clients:
+            client.on_socket_register_write = self._wake
+
+    def _wake(self, client, userdata, sock):
+        try:
+            self.__wake_write.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _connect(self, client, now: float):
+        delay = self.__delays[client]
+        self.__retry_at[client] = now + delay
+        self.__delays[client] = min(delay * 2, self.__max_delay)
+        try:
+            client.reconnect()
+        except OSError as err:
+            logger.warning('connect_failed', 'MQTT CONNECT %s FAILED, RETRY IN %ss: %s', client.client_id,
+                           delay, err)
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            sockets = {}
+            readable, writable = [self.__wake_read], []
+            timeout = self.__timeout
+            for client in self.__clients:
+                sock = client.socket()
+                if sock is None and now >= self.__retry_at[client]:
+                    self._connect(client, now)
+                    sock = client.socket()
+                if sock is None:
+                    timeout = min(timeout, max(0.0, self.__retry_at[client] - now))
+                    continue
+                if client.is_connected():
+                    self.__delays[client] = 1
+                sockets[sock] = client
+                readable.append(sock)
+                if client.want_write():
+                    writable.append(sock)
+                if getattr(sock, 'pending', None) and sock.pending():
+                    # TLS data already decrypted into the socket buffer, select() would not report it
+                    timeout = 0
+
+            ready_read, ready_write, _ = select.select(readable, writable, [], timeout)
+            if self.__wake_read in ready_read:
+                try:
+                    self.__wake_read.recv(4096)
+                except BlockingIOError:
+                    pass
+            for sock, client in sockets.items():
+                if sock in ready_read or (getattr(sock, 'pending', None) and sock.pending()):
+                    client.loop_read()
+                if sock in ready_write and client.socket() is sock:
+                    client.loop_write()
+                client.loop_misc()
+
+
+def start():
+    tenants = load_tenants(config.TENANTS_FILE, ewon_translate.scheduler)
+    # One scheduler, pipeline, capture and metrics endpoint shared by every node
+    if ewon_translate.pipeline is not None:
+        ewon_translate.pipeline.start()
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT)
+    if ewon_translate.capture is not None:
+        logger.info('capture', 'CAPTURING INBOUND MESSAGES TO "%s"', ewon_translate.capture.path)
+        ewon_translate.scheduler.call_every(1, ewon_translate.capture.flush)
+        atexit.register(ewon_translate.capture.close)
+    for tenant in tenants:
+        tenant.start()
+    NetworkLoop([tenant.client for tenant in tenants]).run()
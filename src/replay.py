@@ -0,0 +1,160 @@
+# Feeds a capture (CAPTURE_FILE) through FlexyTranslatorNode with a fake MQTT client and diffs the output.
+#   python replay.py capture.bin --write-golden golden.bin     record the current output
+#   python replay.py capture.bin --golden golden.bin           check a change against it
+#   python replay.py capture.bin --speed 1                     replay at the original rate
+import argparse
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import time
+
+from google.protobuf.json_format import MessageToDict
+
+from pyapp import config
+from pyapp import ewon_translate
+from pyapp.capture import CaptureWriter, read_capture
+from pyapp.ewon_translate import SparkplugNode, FlexyTranslatorNode, encode_seq
+from pyapp.fake_mqtt import FakeMqttClient
+from pyapp.log import logger
+from pyapp.outbound import OutboundScheduler
+from pyapp.protobuf import sparkplug_b_pb2
+from pyapp.rbe import RbeEngine
+from pyapp.rebirth import RebirthScheduler
+from pyapp.scheduler import Scheduler
+
+
+class ReplayClock:
+    # Stands in for ewon_translate.millis, time follows the arrival times in the capture so the output is repeatable
+    def __init__(self):
+        self.now_ms = 0
+
+    def __call__(self) -> int:
+        return self.now_ms
+
+
+def describe(topic: str, payload: bytes) -> str:
+    if topic.startswith('spBv1.0/') and payload:
+        spb_payload = sparkplug_b_pb2.Payload()
+        try:
+            spb_payload.ParseFromString(payload)
+            return f'{topic} {MessageToDict(spb_payload)}'
+        except Exception:
+            pass
+    return f'{topic} {payload!r}'
+
+
+def replay(args) -> tuple:
+    clock = ReplayClock()
+    ewon_translate.millis = clock
+    scheduler = Scheduler(name='replay')
+    sparkplug_node = SparkplugNode(group_id=args.group_id, node_id=args.node_id)
+    # FakeMqttClient confirms every publish straight away, the output only differs when the window is too small
+    outbound = OutboundScheduler(sparkplug_node.sequence, encode_seq, window=args.outbound_window) \
+        if args.outbound_window else None
+    # Rebirth rate limiting depends on wall clock time, replay sends every REBIRTH straight away
+    flexy_node = FlexyTranslatorNode(sparkplug_node=sparkplug_node, direct_encoding=args.encoding == 'direct',
+                                     scheduler=scheduler,
+                                     rbe=RbeEngine.from_file(args.rbe_policy,
+                                                             suppress_identical=config.RBE_SUPPRESS_IDENTICAL),
+                                     rebirths=RebirthScheduler(scheduler, rate=0), writable_tags=config.WRITABLE_TAGS,
+                                     outbound=outbound)
+    client = FakeMqttClient(keep_published=True)
+    if outbound is not None:
+        client.on_publish = outbound.on_publish
+    for subscription, _, handler in flexy_node.message_callbacks():
+        client.message_callback_add(subscription, handler)
+
+    messages = read_capture(args.capture)
+    delivered = 0
+    started = time.perf_counter()
+    first_arrival = None
+    sink = open(os.devnull, 'w') if not args.show_output else None
+    profiler = cProfile.Profile() if args.profile else None
+    with contextlib.redirect_stdout(sink) if sink else contextlib.nullcontext():
+        if profiler is not None:
+            profiler.enable()
+        try:
+            for message in messages:
+                if first_arrival is None:
+                    first_arrival = message.timestamp
+                    clock.now_ms = int(message.timestamp * 1000)
+                    # The session comes up with the first message, as on_connect would publish it
+                    flexy_node.publish_birth(client, 0)
+                if args.speed > 0:
+                    delay = (message.timestamp - first_arrival) / args.speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                clock.now_ms = int(message.timestamp * 1000)
+                client.deliver(message.topic, message.payload, retain=message.retain, timestamp=message.timestamp)
+                delivered += 1
+        except ValueError as err:
+            print(f'CAPTURE READ STOPPED: {err}', file=sys.__stderr__)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            # Entries still buffered go to the same place as the ones already written
+            logger.flush()
+    if sink:
+        sink.close()
+    elapsed = time.perf_counter() - started
+
+    print(f'replayed {delivered} message(s) in {elapsed:.3f}s '
+          f'({delivered / elapsed if elapsed else 0:.0f} msg/s), {len(client.published)} published')
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.profile)
+    return client.published, clock
+
+
+def diff(published: list, golden_path: str, max_diffs: int) -> int:
+    golden = [(message.topic, message.payload) for message in read_capture(golden_path)]
+    differences = 0
+    for index in range(max(len(published), len(golden))):
+        actual = published[index] if index < len(published) else None
+        expected = golden[index] if index < len(golden) else None
+        if actual == expected:
+            continue
+        differences += 1
+        if differences <= max_diffs:
+            print(f'#{index}')
+            print(f'  expected: {describe(*expected) if expected else "<nothing>"}')
+            print(f'  actual:   {describe(*actual) if actual else "<nothing>"}')
+    if differences > max_diffs:
+        print(f'... {differences - max_diffs} more difference(s)')
+    print(f'{differences} difference(s) against {golden_path} ({len(golden)} golden, {len(published)} published)')
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a captured MQTT stream through the translator')
+    parser.add_argument('capture', help='file written with CAPTURE_FILE')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='0 replays as fast as possible, 1 at the captured rate, 2 twice as fast...')
+    parser.add_argument('--golden', help='capture format file with the expected output, differences exit with 1')
+    parser.add_argument('--write-golden', help='write the output to this file')
+    parser.add_argument('--max-diffs', type=int, default=10)
+    parser.add_argument('--encoding', choices=('direct', 'parse_dict'), default='direct')
+    parser.add_argument('--group-id', default=config.SPARKPLUG_GROUP_ID or 'replay')
+    parser.add_argument('--node-id', default=config.SPARKPLUG_EDGE_NODE_ID or 'replay')
+    parser.add_argument('--rbe-policy', default=config.RBE_POLICY_FILE)
+    parser.add_argument('--outbound-window', type=int, default=config.OUTBOUND_WINDOW,
+                        help='publish through the outbound scheduler, 0 publishes directly')
+    parser.add_argument('--profile', type=int, nargs='?', const=25, default=0,
+                        help='profile the replay and print the top N functions')
+    parser.add_argument('--show-output', action='store_true', help='keep the translator print output')
+    args = parser.parse_args()
+
+    published, clock = replay(args)
+    if args.write_golden:
+        writer = CaptureWriter(args.write_golden)
+        for topic, payload in published:
+            writer.record(topic, payload, timestamp=clock.now_ms / 1000)
+        writer.close()
+        print(f'golden output written to {args.write_golden}')
+    if args.golden and diff(published, args.golden, args.max_diffs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
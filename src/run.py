@@ -1,7 +1,10 @@
+from pyapp import config
 from pyapp.ewon_translate import start
 from logging import warning
 
 warning('run.py called')
 if __name__ == '__main__':
     warning('STARTING NODE')
-    start()
\ No newline at end of file
+    if config.TENANTS_FILE:
+        from pyapp.tenants import start
+    start()
@@ -0,0 +1,74 @@
+# Runs SHARD_COUNT translator processes on this host, each one a separate Sparkplug edge node.
+#   SHARD_COUNT=4 python shards.py
+# Shard i gets SHARD_INDEX=i, its own snapshot/store files and metrics port, and is restarted if it exits.
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Files a shard must not share with the others, suffixed with the shard index
+PER_SHARD_PATHS = ('SNAPSHOT_PATH', 'STORE_FORWARD_PATH')
+
+
+def shard_env(index: int, count: int) -> dict:
+    env = dict(os.environ, SHARD_INDEX=str(index), SHARD_COUNT=str(count))
+    for name in PER_SHARD_PATHS:
+        if env.get(name):
+            root, ext = os.path.splitext(env[name])
+            env[name] = f'{root}-{index}{ext}'
+    if int(env.get('METRICS_PORT') or 0):
+        env['METRICS_PORT'] = str(int(env['METRICS_PORT']) + index)
+    if env.get('MQTT_CLIENT_ID'):
+        env['MQTT_CLIENT_ID'] = f'{env["MQTT_CLIENT_ID"]}-{index}'
+    return env
+
+
+def spawn(index: int, count: int) -> subprocess.Popen:
+    print(f'STARTING SHARD {index}/{count}')
+    return subprocess.Popen([sys.executable, 'run.py'], env=shard_env(index, count),
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the translator as N hash sharded edge nodes')
+    parser.add_argument('--count', type=int, default=int(os.environ.get('SHARD_COUNT', 2)))
+    parser.add_argument('--restart-delay', type=float, default=5, help='seconds before restarting an exited shard')
+    args = parser.parse_args()
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    shards = [spawn(index, args.count) for index in range(args.count)]
+    restart_at = {}
+    while not stopping:
+        time.sleep(0.5)
+        for index, process in enumerate(shards):
+            if process.poll() is None:
+                continue
+            if index not in restart_at:
+                print(f'SHARD {index} EXITED WITH {process.returncode}, RESTARTING IN {args.restart_delay}s')
+                restart_at[index] = time.monotonic() + args.restart_delay
+            elif time.monotonic() >= restart_at[index]:
+                del restart_at[index]
+                shards[index] = spawn(index, args.count)
+
+    for process in shards:
+        if process.poll() is None:
+            process.terminate()
+    for process in shards:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import os
+import random
+import sys
+
+import paho.mqtt.client as mqtt
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import make_birth, make_data  # noqa: E402
+from pyapp.ewon_translate import FlexyTranslatorNode, SparkplugNode, encode_seq  # noqa: E402
+from pyapp.fake_mqtt import FakeMqttClient, FakePublishInfo  # noqa: E402
+from pyapp.outbound import OutboundScheduler  # noqa: E402
+from pyapp.protobuf import sparkplug_b_pb2  # noqa: E402
+from pyapp.scheduler import ScheduledCall, Scheduler  # noqa: E402
+from pyapp.store_forward import StoreAndForward  # noqa: E402
+
+TAGS = 20
+BIRTH_TIMESTAMP = 1_700_000_000
+
+
+class FlakyClient(FakeMqttClient):
+    # Connected, but refuses publishes while refuse is set, like paho when the socket drops between packets
+    def __init__(self):
+        super().__init__(keep_published=True)
+        self.refuse = False
+
+    def publish(self, topic: str, payload: bytes = None, qos: int = 0, retain: bool = False):
+        if self.refuse:
+            return FakePublishInfo(mqtt.MQTT_ERR_NO_CONN, 0)
+        return super().publish(topic, payload, qos=qos, retain=retain)
+
+
+class FakeScheduler:
+    # Scheduler on a clock the test moves, also the clock itself: advance() runs the calls that come due in order
+    def __init__(self):
+        self.now = 0.0
+        self.__heap = []
+        self.__counter = itertools.count()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def __len__(self):
+        return sum(1 for _, _, call in self.__heap if not call.cancelled)
+
+    def call_later(self, delay: float, callback, *args) -> ScheduledCall:
+        call = ScheduledCall(self.now + delay, callback, args)
+        heapq.heappush(self.__heap, (call.deadline, next(self.__counter), call))
+        return call
+
+    def call_every(self, interval: float, callback, *args) -> ScheduledCall:
+        periodic = ScheduledCall(0, callback, args)
+
+        def run():
+            if not periodic.cancelled:
+                callback(*args)
+                self.call_later(interval, run)
+
+        self.call_later(interval, run)
+        return periodic
+
+    def advance(self, seconds: float):
+        target = self.now + seconds
+        while self.__heap and self.__heap[0][0] <= target:
+            deadline, _, call = heapq.heappop(self.__heap)
+            self.now = max(self.now, deadline)
+            if not call.cancelled:
+                call.callback(*call.args)
+        self.now = target
+
+
+class Bridge:
+    # A translator on a fake client with one Flexy born, optionally with store and forward and outbound scheduler
+    def __init__(self, tmp_path, store: bool = True, window: int = 0, max_bytes: int = 10 * 1024 * 1024,
+                 client: FakeMqttClient = None, scheduler=None, **translator_args):
+        self.client = client or FlakyClient()
+        self.sparkplug_node = SparkplugNode('group', 'node')
+        self.outbound = OutboundScheduler(self.sparkplug_node.sequence, encode_seq, window=window) if window else None
+        if self.outbound is not None:
+            self.client.on_publish = self.outbound.on_publish
+        self.store = StoreAndForward(str(tmp_path / 'store.db'), max_bytes=max_bytes) if store else None
+        self.translator = FlexyTranslatorNode(self.sparkplug_node, store=self.store, outbound=self.outbound,
+                                              scheduler=scheduler if scheduler is not None else Scheduler(),
+                                              **translator_args)
+        self.rnd = random.Random(1)
+        birth, self.datatypes = make_birth(self.rnd, 0, TAGS, [('float', 1)], BIRTH_TIMESTAMP)
+        self.translator.process_flexy_birth_message(self.client, None, birth)
+        self.topic = birth.topic[:-len('/BIRTH')]
+
+    def data(self, timestamp: int, changed: int = 2):
+        self.translator.process_flexy_data_message(
+            self.client, None, make_data(self.rnd, 0, self.datatypes, changed, timestamp))
+
+    def published(self, message_type: str) -> list:
+        # Decoded payloads published on topics of message_type (DDATA, DBIRTH...), in publish order
+        payloads = []
+        for topic, payload in self.client.published:
+            if topic.split('/')[2] == message_type:
+                sp_payload = sparkplug_b_pb2.Payload()
+                sp_payload.ParseFromString(payload)
+                payloads.append(sp_payload)
+        return payloads
+
+
+@pytest.fixture
+def fake_scheduler():
+    return FakeScheduler()
+
+
+@pytest.fixture
+def bridge(tmp_path):
+    return lambda **kwargs: Bridge(tmp_path, **kwargs)
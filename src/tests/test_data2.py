@@ -0,0 +1,33 @@
+import pytest
+
+from pyapp.ewon_translate import FlexyTranslatorNode
+from pyapp.fake_mqtt import FakeMessage
+
+
+@pytest.mark.parametrize('payload', [b'', b'5', b'5;', b'5;x', b'x;2', b'5;2;1', b'5;2;1,1;3,1', b'5;2;0,1',
+                                     b'\xff\xfe'])
+def test_decode_rejects_malformed_payloads(payload):
+    assert FlexyTranslatorNode.decode_flexy_data2(payload) is None
+
+
+def test_decode():
+    assert FlexyTranslatorNode.decode_flexy_data2(b'5;3;1,1.5;3,abc') == (5, 3, [1, 3], ['1.5', 'abc'])
+    assert FlexyTranslatorNode.decode_flexy_data2(b'5;3') == (5, 3, [], [])
+
+
+@pytest.mark.parametrize('payload', [b'', b'5', b'1700000001;20;2,', b'1700000001;20;2,abc'])
+def test_malformed_data2_does_not_raise(bridge, payload):
+    node = bridge(store=False)
+    node.translator.process_flexy_data2_message(node.client, None, FakeMessage(node.topic + '/DATA2', payload))
+    assert node.published('DDATA') == []
+
+
+def test_bad_value_is_skipped_and_the_rest_published(bridge):
+    node = bridge(store=False)
+    payload = b'1700000001;20;1,abc;2,12.5;3,nan;4,'
+    node.translator.process_flexy_data2_message(node.client, None, FakeMessage(node.topic + '/DATA2', payload))
+    ddata = node.published('DDATA')
+    assert len(ddata) == 1
+    # Float tags: "nan" is a float, "abc" and "" are not
+    assert sorted(metric.alias for metric in ddata[0].metrics) == [2, 3]
+    assert [metric.double_value for metric in ddata[0].metrics if metric.alias == 2] == [12.5]
@@ -0,0 +1,78 @@
+from bench import flexy_topic, make_birth
+from conftest import BIRTH_TIMESTAMP
+from pyapp.ewon_translate import DCMD_REJECTED
+from pyapp.fake_mqtt import FakeMessage
+from pyapp.protobuf import sparkplug_b_pb2
+
+
+def dcmd(node, index: int, *metrics) -> FakeMessage:
+    # metrics: (alias, value field, value, datatype) tuples, datatype 0 leaves it unset
+    payload = sparkplug_b_pb2.Payload()
+    for alias, value_key, value, datatype in metrics:
+        metric = payload.metrics.add()
+        metric.alias = alias
+        if datatype:
+            metric.datatype = datatype
+        setattr(metric, value_key, value)
+    return FakeMessage(node.sparkplug_node.dcmd_topic(f'flexy_{index:05d}'), payload.SerializeToString())
+
+
+def writes(node, index: int) -> list:
+    return [payload.decode() for topic, payload in node.client.published if topic == flexy_topic(index) + '/CMD']
+
+
+def integer_bridge(bridge, **kwargs):
+    # Flexy 0 has float tags (bridge fixture), Flexy 1 integer tags
+    node = bridge(store=False, **kwargs)
+    birth, _ = make_birth(node.rnd, 1, 4, [('integer', 1)], BIRTH_TIMESTAMP)
+    node.translator.process_flexy_birth_message(node.client, None, birth)
+    return node
+
+
+def test_write_signed_integers(bridge):
+    node = integer_bridge(bridge, writable_tags=['*'])
+    node.translator.process_dcmd_message(node.client, None, dcmd(
+        node, 1,
+        (1, 'long_value', 2 ** 64 - 5, 4),      # Int64 -5
+        (2, 'int_value', 2 ** 32 - 7, 3),       # Int32 -7
+        (3, 'int_value', 0xff, 1),              # Int8 -1
+        (4, 'long_value', 2 ** 64 - 2, 0)))     # no datatype, the BIRTH says Int64
+    assert writes(node, 1) == ['WRITE;4;1,-5;2,-7;3,-1;4,-2']
+
+
+def test_write_unsigned_bool_and_float(bridge):
+    node = integer_bridge(bridge, writable_tags=['*'])
+    node.translator.process_dcmd_message(node.client, None, dcmd(
+        node, 1,
+        (1, 'long_value', 2 ** 64 - 5, 8),      # UInt64 stays as is
+        (2, 'boolean_value', True, 11),
+        (3, 'double_value', -1.5, 10),
+        (4, 'string_value', '42', 12)))
+    assert writes(node, 1) == [f'WRITE;4;1,{2 ** 64 - 5};2,1;3,-1.5;4,42.0']
+
+
+def test_write_rejects_non_finite_and_non_numeric(bridge):
+    node = integer_bridge(bridge, writable_tags=['*'])
+    rejected = DCMD_REJECTED.value
+    node.translator.process_dcmd_message(node.client, None, dcmd(
+        node, 0,
+        (1, 'double_value', float('nan'), 10),
+        (2, 'float_value', float('inf'), 9),
+        (3, 'string_value', 'nan', 12),
+        (4, 'string_value', '1e400', 12),
+        (5, 'string_value', 'open', 12),
+        (6, 'double_value', 2.5, 10)))
+    assert writes(node, 0) == ['WRITE;1;6,2.5']
+    assert DCMD_REJECTED.value == rejected + 5
+
+
+def test_write_rejects_read_only_tags(bridge):
+    node = integer_bridge(bridge, writable_tags=['*/Tag1'])
+    rejected = DCMD_REJECTED.value
+    # Alias 1 is Tag0, read only, alias 99 is not in the BIRTH
+    node.translator.process_dcmd_message(node.client, None, dcmd(node, 1, (1, 'long_value', 1, 4)))
+    node.translator.process_dcmd_message(node.client, None, dcmd(node, 1, (99, 'long_value', 1, 4)))
+    assert writes(node, 1) == []
+    assert DCMD_REJECTED.value == rejected + 2
+    node.translator.process_dcmd_message(node.client, None, dcmd(node, 1, (2, 'long_value', 1, 4)))
+    assert writes(node, 1) == ['WRITE;1;2,1']
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from bench import flexy_topic
+from pyapp.fake_mqtt import FakeMessage
+
+
+def signed(value: int) -> int:
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+def flexy_message(kind: str, metrics: list, timestamp: int) -> FakeMessage:
+    return FakeMessage(f'{flexy_topic(1)}/{kind}', json.dumps({'t': timestamp, 'm': metrics}).encode())
+
+
+@pytest.mark.parametrize('direct_encoding', [True, False])
+def test_negative_integer_tags(bridge, direct_encoding):
+    node = bridge(store=False, direct_encoding=direct_encoding)
+    node.translator.process_flexy_birth_message(node.client, None, flexy_message('BIRTH', [
+        {'n': 'Level', 'a': '1', 't': 'integer', 'v': '-5'},
+        {'n': 'Count', 'a': '2', 't': 'integer', 'v': '3'}], 1_700_000_000))
+    dbirth = node.published('DBIRTH')[-1]
+    assert [signed(metric.long_value) for metric in dbirth.metrics if metric.alias] == [-5, 3]
+
+    node.translator.process_flexy_data_message(node.client, None, flexy_message('DATA', [
+        {'a': '1', 'v': '-7'}, {'a': '2', 'v': '-9223372036854775808'}], 1_700_000_001))
+    # A negative value used to fail the encoding and every DDATA of the device after it
+    node.translator.process_flexy_data_message(node.client, None, flexy_message('DATA', [
+        {'a': '2', 'v': '4'}], 1_700_000_002))
+    ddata = node.published('DDATA')
+    assert [[signed(metric.long_value) for metric in payload.metrics] for payload in ddata] == \
+        [[-7, -9223372036854775808], [4]]
@@ -0,0 +1,109 @@
+import json
+
+from bench import flexy_topic, make_birth
+from conftest import BIRTH_TIMESTAMP, TAGS, FakeScheduler
+from pyapp.ewon_translate import STALE_DEVICES
+from pyapp.fake_mqtt import FakeMessage
+from pyapp.scheduler import TimingWheel
+
+
+def device_ids(topics: list) -> list:
+    return [topic.split('/')[-1] for topic in topics]
+
+
+def published_topics(node, message_type: str) -> list:
+    return [topic for topic, _ in node.client.published if topic.split('/')[2] == message_type]
+
+
+def test_rebirth_skips_offline_device(bridge):
+    node = bridge(store=False, stale_seconds=60)
+    birth, _ = make_birth(node.rnd, 1, TAGS, [('float', 1)], BIRTH_TIMESTAMP)
+    node.translator.process_flexy_birth_message(node.client, None, birth)
+    node.translator.process_flexy_state_message(node.client, None, FakeMessage(flexy_topic(1) + '/STATE', b'OFFLINE'))
+    assert device_ids(published_topics(node, 'DDEATH')) == ['flexy_00001']
+
+    dbirths = len(published_topics(node, 'DBIRTH'))
+    node.translator.publish_birth(node.client, node.sparkplug_node.bd_seq.current_value)
+    # Only the live device is born again, the OFFLINE one waits for its Flexy BIRTH
+    assert device_ids(published_topics(node, 'DBIRTH')[dbirths:]) == ['flexy_00000']
+    assert [device.online for device in node.translator.devices] == [True, False]
+
+    node.translator.process_flexy_birth_message(node.client, None, birth)
+    assert device_ids(published_topics(node, 'DBIRTH')[-1:]) == ['flexy_00001']
+    assert [device.online for device in node.translator.devices] == [True, True]
+
+
+def run_wheel(wheel: TimingWheel, clock: FakeScheduler, seconds: int):
+    for _ in range(seconds):
+        clock.now += 1
+        wheel.advance()
+
+
+def test_timing_wheel_cascade():
+    clock = FakeScheduler()
+    # Levels of 1, 4 and 16 ticks per slot cover 64 ticks, later timers are parked in the top level
+    wheel = TimingWheel(tick=1, slots=4, levels=3, clock=clock)
+    fired = []
+    for delay in (1, 2.5, 3, 4, 5, 15, 16, 17, 40, 63, 64, 100, 250):
+        wheel.call_later(delay, lambda delay=delay: fired.append((delay, clock.now)))
+    cancelled = wheel.call_later(20, fired.append, 'cancelled')
+    cancelled.cancel()
+    assert len(wheel) == 14
+    run_wheel(wheel, clock, 300)
+    # Every timer fires on the first tick at or after its deadline, whichever wheel it waited in
+    assert fired == [(delay, -(-delay // 1)) for delay in (1, 2.5, 3, 4, 5, 15, 16, 17, 40, 63, 64, 100, 250)]
+    assert len(wheel) == 0
+
+
+def test_timing_wheel_catches_up():
+    clock = FakeScheduler()
+    wheel = TimingWheel(tick=1, slots=4, levels=2, clock=clock)
+    fired = []
+    for delay in (3, 10, 30):
+        wheel.call_later(delay, fired.append, delay)
+    # A late advance() runs every timer that came due meanwhile, in deadline order
+    clock.now = 12
+    assert wheel.advance() == 2
+    assert fired == [3, 10]
+    # Timers added from a later point count from the clock, not from the last tick processed
+    wheel.call_later(5, fired.append, 'late')
+    clock.now = 31
+    wheel.advance()
+    assert fired == [3, 10, 'late', 30]
+
+
+def data(index: int, timestamp: int) -> FakeMessage:
+    return FakeMessage(flexy_topic(index) + '/DATA', json.dumps({'t': timestamp, 'm': [{'a': '1', 'v': '1'}]}).encode())
+
+
+def test_stale_device_ddeath(bridge, fake_scheduler):
+    node = bridge(store=False, scheduler=fake_scheduler, clock=fake_scheduler, stale_seconds=30)
+    stale = STALE_DEVICES.value
+    fake_scheduler.advance(20)
+    node.translator.process_flexy_data_message(node.client, None, data(0, BIRTH_TIMESTAMP + 20))
+    # Due at 30s, the device was seen at 20s, so the check moves to 50s
+    fake_scheduler.advance(29)
+    assert published_topics(node, 'DDEATH') == []
+    fake_scheduler.advance(2)
+    assert device_ids(published_topics(node, 'DDEATH')) == ['flexy_00000']
+    assert STALE_DEVICES.value == stale + 1
+    device = node.translator.devices[0]
+    assert (device.online, device.stale) == (False, True)
+
+    # A node rebirth leaves it dead, its next DATA asks the Flexy for a BIRTH instead of publishing
+    dbirths = len(published_topics(node, 'DBIRTH'))
+    node.translator.publish_birth(node.client, node.sparkplug_node.bd_seq.current_value)
+    assert published_topics(node, 'DBIRTH')[dbirths:] == []
+    ddata = len(published_topics(node, 'DDATA'))
+    node.translator.process_flexy_data_message(node.client, None, data(0, BIRTH_TIMESTAMP + 60))
+    assert len(published_topics(node, 'DDATA')) == ddata
+    assert (flexy_topic(0) + '/CMD', b'REBIRTH') in node.client.published
+
+    # Born again, it is watched again
+    birth, _ = make_birth(node.rnd, 0, TAGS, [('float', 1)], BIRTH_TIMESTAMP + 61)
+    node.translator.process_flexy_birth_message(node.client, None, birth)
+    device = node.translator.devices[0]
+    assert (device.online, device.stale) == (True, False)
+    fake_scheduler.advance(31)
+    assert device_ids(published_topics(node, 'DDEATH')) == ['flexy_00000', 'flexy_00000']
+    assert STALE_DEVICES.value == stale + 2
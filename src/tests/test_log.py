@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from pyapp import config
+from pyapp.log import AsyncLogger, EventLimit, INFO, WARNING, level_from_config
+
+
+def test_level_from_config(monkeypatch):
+    monkeypatch.setattr(config, 'LOG_LEVEL', 'warning')
+    assert level_from_config() == WARNING
+    monkeypatch.setattr(config, 'LOG_LEVEL', 'verbose')
+    with pytest.raises(ValueError, match='LOG_LEVEL'):
+        level_from_config()
+
+
+def test_levels_formatting_and_sampling():
+    stream = io.StringIO()
+    logger = AsyncLogger(level=INFO, stream=stream, limits={'noisy': EventLimit(every=3)})
+    logger.debug('hidden', 'not written')
+    logger.info('ddata_published', 'DDATA PUBLISHED, source: %s', 'flush_device()', device='flexy_1')
+    for _ in range(6):
+        logger.info('noisy', 'tick')
+    logger.flush()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    assert lines[0].endswith('INFO    ddata_published: DDATA PUBLISHED, source: flush_device() device=flexy_1')
+    assert lines[1].endswith('noisy: tick suppressed=2')
+
+
+def test_json_lines_and_bad_format_args():
+    stream = io.StringIO()
+    logger = AsyncLogger(stream=stream, json_lines=True)
+    logger.warning('store_full', 'FULL: %s %s', 'only one')
+    logger.flush()
+    entry = json.loads(stream.getvalue())
+    assert (entry['level'], entry['event']) == ('WARNING', 'store_full')
+    assert 'only one' in entry['msg']
+
+
+def test_full_buffer_drops_oldest():
+    stream = io.StringIO()
+    logger = AsyncLogger(stream=stream, buffer_size=2, flush_seconds=60)
+    for index in range(4):
+        logger.info('event', 'entry %s', index)
+    logger.flush()
+    assert [line.split(': ')[-1] for line in stream.getvalue().splitlines()] == ['entry 2', 'entry 3']
@@ -0,0 +1,85 @@
+import random
+import socket
+import threading
+
+from bench import make_birth
+from pyapp import metrics
+from pyapp.ewon_translate import TrackedClient
+
+
+def test_device_gauges_while_devices_are_added(bridge):
+    node = bridge(store=False)
+    errors = []
+    stop = threading.Event()
+    gauges = [metrics.registry.gauge(name, '') for name in ('flexy_bridge_devices_online',
+                                                             'flexy_bridge_device_metrics')]
+
+    def collect():
+        while not stop.is_set():
+            try:
+                for gauge in gauges:
+                    gauge.collect()
+            except Exception as err:
+                errors.append(err)
+
+    thread = threading.Thread(target=collect, daemon=True)
+    thread.start()
+    rnd = random.Random(2)
+    for index in range(1, 300):
+        birth, _ = make_birth(rnd, index, 5, [('float', 1)], 1_700_000_000)
+        node.translator.process_flexy_birth_message(node.client, None, birth)
+    stop.set()
+    thread.join()
+    assert errors == []
+    assert gauges[0].collect() == 300
+    assert len(gauges[1].collect()) == 300
+
+
+def test_tracked_client_counts_unwritten_publishes():
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = TrackedClient('tracked_test')
+    client.connect('127.0.0.1', server.getsockname()[1])
+    connection, _ = server.accept()
+    try:
+        # Nothing is read on the other side, so the socket buffers fill up and paho queues the rest
+        for _ in range(500):
+            client.publish('test', b'x' * 10000)
+        assert 0 < client.pending_publishes < 500
+        client.forget_pending()
+        assert client.pending_publishes == 0
+    finally:
+        connection.close()
+        server.close()
+        client.socket().close()
+
+
+def test_tracked_client_does_not_keep_written_publishes():
+    # Publishes made while paho may not write them straight away (inside a callback, or with
+    # on_socket_register_write set as in tenants mode) are written later by the network loop
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = TrackedClient('tracked_test')
+    client.on_socket_register_write = lambda client, userdata, sock: None
+    client.connect('127.0.0.1', server.getsockname()[1])
+    connection, _ = server.accept()
+    connection.setblocking(False)
+    try:
+        for _ in range(3):
+            for _ in range(2000):
+                client.publish('test', b'x' * 10)
+            while client.want_write():
+                client.loop_write()
+                try:
+                    connection.recv(1 << 20)
+                except BlockingIOError:
+                    pass
+        client.publish('test', b'x' * 10)
+        assert len(client._TrackedClient__pending) <= 1
+    finally:
+        connection.close()
+        server.close()
+        client.socket().close()
@@ -0,0 +1,42 @@
+from pyapp.ewon_translate import PROFILE_START, PROFILE_STOP
+from pyapp.fake_mqtt import FakeMessage
+from pyapp.profiler import SamplingProfiler
+from pyapp.protobuf import sparkplug_b_pb2
+
+
+def ncmd(node, **commands) -> FakeMessage:
+    # commands: metric name -> value, bools and ints as Sparkplug boolean/long metrics
+    payload = sparkplug_b_pb2.Payload()
+    for name, value in commands.items():
+        metric = payload.metrics.add()
+        metric.name = name
+        if isinstance(value, bool):
+            metric.boolean_value = value
+        else:
+            metric.long_value = value
+    return FakeMessage(node.sparkplug_node.ncmd_topic, payload.SerializeToString())
+
+
+def test_rebirth_with_profile_start(bridge, tmp_path):
+    node = bridge(store=False, profiler=SamplingProfiler(interval=0.001), profile_dir=str(tmp_path))
+    births = len(node.published('NBIRTH'))
+    node.translator.process_ncmd_message(
+        node.client, None, ncmd(node, **{PROFILE_START: 60, 'Node Control/Rebirth': True}))
+    assert len(node.published('NBIRTH')) == births + 1
+    running = [metric.boolean_value for metric in node.published('NBIRTH')[-1].metrics
+               if metric.name == 'Profiler/Running']
+    assert running == [True]
+
+    node.translator.process_ncmd_message(
+        node.client, None, ncmd(node, **{'Node Control/Rebirth': True, PROFILE_STOP: True}))
+    assert len(node.published('NBIRTH')) == births + 2
+    assert list(tmp_path.glob('profile-*.txt'))
+
+
+def test_profiler_is_opt_in(bridge):
+    node = bridge(store=False)
+    names = [metric.name for metric in node.published('NBIRTH')[-1].metrics]
+    assert PROFILE_START not in names
+    births = len(node.published('NBIRTH'))
+    node.translator.process_ncmd_message(node.client, None, ncmd(node, **{PROFILE_START: 60}))
+    assert len(node.published('NBIRTH')) == births
@@ -0,0 +1,172 @@
+import paho.mqtt.client as mqtt
+
+from pyapp.ewon_translate import Sequencer, encode_seq
+from pyapp.fake_mqtt import FakeMqttClient, FakePublishInfo
+from pyapp.outbound import OutboundScheduler, PRIORITY_DATA, PRIORITY_DEVICE, PRIORITY_HISTORICAL, PRIORITY_NODE
+from pyapp.protobuf import sparkplug_b_pb2
+
+NBIRTH = 'spBv1.0/group/NBIRTH/node'
+
+
+def ddata(device: str) -> str:
+    return f'spBv1.0/group/DDATA/node/{device}'
+
+
+def dbirth(device: str) -> str:
+    return f'spBv1.0/group/DBIRTH/node/{device}'
+
+
+def payload(alias: int, value: float) -> bytes:
+    sp_payload = sparkplug_b_pb2.Payload()
+    metric = sp_payload.metrics.add()
+    metric.alias = alias
+    metric.double_value = value
+    return sp_payload.SerializeToString()
+
+
+def decode(data: bytes) -> sparkplug_b_pb2.Payload:
+    sp_payload = sparkplug_b_pb2.Payload()
+    sp_payload.ParseFromString(data)
+    return sp_payload
+
+
+class DeferredClient(FakeMqttClient):
+    # Writes nothing until confirm(), like paho with a busy socket. refuse makes publish() fail as when offline
+    def __init__(self):
+        super().__init__(keep_published=True)
+        self.unconfirmed = []
+        self.refuse = False
+        self.__mid = 0
+
+    def publish(self, topic: str, payload: bytes = None, qos: int = 0, retain: bool = False):
+        if self.refuse:
+            return FakePublishInfo(mqtt.MQTT_ERR_NO_CONN, 0)
+        self.__mid += 1
+        self.published.append((topic, payload))
+        self.unconfirmed.append(self.__mid)
+        return FakePublishInfo(mqtt.MQTT_ERR_SUCCESS, self.__mid)
+
+    def confirm(self, count: int = 1):
+        for _ in range(count):
+            self.on_publish(self, None, self.unconfirmed.pop(0))
+
+
+def make_scheduler(client, window: int = 2, **kwargs):
+    failed = []
+    scheduler = OutboundScheduler(Sequencer(), encode_seq, window=window, on_failed=failed.append, **kwargs)
+    client.on_publish = scheduler.on_publish
+    return scheduler, failed
+
+
+def test_window_limits_in_flight_and_seq_follows_wire_order():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=2)
+    for device in 'abcde':
+        assert scheduler.publish(client, ddata(device), payload(1, 1.0), PRIORITY_DATA, device=device)
+    assert (len(client.published), scheduler.in_flight, len(scheduler)) == (2, 2, 3)
+
+    # The DBIRTH queued last goes out before the queued DDATA/NDATA once a slot frees up
+    scheduler.publish(client, 'spBv1.0/group/NDATA/node', payload(1, 2.0), PRIORITY_DATA)
+    scheduler.publish(client, dbirth('z'), payload(1, 3.0), PRIORITY_DEVICE, device='z')
+    client.confirm()
+    assert client.published[2][0] == dbirth('z')
+    while client.unconfirmed:
+        client.confirm()
+    assert len(client.published) == 7
+    assert [decode(data).seq for _, data in client.published] == list(range(1, 8))
+    assert (scheduler.in_flight, len(scheduler)) == (0, 0)
+
+
+def test_on_publish_fired_inside_publish():
+    # FakeMqttClient confirms before publish() returns the mid, as paho does when it writes the packet at once
+    client = FakeMqttClient(keep_published=True)
+    scheduler, _ = make_scheduler(client, window=1)
+    for device in 'abcde':
+        scheduler.publish(client, ddata(device), payload(1, 1.0), PRIORITY_DATA, device=device)
+    assert len(client.published) == 5
+    assert (scheduler.in_flight, len(scheduler)) == (0, 0)
+
+
+def test_dbirth_supersedes_queued_device_data():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=1)
+    scheduler.publish(client, ddata('other'), payload(1, 1.0), PRIORITY_DATA, device='other')
+    scheduler.publish(client, ddata('a'), payload(1, 1.0), PRIORITY_DATA, device='a')
+    scheduler.publish(client, ddata('b'), payload(1, 1.0), PRIORITY_DATA, device='b')
+    scheduler.publish(client, dbirth('a'), payload(1, 2.0), PRIORITY_DEVICE, device='a')
+    assert scheduler.queued(PRIORITY_DATA) == 1
+    while client.unconfirmed:
+        client.confirm()
+    assert [topic for topic, _ in client.published] == [ddata('other'), dbirth('a'), ddata('b')]
+
+
+def test_nbirth_supersedes_everything_queued():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=1)
+    scheduler.publish(client, ddata('a'), payload(1, 1.0), PRIORITY_DATA, device='a')
+    scheduler.publish(client, ddata('b'), payload(1, 1.0), PRIORITY_DATA, device='b')
+    scheduler.publish(client, NBIRTH, payload(1, 1.0), PRIORITY_NODE, seq=False, reset_seq=True)
+    while client.unconfirmed:
+        client.confirm()
+    assert [topic for topic, _ in client.published] == [ddata('a'), NBIRTH]
+
+
+def test_queued_ddata_of_a_device_is_coalesced():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=1)
+    scheduler.publish(client, ddata('busy'), payload(1, 0.0), PRIORITY_DATA, device='busy')
+    scheduler.publish(client, ddata('a'), payload(1, 1.0), PRIORITY_DATA, device='a')
+    scheduler.publish(client, ddata('a'), payload(2, 2.0), PRIORITY_DATA, device='a')
+    assert scheduler.queued(PRIORITY_DATA) == 1
+    client.confirm()
+    merged = decode(client.published[1][1])
+    assert [(metric.alias, metric.double_value) for metric in merged.metrics] == [(1, 1.0), (2, 2.0)]
+    assert merged.seq == 2
+
+
+def test_no_coalescing_across_a_dbirth():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=1)
+    scheduler.publish(client, ddata('busy'), payload(1, 0.0), PRIORITY_DATA, device='busy')
+    scheduler.publish(client, dbirth('a'), payload(1, 1.0), PRIORITY_DEVICE, device='a')
+    scheduler.publish(client, ddata('a'), payload(1, 2.0), PRIORITY_DATA, device='a')
+    scheduler.publish(client, ddata('a'), payload(2, 3.0), PRIORITY_DATA, device='a')
+    while client.unconfirmed:
+        client.confirm()
+    assert [topic for topic, _ in client.published] == [ddata('busy'), dbirth('a'), ddata('a')]
+
+
+def test_failed_send():
+    client = DeferredClient()
+    scheduler, failed = make_scheduler(client, window=1)
+    scheduler.publish(client, ddata('a'), payload(1, 1.0), PRIORITY_DATA, device='a')
+    scheduler.publish(client, ddata('b'), payload(1, 1.0), PRIORITY_DATA, device='b')
+    client.refuse = True
+    # Queued behind the window, accepted
+    assert scheduler.publish(client, ddata('c'), payload(1, 1.0), PRIORITY_HISTORICAL)
+    # Refused later, when a slot frees up: reported to on_failed
+    client.confirm()
+    assert [message.topic for message in failed] == [ddata('b'), ddata('c')]
+    assert (scheduler.in_flight, len(scheduler)) == (0, 0)
+    # Refused within its own publish(): reported to the caller only
+    assert not scheduler.publish(client, ddata('d'), payload(1, 1.0), PRIORITY_DATA, device='d')
+    assert len(failed) == 2
+    client.refuse = False
+    assert scheduler.publish(client, ddata('e'), payload(1, 1.0), PRIORITY_DATA, device='e')
+    assert [topic for topic, _ in client.published] == [ddata('a'), ddata('e')]
+
+
+def test_reset_after_disconnect():
+    client = DeferredClient()
+    scheduler, _ = make_scheduler(client, window=2)
+    for device in 'abcd':
+        scheduler.publish(client, ddata(device), payload(1, 1.0), PRIORITY_DATA, device=device)
+    assert scheduler.in_flight == 2
+    # The connection dropped, the in-flight publishes are never confirmed
+    client.unconfirmed.clear()
+    scheduler.reset()
+    assert scheduler.in_flight == 0
+    scheduler.publish(client, ddata('e'), payload(1, 1.0), PRIORITY_DATA, device='e')
+    assert [topic for topic, _ in client.published[2:]] == [ddata('c'), ddata('d')]
+    client.confirm(2)
+    assert [topic for topic, _ in client.published[4:]] == [ddata('e')]
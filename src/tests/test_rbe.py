@@ -0,0 +1,86 @@
+import json
+from types import SimpleNamespace
+
+from bench import flexy_topic
+from pyapp.fake_mqtt import FakeMessage
+from pyapp.rbe import DEFER, REPORT, SUPPRESS, RbeEngine, RbePolicy
+
+
+def published(value, at: int = 0):
+    # Stands in for a FlexyMetric, check() only reads what was last published and when
+    return SimpleNamespace(value_published=value, published_at=at)
+
+
+def test_suppress_identical():
+    assert RbePolicy().check(published(1.5), 1.5, 1000) == SUPPRESS
+    assert RbePolicy().check(published('on'), 'on', 1000) == SUPPRESS
+    assert RbePolicy(suppress_identical=False).check(published(1.5), 1.5, 1000) == REPORT
+    assert RbePolicy().check(published(1.5), 1.6, 1000) == REPORT
+
+
+def test_deadband():
+    policy = RbePolicy(deadband=0.5)
+    assert policy.check(published(10.0), 10.5, 1000) == SUPPRESS
+    assert policy.check(published(10.0), 9.5, 1000) == SUPPRESS
+    assert policy.check(published(10.0), 10.6, 1000) == REPORT
+    assert policy.check(published(10), 11, 1000) == REPORT
+    # Only numbers have a deadband
+    assert policy.check(published('a'), 'b', 1000) == REPORT
+    assert policy.check(published(None), 10.2, 1000) == REPORT
+
+
+def test_percent_deadband():
+    policy = RbePolicy(percent_deadband=2)
+    assert policy.check(published(200.0), 204.0, 1000) == SUPPRESS
+    assert policy.check(published(-200.0), -196.0, 1000) == SUPPRESS
+    assert policy.check(published(200.0), 204.5, 1000) == REPORT
+    # 2% of 0 is 0, any change from 0 is reported
+    assert policy.check(published(0.0), 0.1, 1000) == REPORT
+
+
+def test_min_interval():
+    policy = RbePolicy(min_interval=5)
+    metric = published(1.0, at=10_000)
+    assert policy.check(metric, 2.0, 14_999) == DEFER
+    assert not policy.min_interval_elapsed(metric, 14_999)
+    assert policy.check(metric, 2.0, 15_000) == REPORT
+    assert policy.min_interval_elapsed(metric, 15_000)
+    # Deadband suppression wins over deferral
+    assert RbePolicy(deadband=1, min_interval=5).check(metric, 1.5, 11_000) == SUPPRESS
+
+
+def test_max_interval():
+    metric = published(1.0, at=10_000)
+    assert not RbePolicy().max_interval_elapsed(metric, 10_000_000)
+    policy = RbePolicy(max_interval=60)
+    assert not policy.max_interval_elapsed(metric, 69_999)
+    assert policy.max_interval_elapsed(metric, 70_000)
+
+
+def test_first_matching_pattern_wins(tmp_path):
+    path = tmp_path / 'rbe.json'
+    path.write_text(json.dumps({
+        'default': {'deadband': 1},
+        'policies': [{'pattern': '*/Tank1/Level', 'deadband': 0.1},
+                     {'pattern': '*/Tank*/Level', 'percent_deadband': 5, 'suppress_identical': False},
+                     {'pattern': '*/Tank1/*', 'deadband': 9}]}))
+    engine = RbeEngine.from_file(str(path))
+    exact = engine.policy_for('client/iono2x/Tank1/Level')
+    assert (exact.deadband, exact.percent_deadband) == (0.1, 0)
+    # Fields a policy leaves out come from the default policy of the file
+    wildcard = engine.policy_for('client/iono2x/Tank2/Level')
+    assert (wildcard.deadband, wildcard.percent_deadband, wildcard.suppress_identical) == (1, 5, False)
+    assert engine.policy_for('client/iono2x/Tank1/Temp').deadband == 9
+    fallback = engine.policy_for('client/iono2x/Pump/Speed')
+    assert (fallback.deadband, fallback.suppress_identical) == (1, True)
+    # Matching is case sensitive
+    assert engine.policy_for('client/iono2x/tank1/level') is fallback
+
+
+def test_default_policy_suppresses_identical_values(bridge):
+    node = bridge(store=False, rbe=RbeEngine.from_file(None))
+    for timestamp in (1_700_000_001, 1_700_000_002):
+        node.translator.process_flexy_data_message(node.client, None, FakeMessage(
+            flexy_topic(0) + '/DATA', json.dumps({'t': timestamp, 'm': [{'a': '1', 'v': '12.5'}]}).encode()))
+    assert len(node.published('DDATA')) == 1
+    assert RbeEngine.from_file(None, suppress_identical=False).policy_for('any').suppress_identical is False
@@ -0,0 +1,127 @@
+import pytest
+
+from bench import flexy_topic
+from pyapp.devices import FlexyTopic
+from pyapp.fake_mqtt import FakeMessage, FakeMqttClient
+from pyapp.rebirth import RebirthScheduler
+
+
+def rebirths(client) -> list:
+    # Flexy indexes the REBIRTH commands went to, in order
+    return [int(topic.split('/')[3][len('flexy_'):]) for topic, payload in client.published if payload == b'REBIRTH']
+
+
+@pytest.fixture
+def client():
+    return FakeMqttClient(keep_published=True)
+
+
+def test_token_bucket(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, rate=2, burst=3, clock=fake_scheduler)
+    for index in range(6):
+        assert scheduler.request(client, FlexyTopic(flexy_topic(index)), 'state_online')
+    assert rebirths(client) == [0, 1, 2]
+    fake_scheduler.advance(0.5)
+    assert rebirths(client) == [0, 1, 2, 3]
+    fake_scheduler.advance(1)
+    assert rebirths(client) == [0, 1, 2, 3, 4, 5]
+    # The bucket refills up to burst, not beyond
+    fake_scheduler.advance(10)
+    for index in range(6, 10):
+        scheduler.request(client, FlexyTopic(flexy_topic(index)), 'state_online')
+    assert rebirths(client)[6:] == [6, 7, 8]
+
+
+def test_rate_zero_sends_straight_away(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, rate=0, clock=fake_scheduler)
+    for index in range(50):
+        scheduler.request(client, FlexyTopic(flexy_topic(index)), 'state_online')
+    assert len(rebirths(client)) == 50
+
+
+def test_one_pending_rebirth_per_flexy(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, clock=fake_scheduler)
+    topic = FlexyTopic(flexy_topic(0))
+    assert scheduler.request(client, topic, 'unknown_alias')
+    assert not scheduler.request(client, topic, 'unknown_alias')
+    assert not scheduler.request(client, topic, 'tag_count')
+    assert rebirths(client) == [0]
+    assert len(scheduler) == 1 and topic.flexy_topic in scheduler
+    scheduler.on_birth(topic.flexy_topic)
+    assert len(scheduler) == 0
+    assert scheduler.request(client, topic, 'unknown_alias')
+    assert rebirths(client) == [0, 0]
+
+
+def test_backoff_until_birth(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, timeout=10, max_timeout=25, clock=fake_scheduler)
+    topic = FlexyTopic(flexy_topic(0))
+    scheduler.request(client, topic, 'state_online')
+    sent = []
+    for _ in range(100):
+        fake_scheduler.advance(1)
+        if len(rebirths(client)) > len(sent) + 1:
+            sent.append(fake_scheduler.now)
+    # Timeouts double from 10s and stop growing at 25s
+    assert sent == [10, 30, 55, 80]
+    scheduler.on_birth(topic.flexy_topic)
+    fake_scheduler.advance(1000)
+    assert len(rebirths(client)) == 5
+    assert len(fake_scheduler) == 0
+
+
+def test_cancel_stops_retries(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, rate=1, burst=1, timeout=10, clock=fake_scheduler)
+    for index in range(2):
+        scheduler.request(client, FlexyTopic(flexy_topic(index)), 'state_online')
+    # Flexy 0 waits for its BIRTH, Flexy 1 for a token
+    assert scheduler.cancel(flexy_topic(0)) and scheduler.cancel(flexy_topic(1))
+    assert not scheduler.cancel(flexy_topic(0))
+    fake_scheduler.advance(1000)
+    assert rebirths(client) == [0]
+    assert len(scheduler) == 0
+
+
+def test_hold_buffer(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, hold='buffer', buffer_size=2, clock=fake_scheduler)
+    topic = FlexyTopic(flexy_topic(0))
+    assert not scheduler.hold(topic.flexy_topic, 'data')
+    scheduler.request(client, topic, 'unknown_alias', 'data 1')
+    assert scheduler.hold(topic.flexy_topic, 'data 2')
+    assert scheduler.hold(topic.flexy_topic, 'data 3')
+    # The oldest DATA makes room once buffer_size are held
+    assert scheduler.on_birth(topic.flexy_topic) == ['data 2', 'data 3']
+    assert not scheduler.hold(topic.flexy_topic, 'data 4')
+
+
+def test_hold_drop(fake_scheduler, client):
+    scheduler = RebirthScheduler(fake_scheduler, hold='drop', clock=fake_scheduler)
+    topic = FlexyTopic(flexy_topic(0))
+    scheduler.request(client, topic, 'unknown_alias', 'data 1')
+    assert scheduler.hold(topic.flexy_topic, 'data 2')
+    assert scheduler.on_birth(topic.flexy_topic) == []
+    # A REBIRTH without DATA behind it, e.g. for STATE ONLINE, lets DATA through
+    scheduler.request(client, topic, 'state_online')
+    assert not scheduler.hold(topic.flexy_topic, 'data 3')
+
+
+def test_invalid_hold_policy(fake_scheduler):
+    with pytest.raises(ValueError):
+        RebirthScheduler(fake_scheduler, hold='keep')
+
+
+def test_offline_cancels_pending_rebirth(bridge, fake_scheduler):
+    scheduler = RebirthScheduler(fake_scheduler, timeout=10, clock=fake_scheduler)
+    node = bridge(store=False, rebirths=scheduler)
+    for index in (0, 1):
+        # Flexy 0 is cached and gets a DDEATH, Flexy 1 never sent its BIRTH
+        node.translator.process_flexy_state_message(
+            node.client, None, FakeMessage(flexy_topic(index) + '/STATE', b'ONLINE'))
+    assert len(scheduler) == 2
+    for index in (0, 1):
+        node.translator.process_flexy_state_message(
+            node.client, None, FakeMessage(flexy_topic(index) + '/STATE', b'OFFLINE'))
+    assert len(scheduler) == 0
+    requests = len(rebirths(node.client))
+    fake_scheduler.advance(3600)
+    assert len(rebirths(node.client)) == requests
@@ -0,0 +1,26 @@
+import pytest
+
+import bench
+
+
+def shard_args(shards: int, projected: bool = False):
+    return bench.parse_args(['--devices', '40', '--tags', '50', '--messages', '6000', '--dcmds', '0',
+                             '--rebirths', '0', '--shards', str(shards)] + (['--projected'] if projected else []))
+
+
+def test_shards_split_the_fleet():
+    report = bench.run_shards(shard_args(2))
+    assert report['scaling']['mode'] == 'measured'
+    # Every DATA is translated by exactly one shard
+    baseline_ddata = report['baseline']['results'][1]['publishes']
+    assert sum(shard['results'][1]['publishes'] for shard in report['shards']) == baseline_ddata == 6000
+    assert all(0 < shard['results'][1]['publishes'] < 6000 for shard in report['shards'])
+
+
+@pytest.mark.parametrize('shards', [2, 4])
+def test_measured_throughput_scales(shards):
+    if bench.available_cores() < shards:
+        pytest.skip(f'needs {shards} free cores, {bench.available_cores()} available')
+    report = bench.run_shards(shard_args(shards))
+    # Near linear, every shard still runs the hash filter over the other shards' messages
+    assert report['scaling']['speedup'] >= 0.6 * shards
@@ -0,0 +1,63 @@
+import pytest
+
+from bench import flexy_topic
+from conftest import TAGS
+from pyapp.ewon_translate import FlexyTranslatorNode, SparkplugNode
+from pyapp.fake_mqtt import FakeMessage, FakeMqttClient
+from pyapp.protobuf import sparkplug_b_pb2
+from pyapp.scheduler import Scheduler
+from pyapp.snapshot import read_snapshot, write_snapshot
+
+
+def dbirth_metrics(client) -> list:
+    payload = sparkplug_b_pb2.Payload()
+    payload.ParseFromString([payload for topic, payload in client.published if '/DBIRTH/' in topic][-1])
+    return [(metric.name, metric.alias, metric.datatype, metric.double_value, metric.timestamp)
+            for metric in payload.metrics if metric.alias]
+
+
+@pytest.fixture
+def restored(bridge, tmp_path):
+    # The Flexy 0 bridge with some DATA, restarted from its snapshot on a new translator and client
+    node = bridge(store=False)
+    node.data(1_700_000_001, changed=5)
+    node.translator.publish_birth(node.client, node.sparkplug_node.bd_seq.current_value)
+    path = str(tmp_path / 'snapshot')
+    write_snapshot(path, dict(bd_seq=3, **node.translator.snapshot_state()))
+
+    state = read_snapshot(path)
+    assert state['bd_seq'] == 3
+    translator = FlexyTranslatorNode(SparkplugNode('group', 'node'), scheduler=Scheduler())
+    assert translator.restore_state(state) == 1
+    client = FakeMqttClient(keep_published=True)
+    translator.publish_birth(client, 4)
+    return node, translator, client
+
+
+def test_restored_births(restored):
+    node, translator, client = restored
+    assert [topic.split('/')[2] for topic, _ in client.published] == ['NBIRTH', 'DBIRTH']
+    assert len(dbirth_metrics(client)) == TAGS
+    assert dbirth_metrics(client) == dbirth_metrics(node.client)
+
+
+@pytest.mark.parametrize('tag_ids, rebirth', [
+    (None, False),                                              # plain "ONLINE" lists no tags
+    (list(range(1, TAGS + 1)), False),
+    (list(range(TAGS, 0, -1)), False),                          # order does not matter
+    (list(range(1, TAGS)), True),                               # a tag was removed
+    (list(range(1, TAGS + 2)), True),                           # a tag was added
+    (list(range(2, TAGS + 2)), True),                           # same count, different tags
+])
+def test_retained_online_checks_alias_set(restored, tag_ids, rebirth):
+    _, translator, client = restored
+    payload = b'ONLINE' if tag_ids is None else b'ONLINE;' + ','.join(map(str, tag_ids)).encode()
+    translator.process_flexy_state_message(client, None, FakeMessage(flexy_topic(0) + '/STATE', payload, retain=True))
+    assert ((flexy_topic(0) + '/CMD', b'REBIRTH') in client.published) is rebirth
+
+
+def test_live_online_requests_rebirth(restored):
+    _, translator, client = restored
+    payload = b'ONLINE;' + ','.join(map(str, range(1, TAGS + 1))).encode()
+    translator.process_flexy_state_message(client, None, FakeMessage(flexy_topic(0) + '/STATE', payload))
+    assert (flexy_topic(0) + '/CMD', b'REBIRTH') in client.published
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+from pyapp import ewon_translate
+from pyapp.store_forward import StoreAndForward
+
+
+def replay_in_thread(bridge) -> bool:
+    # True when replay_stored() returned, a deadlock leaves the thread hanging
+    thread = threading.Thread(target=bridge.translator.replay_stored, args=(bridge.client,), daemon=True)
+    thread.start()
+    thread.join(5)
+    return not thread.is_alive()
+
+
+def test_publish_refused_during_replay_keeps_messages(bridge):
+    node = bridge(window=10)
+    node.client.connected = False
+    for second in range(5):
+        node.data(1_700_000_001 + second)
+    assert len(node.store) == 5
+
+    node.client.connected = True
+    node.client.refuse = True
+    assert replay_in_thread(node)
+    # Nothing went out, nothing was stored a second time
+    assert len(node.store) == 5
+    assert node.store.stats()['replayed'] == 0
+
+    node.client.refuse = False
+    assert replay_in_thread(node)
+    assert len(node.store) == 0
+    historical = node.published('DDATA')
+    assert [payload.metrics[0].timestamp for payload in historical] == \
+        [(1_700_000_001 + second) * 1000 for second in range(5)]
+    assert all(metric.is_historical for payload in historical for metric in payload.metrics)
+
+
+def test_publish_refused_during_replay_without_outbound(bridge):
+    node = bridge()
+    node.client.connected = False
+    node.data(1_700_000_001)
+    node.client.connected = True
+    node.client.refuse = True
+    assert replay_in_thread(node)
+    assert len(node.store) == 1
+
+
+def test_store_from_publish_callback_does_not_deadlock(tmp_path):
+    store = StoreAndForward(str(tmp_path / 'store.db'))
+    for index in range(3):
+        store.store('spBv1.0/group/DDATA/node/flexy', bytes([index]))
+
+    def publish(topic, payload):
+        # As the outbound failure callback does for a DDATA paho refused
+        store.store(topic, payload + b'again')
+        return True
+
+    thread = threading.Thread(target=store.replay, args=(publish, 10), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(store) == 3
+    assert store.stats()['replayed'] == 3
+
+
+def test_offline_ddata_is_counted_as_stored(bridge):
+    node = bridge()
+    published, stored = ewon_translate.DDATA_PUBLISHED.value, ewon_translate.DDATA_STORED.value
+    node.client.connected = False
+    node.data(1_700_000_001)
+    assert ewon_translate.DDATA_STORED.value == stored + 1
+    assert ewon_translate.DDATA_PUBLISHED.value == published
+    node.client.connected = True
+    node.data(1_700_000_002)
+    assert ewon_translate.DDATA_PUBLISHED.value == published + 1
+
+
+@pytest.mark.parametrize('window', [0, 10])
+def test_reconnect_replays_after_the_births_in_order(bridge, window):
+    node = bridge(window=window)
+    node.client.connected = False
+    node.sparkplug_node.on_disconnect()
+    for second in range(25):
+        node.data(1_700_000_001 + second)
+    assert len(node.store) == 25
+    node.client.published.clear()
+
+    node.client.connected = True
+    node.translator.publish_birth(node.client, node.sparkplug_node.bd_seq.current_value)
+    deadline = time.monotonic() + 5
+    while len(node.store) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(node.store) == 0
+
+    types = [topic.split('/')[2] for topic, _ in node.client.published]
+    assert types == ['NBIRTH', 'DBIRTH'] + ['DDATA'] * 25
+    historical = node.published('DDATA')
+    assert [payload.metrics[0].timestamp for payload in historical] == \
+        [(1_700_000_001 + second) * 1000 for second in range(25)]
+    assert [payload.seq for payload in historical] == list(range(2, 27))
+
+
+def test_size_cap_drops_oldest(tmp_path):
+    store = StoreAndForward(str(tmp_path / 'store.db'), max_bytes=100)
+    for index in range(10):
+        assert store.store('t', bytes([index]) * 19)
+    assert store.size <= 100
+    assert len(store) == 5
+    replayed = []
+    store.replay(lambda topic, payload: replayed.append(payload[0]) is None, limit=100)
+    assert replayed == [5, 6, 7, 8, 9]
+    assert store.stats()['evicted'] == 5
+
+
+def test_size_cap_drops_newest(tmp_path):
+    store = StoreAndForward(str(tmp_path / 'store.db'), max_bytes=100, eviction='drop_newest')
+    results = [store.store('t', bytes([index]) * 19) for index in range(10)]
+    assert results == [True] * 5 + [False] * 5
+    assert not store.store('t', b'x' * 200)
+    assert store.stats()['rejected'] == 6
+
+
+def test_store_survives_restart(tmp_path):
+    path = str(tmp_path / 'store.db')
+    store = StoreAndForward(path)
+    store.store('a', b'1')
+    store.store('b', b'22')
+    store.close()
+    reopened = StoreAndForward(path)
+    assert (len(reopened), reopened.size) == (2, 5)
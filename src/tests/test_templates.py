@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from bench import flexy_topic, make_birth
+from conftest import BIRTH_TIMESTAMP
+from pyapp.ewon_translate import FlexyDataTypes
+from pyapp.fake_mqtt import FakeMessage
+from pyapp.templates import TEMPLATE_DATATYPE, TemplateRegistry
+
+MIX = [('float', 1), ('integer', 1), ('boolean', 1)]
+PREFIX = 'bench/iono2x_bench/'
+SAMPLE_VALUES = {'float': '2.5', 'integer': '7', 'boolean': '1'}
+
+
+def value_of(metric):
+    return getattr(metric, metric.WhichOneof('value'))
+
+
+def properties(metric) -> dict:
+    return dict(zip(metric.properties.keys, (value_of(value) for value in metric.properties.values)))
+
+
+@pytest.fixture
+def templated(bridge):
+    # Flexy 0 of the fixture has a single group, Flexy 1 two groups of the same 20 members, Group0 and Group1
+    node = bridge(store=False, templates=TemplateRegistry(), writable_tags=['*/Group1/Tag1'])
+    birth, _ = make_birth(node.rnd, 1, 40, MIX, BIRTH_TIMESTAMP, repeated_groups=True)
+    node.translator.process_flexy_birth_message(node.client, None, birth)
+    node.birth_metrics = json.loads(birth.payload)['m']
+    return node
+
+
+def test_definition_in_nbirth(templated):
+    definitions = [metric for metric in templated.published('NBIRTH')[-1].metrics
+                   if metric.datatype == TEMPLATE_DATATYPE]
+    assert [metric.name for metric in definitions] == ['Group']
+    template = definitions[0].template_value
+    assert template.is_definition
+    assert [(member.name, member.datatype) for member in template.metrics] == \
+        [(f'Tag{tag}', FlexyDataTypes[metric['t']].sparkplug_code)
+         for tag, metric in enumerate(templated.birth_metrics[:20])]
+    assert all(member.is_null and properties(member) == {'Quality': 192, 'readOnly': True}
+               for member in template.metrics)
+
+
+def test_instances_in_dbirth(templated):
+    dbirth = templated.published('DBIRTH')[-1]
+    instances = [metric for metric in dbirth.metrics if metric.datatype == TEMPLATE_DATATYPE]
+    # Instance aliases follow the highest tag alias
+    assert [(metric.name, metric.alias) for metric in instances] == [(PREFIX + 'Group0', 41), (PREFIX + 'Group1', 42)]
+    assert len(dbirth.metrics) == 3   # the instances and Device Control/Rebirth
+    for group, instance in enumerate(instances):
+        assert instance.template_value.template_ref == 'Group'
+        assert not instance.template_value.is_definition
+        expected = templated.birth_metrics[group * 20:group * 20 + 20]
+        assert [(member.name, member.datatype, value_of(member)) for member in instance.template_value.metrics] == \
+            [(metric['n'].split('.')[1], FlexyDataTypes[metric['t']].sparkplug_code,
+              FlexyDataTypes[metric['t']].cast_value(metric['v'])) for metric in expected]
+    # Only writable members repeat the properties, the definition has readOnly=True for the others
+    writable = [member.name for member in instances[1].template_value.metrics if member.properties.keys]
+    assert writable == ['Tag1']
+    assert properties(instances[1].template_value.metrics[1])['readOnly'] is False
+
+
+def test_changed_members_in_ddata(templated):
+    # Aliases 1 and 2 are Group0/Tag0 and Tag1, alias 22 is Group1/Tag1
+    values = {alias: SAMPLE_VALUES[templated.birth_metrics[alias - 1]['t']] for alias in (1, 2, 22)}
+    templated.translator.process_flexy_data_message(templated.client, None, FakeMessage(
+        flexy_topic(1) + '/DATA', json.dumps({'t': BIRTH_TIMESTAMP + 1, 'm': [
+            {'a': str(alias), 'v': value} for alias, value in values.items()]}).encode()))
+    ddata = templated.published('DDATA')[-1]
+    assert [(metric.alias, metric.datatype, metric.template_value.template_ref) for metric in ddata.metrics] == \
+        [(41, TEMPLATE_DATATYPE, 'Group'), (42, TEMPLATE_DATATYPE, 'Group')]
+    members = [[(member.name, value_of(member), member.timestamp) for member in metric.template_value.metrics]
+               for metric in ddata.metrics]
+    cast = {alias: FlexyDataTypes[templated.birth_metrics[alias - 1]['t']].cast_value(value)
+            for alias, value in values.items()}
+    timestamp = (BIRTH_TIMESTAMP + 1) * 1000
+    assert members == [[('Tag0', cast[1], timestamp), ('Tag1', cast[2], timestamp)], [('Tag1', cast[22], timestamp)]]